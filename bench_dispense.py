@@ -0,0 +1,194 @@
+#!/usr/bin/python
+
+"""
+Benchmark for the Dispenser flow-integration path using the simulated
+GPIO backend. Pulse trains are played through a Dispenser at rates from
+the slowest measured flow to several kHz, including pours that start
+after an idle gap, and the pulse throughput, CPU time per pulse and
+volume error of each run are reported.
+
+    GPIO_BACKEND=sim python bench_dispense.py [--save FILE] [--baseline FILE]
+"""
+
+import os
+os.environ.setdefault('GPIO_BACKEND', 'sim')
+
+from dispenser import Dispenser
+from gpio import GPIO, SimulatedGPIO, constant_flow, bursty_flow, jitter, drop_edges
+
+import argparse
+import json
+import resource
+import sys
+import threading
+import time
+
+
+# pulse rates exercised by every scenario, the lowest just above the
+# 0.1 L/min minimum flow of the reference sensor
+RATES = [0.8, 1, 10, 100, 1000, 5000]
+
+# seconds of simulated flow per run
+DURATION = 4.0
+
+# simulated sensor pin
+SENSOR_PIN = 36
+
+# runs with fewer pulses are too short to compare cpu time
+CPU_MIN_PULSES = 1000
+
+# cpu differences below this many microseconds per pulse are noise
+CPU_FLOOR_US = 2.0
+
+# pulses per liter of the reference flow sensor
+PULSES_PER_LITER = 60 * 7.5
+
+# seconds without flow before the pour of the 'idle' scenario
+IDLE_GAP = 2.0
+
+
+class RecordingClient:
+    """Collects events that the Dispenser would publish over MQTT."""
+
+    def __init__(self):
+        self.events = []
+        self.pourEnded = threading.Event()
+
+    def publishEvent(self, event, msgFormat, data, qos=0):
+        self.events.append((event, dict(data)))
+        if event == 'pouring' and not data['state']:
+            self.pourEnded.set()
+
+    def dispensed(self):
+        return sum(data['amount'] for event, data in self.events if event == 'dispensed')
+
+
+def scenarios(rate):
+    train = constant_flow(rate, DURATION)
+    return [
+        ('constant', train, len(train)),
+        ('bursty', bursty_flow(rate, DURATION, 1.0, 0.5), None),
+        ('jitter', jitter(train, 0.1 / rate, seed=rate), len(train)),
+        ('dropped', drop_edges(train, 0.01, seed=rate), len(train)),
+        ('idle', [IDLE_GAP + edge for edge in train], len(train))
+    ]
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(name, rate, train, true_pulses):
+    if not isinstance(GPIO, SimulatedGPIO):
+        raise RuntimeError('benchmark requires the simulated GPIO backend')
+
+    if true_pulses is None:
+        true_pulses = len(train)
+
+    GPIO.setmode(GPIO.BOARD)
+    GPIO.setup(SENSOR_PIN, GPIO.IN)
+
+    client = RecordingClient()
+    dispenser = Dispenser(client, 0, SENSOR_PIN)
+    dispenser.clock = GPIO.time_ns
+    dispenser.connect_device()
+
+    worker = threading.Thread(target=dispenser.loop)
+    worker.start()
+
+    # wait for the loop to register its edge callback
+    while SENSOR_PIN not in GPIO.detects:
+        time.sleep(0.001)
+
+    cpu_start = cpu_time()
+    wall_start = time.time()
+
+    GPIO.play(SENSOR_PIN, train)
+
+    # let the pour time out so its volume is published
+    GPIO.advance(Dispenser.POUR_TIMEOUT + 1.0)
+    dispenser.pulseEvent.set()
+    client.pourEnded.wait(10.0)
+
+    wall = time.time() - wall_start
+    cpu = cpu_time() - cpu_start
+
+    dispenser.disconnect_device()
+    worker.join()
+    GPIO.cleanup()
+
+    expected = true_pulses / PULSES_PER_LITER * Dispenser.LITERS_TO_GAL
+    measured = client.dispensed()
+
+    return {
+        'scenario': name,
+        'rate': rate,
+        'pulses': len(train),
+        'dropped': dispenser.pulsesDropped,
+        'pulses_per_sec': len(train) / wall if wall > 0 else 0.0,
+        'cpu_us_per_pulse': cpu * 1e6 / len(train) if train else 0.0,
+        'volume_error': abs(measured - expected) / expected if expected else 0.0
+    }
+
+
+def compare(results, baseline, tolerance):
+    previous = dict(((r['scenario'], r['rate']), r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = previous.get((result['scenario'], result['rate']))
+        if old is None:
+            continue
+        if result['volume_error'] > old['volume_error'] + tolerance * 0.1:
+            regressions.append((result, 'volume_error', old['volume_error']))
+        if result['pulses'] < CPU_MIN_PULSES:
+            # fixed per-run overhead dominates short runs
+            continue
+        slowdown = result['cpu_us_per_pulse'] - old['cpu_us_per_pulse']
+        if slowdown > CPU_FLOOR_US and slowdown > old['cpu_us_per_pulse'] * tolerance:
+            regressions.append((result, 'cpu_us_per_pulse', old['cpu_us_per_pulse']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Dispenser pulse handling.')
+    parser.add_argument('--save', help='write results as json to this file')
+    parser.add_argument('--baseline', help='compare results against a saved json file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown before a run counts as a regression')
+    args = parser.parse_args()
+
+    results = []
+    print '%-10s %6s %8s %8s %12s %10s %8s' % ('scenario', 'rate', 'pulses', 'dropped', 'pulses/s', 'cpu us/p', 'error')
+    for rate in RATES:
+        for name, train, true_pulses in scenarios(rate):
+            # keep the dispenser's own output out of the table
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                result = run(name, rate, train, true_pulses)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            results.append(result)
+            print '%-10s %6g %8d %8d %12.0f %10.2f %7.2f%%' % (
+                name, rate, result['pulses'], result['dropped'], result['pulses_per_sec'],
+                result['cpu_us_per_pulse'], result['volume_error'] * 100)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for result, metric, old in regressions:
+            print 'REGRESSION %s %g Hz: %s %.4f (baseline %.4f)' % (
+                result['scenario'], result['rate'], metric, result[metric], old)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
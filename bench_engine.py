@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+"""
+Benchmark for the monitor state engine. Writer threads dispense into a
+Monitor through a StateEngine while reader threads poll the published
+state, and the write throughput, write latency and read throughput are
+reported along with a check that no dispensed amount was lost.
+
+    python bench_engine.py [--writers N] [--readers N] [--seconds S]
+"""
+
+from web_app import Monitor, Beverage
+from web_engine import StateEngine
+
+import argparse
+import threading
+import time
+
+
+# gallons removed by each simulated pour
+POUR = 0.01
+
+
+def build_monitor(count):
+    monitor = Monitor(5.0, 31.0, 1e9, 0)
+    for index in range(count):
+        monitor.add_beverage(Beverage('Beverage ' + str(index + 1), 5.0, 1e6, 1.0, 1, 0, False))
+    return monitor
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the monitor state engine.')
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--beverages', type=int, default=3)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    monitor = build_monitor(args.beverages)
+    engine = StateEngine(monitor.snapshot, lambda: monitor.version)
+
+    stop = threading.Event()
+    latencies = [[] for i in range(args.writers)]
+    reads = [0] * args.readers
+
+    def writer(number):
+        index = number % args.beverages
+        while not stop.is_set():
+            start = time.time()
+            engine.call(monitor.dispense_beverage, index, POUR)
+            latencies[number].append(time.time() - start)
+
+    def reader(number):
+        while not stop.is_set():
+            state = engine.state
+            sum(beverage.daily_total for beverage in state.beverages)
+            reads[number] += 1
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    engine.stop()
+
+    writes = [latency for history in latencies for latency in history]
+    expected = len(writes) * POUR
+    dispensed = monitor.column('daily_total').sum()
+
+    print 'writes/s      %12.0f' % (len(writes) / elapsed)
+    print 'write p50 ms  %12.3f' % (percentile(writes, 0.50) * 1000)
+    print 'write p99 ms  %12.3f' % (percentile(writes, 0.99) * 1000)
+    print 'reads/s       %12.0f' % (sum(reads) / elapsed)
+    print 'lost gallons  %12.6f' % (expected - dispensed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+"""
+End-to-end load test for MonitorApplication. Synthetic multi-tap pouring
+traffic is fed to event_callback through the in-process LocalBroker, with
+Cloudant replaced by a local HTTP stand-in, while reader threads poll the
+dashboard API. Each scenario reports event throughput, the latency from
+an event arriving to its 'log' publish, and the API latency under load.
+
+    python bench_monitor.py [--save FILE] [--baseline FILE]
+"""
+
+from transport import qos
+from web_broker import LocalBroker
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+
+# (name, events per second or 0 for as fast as the monitor accepts them)
+SCENARIOS = [
+    ('steady', 200),
+    ('busy', 1000),
+    ('saturate', 0)
+]
+
+# seconds of traffic per scenario
+DURATION = 5.0
+
+# seconds allowed for queued events to finish after the traffic stops
+DRAIN_TIMEOUT = 30.0
+
+# seconds allowed for the monitor to subscribe to the broker
+READY_TIMEOUT = 10.0
+
+# gallons removed by each simulated pour
+POUR = 0.01
+
+# pours between a tap going offline and back online
+ONLINE_EVERY = 50
+
+# seconds between polls of each dashboard reader
+POLL_INTERVAL = 0.01
+
+# latency differences below this many milliseconds are noise
+LATENCY_FLOOR_MS = 2.0
+
+
+class CloudantHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the view reads and bulk writes the monitor makes."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.reply({'rows': []})
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        body = json.loads(self.rfile.read(length) or 'null')
+        if self.path.endswith('/_bulk_docs'):
+            self.reply([{'id': doc.get('_id'), 'ok': True} for doc in body['docs']])
+        else:
+            self.reply({'ok': True})
+
+    def reply(self, data):
+        time.sleep(self.server.delay)
+        self.server.requests += 1
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CloudantStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), CloudantHandler)
+        self.delay = delay
+        self.requests = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+def write_monitor_config(path, taps):
+    with open(path, 'w') as f:
+        f.write('[monitor]\ntap_size=5.0\norder_amount=93.0\nmax_storage=310.0\ndays_to_order=2\n\n')
+        for index in range(taps):
+            f.write('[beverage%d]\nname=Tap %d\ntap=5.0\nstorage=300.0\ntotal_dispensed=30.0\n'
+                    'days_dispensed=30\nlast_order=\nauto_update=\n\n' % (index + 1, index + 1))
+
+
+def traffic(taps):
+    """Endless (event, data) stream of taps pouring in turn."""
+
+    cycle = 0
+    while True:
+        for index in range(taps):
+            if cycle % ONLINE_EVERY == 0:
+                yield 'online', {'beverage': index, 'state': True}
+            yield 'pouring', {'beverage': index, 'state': True}
+            yield 'dispensed', {'beverage': index, 'amount': POUR}
+            yield 'pouring', {'beverage': index, 'state': False}
+        cycle += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(name, rate, args, cloudant):
+    # imported here so CLOUDANT_URL is set before the connector reads it
+    from web_app import MonitorApplication
+
+    data_dir = tempfile.mkdtemp(prefix='bench-monitor-')
+    config = os.path.join(data_dir, 'monitor.cfg')
+    write_monitor_config(config, args.taps)
+
+    broker = LocalBroker()
+    app = MonitorApplication(config, 'config/bluemix/app.cfg', client=broker, data_dir=data_dir)
+
+    # the broker subscription comes up in the background, events sent
+    # before it would be lost
+    deadline = time.time() + READY_TIMEOUT
+    while not app.health.ready('iot'):
+        if time.time() > deadline:
+            app.disconnect()
+            raise RuntimeError('monitor did not subscribe to the broker within %.0f s' % READY_TIMEOUT)
+        time.sleep(0.01)
+
+    # every event is answered by one 'log' publish for its tap, in order
+    arrivals = [collections.deque() for index in range(args.taps)]
+    latencies = []
+    done = threading.Event()
+
+    def on_publish(message):
+        if message.event == 'log':
+            arrived = arrivals[message.data['beverage']].popleft()
+            latencies.append(time.time() - arrived)
+
+    broker.onEvent(on_publish)
+
+    stop = threading.Event()
+    api_latencies = [[] for i in range(args.readers)]
+
+    def reader(number):
+        while not stop.is_set():
+            for call in (lambda: app.get_snapshot('beverage'), lambda: app.get_snapshot('system'),
+                         app.get_all_weekly_totals):
+                start = time.time()
+                call()
+                api_latencies[number].append(time.time() - start)
+            time.sleep(POLL_INTERVAL)
+
+    readers = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    for thread in readers:
+        thread.start()
+
+    sent = 0
+    events = traffic(args.taps)
+    start = time.time()
+    while time.time() - start < args.seconds:
+        if rate:
+            # open loop, events go out on schedule however far behind the monitor is
+            delay = start + sent / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        event, data = next(events)
+        arrivals[data['beverage']].append(time.time())
+        broker.inject('RaspberryPi', app.device_prefix + str(data['beverage'] + 1), event, data, qos(event))
+        sent += 1
+    sending = time.time() - start
+
+    # the dropped events never publish, everything else should drain
+    deadline = time.time() + DRAIN_TIMEOUT
+    while len(latencies) < sent - app.pipeline.dropped and time.time() < deadline:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+
+    stop.set()
+    for thread in readers:
+        thread.join()
+    dropped = app.pipeline.dropped
+    app.disconnect()
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+    api = [latency for history in api_latencies for latency in history]
+    return {
+        'scenario': name,
+        'rate': rate,
+        'events': sent,
+        'dropped': dropped,
+        'sent_per_sec': sent / sending,
+        'events_per_sec': len(latencies) / elapsed,
+        'event_p50_ms': percentile(latencies, 0.50) * 1000,
+        'event_p99_ms': percentile(latencies, 0.99) * 1000,
+        'api_p50_ms': percentile(api, 0.50) * 1000,
+        'api_p99_ms': percentile(api, 0.99) * 1000
+    }
+
+
+def compare(results, baseline, tolerance):
+    previous = dict((r['scenario'], r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = previous.get(result['scenario'])
+        if old is None:
+            continue
+        if result['events_per_sec'] < old['events_per_sec'] * (1 - tolerance):
+            regressions.append((result, 'events_per_sec', old['events_per_sec']))
+        if result['dropped'] > old['dropped']:
+            regressions.append((result, 'dropped', old['dropped']))
+        for metric in ('event_p99_ms', 'api_p99_ms'):
+            slowdown = result[metric] - old[metric]
+            if slowdown > LATENCY_FLOOR_MS and slowdown > old[metric] * tolerance:
+                regressions.append((result, metric, old[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test MonitorApplication.')
+    parser.add_argument('--taps', type=int, default=12)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=DURATION)
+    parser.add_argument('--cloudant-delay', type=float, default=0.02,
+                        help='seconds the cloudant stand-in takes to answer')
+    parser.add_argument('--save', help='write results as json to this file')
+    parser.add_argument('--baseline', help='compare results against a saved json file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown before a run counts as a regression')
+    args = parser.parse_args()
+
+    cloudant = CloudantStandIn(args.cloudant_delay)
+    os.environ['CLOUDANT_URL'] = cloudant.url
+
+    results = []
+    print '%-10s %6s %8s %8s %10s %10s %10s %10s %10s' % (
+        'scenario', 'rate', 'events', 'dropped', 'events/s', 'p50 ms', 'p99 ms', 'api p50', 'api p99')
+    for name, rate in SCENARIOS:
+        # keep the monitor's own output out of the table
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            result = run(name, rate, args, cloudant)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        results.append(result)
+        print '%-10s %6d %8d %8d %10.0f %10.2f %10.2f %10.2f %10.2f' % (
+            name, rate, result['events'], result['dropped'], result['events_per_sec'],
+            result['event_p50_ms'], result['event_p99_ms'], result['api_p50_ms'], result['api_p99_ms'])
+
+    cloudant.shutdown()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for result, metric, old in regressions:
+            print 'REGRESSION %s: %s %.4f (baseline %.4f)' % (result['scenario'], metric, result[metric], old)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,16 @@
 #!/usr/bin/python
 
 from dispenser import Dispenser
+from gpio import GPIO
+from spool import EventSpool
+from transport import persistent_session
 
 import ibmiotf.device
 import json
-import RPi.GPIO as GPIO
+import os
 import sys
 import time
+import wire
 
 
 # number of beverage dispensers
@@ -15,6 +19,15 @@ NUM_BEVS = 3
 # I/O pins for beverage
 BEV_PIN = [36, 38, 40]
 
+# flow sensor calibration, pulse Hz per L/min of flow
+BEV_K_FACTOR = [7.5, 7.5, 7.5]
+
+# seconds between sensor path summaries sent to the monitor, 0 for none
+STATS_INTERVAL = 300.0
+
+# directory of the event spools holding events until the broker has them
+SPOOL_DIR = 'spool'
+
 beverage = int(sys.argv[1])
 dispenser = None
 
@@ -30,17 +43,24 @@ def command_callback(command):
     elif command.command == 'disconnect' and not dispenser.disconnect:
         print 'Disconnecting Beverage ' + str(beverage) + '...'
         dispenser.disconnect_device()
+    elif command.command == 'trace':
+        print 'Tracing next pour of Beverage ' + str(beverage) + '...'
+        dispenser.trace_next_pour()
+    elif command.command == 'wire':
+        dispenser.transport.negotiate((), command.data['version'])
 
 try:
-    options = ibmiotf.device.ParseConfigFile('config/bluemix/bev' + str(beverage) + '.cfg')
-    client = ibmiotf.device.Client(options)
+    options = persistent_session(ibmiotf.device.ParseConfigFile('config/bluemix/bev' + str(beverage) + '.cfg'))
+    client = wire.register(ibmiotf.device.Client(options))
     client.connect()
     client.commandCallback = command_callback
     
-    dispenser = Dispenser(client, beverage - 1, BEV_PIN[beverage - 1])
+    spool = EventSpool(os.path.join(SPOOL_DIR, 'bev' + str(beverage) + '.spool'))
+    dispenser = Dispenser(client, beverage - 1, BEV_PIN[beverage - 1], BEV_K_FACTOR[beverage - 1],
+                          stats_interval=STATS_INTERVAL, spool=spool)
     
     while True:
-        if dispenser.running:
+        if dispenser.wait_for_connect():
             dispenser.loop()
 except ibmiotf.ConnectionException as e:
     print e
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+from dispenser import Dispenser
+from gpio import GPIO
+from spool import EventSpool
+from transport import persistent_session
+
+import ibmiotf.gateway
+import os
+import sys
+import threading
+import wire
+
+
+# I/O pins for beverages, overridden by pins given on the command line
+BEV_PIN = [36, 38, 40]
+
+# flow sensor calibration, pulse Hz per L/min of flow
+BEV_K_FACTOR = [7.5, 7.5, 7.5]
+
+# seconds between sensor path summaries sent to the monitor, 0 for none
+STATS_INTERVAL = 300.0
+
+# directory of the event spools holding events until the broker has them
+SPOOL_DIR = 'spool'
+
+# device type of the beverage dispensers behind the gateway
+DEVICE_TYPE = 'RaspberryPi'
+
+
+class GatewayDevice:
+    """Publishes events for one dispenser through the shared gateway client."""
+
+    def __init__(self, client, deviceType, deviceId):
+        self.client = client
+        self.deviceType = deviceType
+        self.deviceId = deviceId
+
+        # set while the gateway is connected, read by the Transport
+        self.connectEvent = client.connectEvent
+
+    def publishEvent(self, event, msgFormat, data, qos=0, on_publish=None):
+        return self.client.publishDeviceEvent(self.deviceType, self.deviceId, event, msgFormat, data, qos=qos,
+                                              on_publish=on_publish)
+
+
+if len(sys.argv) > 1:
+    pins = [int(pin) for pin in sys.argv[1:]]
+else:
+    pins = BEV_PIN
+
+client = None
+dispensers = {}
+
+# edges from every sensor wake the one loop below
+pulseEvent = threading.Event()
+
+# setup I/O pins
+GPIO.setwarnings(False)
+GPIO.setmode(GPIO.BOARD)
+GPIO.setup(pins, GPIO.IN)
+
+def command_callback(command):
+    dispenser = dispensers.get(command.id)
+    if dispenser is None:
+        return
+
+    if command.command == 'connect' and not dispenser.running:
+        print 'Connecting Beverage ' + str(dispenser.index + 1) + '...'
+        dispenser.connect_device()
+    elif command.command == 'disconnect' and not dispenser.disconnect:
+        print 'Disconnecting Beverage ' + str(dispenser.index + 1) + '...'
+        dispenser.disconnect_device()
+    elif command.command == 'trace':
+        print 'Tracing next pour of Beverage ' + str(dispenser.index + 1) + '...'
+        dispenser.trace_next_pour()
+    elif command.command == 'wire':
+        dispenser.transport.negotiate((), command.data['version'])
+
+try:
+    options = persistent_session(ibmiotf.gateway.ParseConfigFile('config/bluemix/gateway.cfg'))
+    client = wire.register(ibmiotf.gateway.Client(options))
+    client.connect()
+    client.commandCallback = command_callback
+
+    for index, pin in enumerate(pins):
+        deviceId = 'bev' + str(index + 1)
+        if index < len(BEV_K_FACTOR):
+            k_factor = BEV_K_FACTOR[index]
+        else:
+            k_factor = Dispenser.DEFAULT_K_FACTOR
+
+        device = GatewayDevice(client, DEVICE_TYPE, deviceId)
+        spool = EventSpool(os.path.join(SPOOL_DIR, deviceId + '.spool'))
+        dispensers[deviceId] = Dispenser(device, index, pin, k_factor, pulseEvent=pulseEvent,
+                                         stats_interval=STATS_INTERVAL, spool=spool)
+        client.subscribeToDeviceCommands(deviceType=DEVICE_TYPE, deviceId=deviceId, command='+')
+
+    while True:
+        # sleep until an edge or command arrives or a pour may have timed out
+        pulseEvent.wait(Dispenser.IDLE_WAIT)
+        pulseEvent.clear()
+
+        for dispenser in dispensers.values():
+            if dispenser.active:
+                if dispenser.running and not dispenser.disconnect:
+                    dispenser.process()
+                else:
+                    dispenser.stop()
+                    dispenser.cleanup()
+            elif dispenser.running:
+                dispenser.start()
+except ibmiotf.ConnectionException as e:
+    print e
+except KeyboardInterrupt:
+    for dispenser in dispensers.values():
+        if dispenser.active:
+            dispenser.stop()
+            dispenser.cleanup()
+
+    if client:
+        client.disconnect()
+finally:
+    GPIO.cleanup()
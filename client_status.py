@@ -1,10 +1,15 @@
 #!/usr/bin/python
 
+from gpio import GPIO
+from spool import EventSpool
+from transport import Transport, persistent_session
+
 import ibmiotf.device
 import json
-import RPi.GPIO as GPIO
+import Queue
 import threading
 import time
+import wire
 
 
 # number of beverage dispensers
@@ -15,6 +20,15 @@ LED_RED = [7, 13, 29]
 LED_GRN = [11, 15, 31]
 BTN_REF = [33, 35, 37]
 
+# milliseconds during which further edges on a button are ignored
+BTN_BOUNCE_MS = 50
+
+# event spool holding refills until the broker has them
+SPOOL_PATH = 'spool/status.spool'
+
+# work for the main thread, filled by GPIO and MQTT callbacks
+tasks = Queue.Queue()
+
 # setup I/O pins
 GPIO.setwarnings(False)
 GPIO.setmode(GPIO.BOARD)
@@ -27,6 +41,10 @@ def toggle_lights(online):
         GPIO.output(LED_GRN[i], online[i])
         GPIO.output(LED_RED[i], not online[i])
 
+def button_callback(channel):
+    # runs on the GPIO thread, publishing is left to the main thread
+    tasks.put(('refill', BTN_REF.index(channel)))
+
 def command_callback(command):
     if command.command == 'info':
         beverages = command.data['beverages']
@@ -34,26 +52,34 @@ def command_callback(command):
         online = []
         for beverage in beverages:
             online.append(beverage['online'])
-        toggle_lights(online)
+        tasks.put(('lights', online))
+    elif command.command == 'wire':
+        transport.negotiate((), command.data['version'])
 
 try:
-    options = ibmiotf.device.ParseConfigFile('config/bluemix/status.cfg')
-    client = ibmiotf.device.Client(options)
+    options = persistent_session(ibmiotf.device.ParseConfigFile('config/bluemix/status.cfg'))
+    client = wire.register(ibmiotf.device.Client(options))
     client.connect()
+    transport = Transport(client, spool=EventSpool(SPOOL_PATH))
     client.commandCallback = command_callback
     
-    client.publishEvent('startup', 'json', {})
+    transport.event('startup', {'wire': wire.VERSION})
     
-    button_state = False
-    prev_button_state = False
+    # each button is debounced on its own channel
+    for pin in BTN_REF:
+        GPIO.add_event_detect(pin, GPIO.RISING, callback=button_callback, bouncetime=BTN_BOUNCE_MS)
     
     while True:
-        for i in range(NUM_BEVS):
-            button_state = GPIO.input(BTN_REF[i])
-            if button_state and button_state != prev_button_state:
-                client.publishEvent('refill', 'json', {'beverage': i})
-            prev_button_state = button_state
-        time.sleep(0.2)
+        try:
+            # a timeout keeps the wait responsive to KeyboardInterrupt
+            task, value = tasks.get(timeout=1.0)
+        except Queue.Empty:
+            continue
+        
+        if task == 'refill':
+            transport.event('refill', {'beverage': value})
+        elif task == 'lights':
+            toggle_lights(value)
 except ibmiotf.ConnectionException as e:
     print e
 except KeyboardInterrupt:
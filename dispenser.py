@@ -1,101 +1,367 @@
 #!/usr/bin/python
 
-import ibmiotf.device
-import json
-import RPi.GPIO as GPIO
+from gpio import GPIO, monotonic_ns, thread_cpu_ns
+from transport import Transport
+
+import collections
+import os
+import threading
 import time
+import wire
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Dispenser:
     LITERS_TO_GAL = 0.26417205234815
     GAL_LIMIT = 0.001
     
-    def __init__(self, client, index, sensor):
+    # sensor pulse frequency in Hz per L/min of flow
+    DEFAULT_K_FACTOR = 7.5
+    
+    # slowest flow in L/min the sensor measures, longer pulse intervals
+    # are gaps between pours
+    MIN_FLOW = 0.1
+    
+    # batches at least this long are integrated with numpy when available
+    VECTOR_BATCH_SIZE = 64
+    
+    # seconds without a pulse before a pour is considered finished
+    POUR_TIMEOUT = 3.0
+    
+    # maximum seconds the loop sleeps when no pulses arrive
+    IDLE_WAIT = 0.5
+    
+    # number of pulse timestamps held between loop iterations
+    PULSE_BUFFER_SIZE = 4096
+    
+    # seconds between published stats summaries, 0 to publish none
+    STATS_INTERVAL = 300.0
+    
+    # directory of the trace files written by trace_next_pour()
+    TRACE_DIR = 'traces'
+    
+    def __init__(self, client, index, sensor, k_factor=DEFAULT_K_FACTOR, flow_offset=0.0, pulseEvent=None,
+                 stats_interval=STATS_INTERVAL, spool=None, min_flow=MIN_FLOW):
         self.client = client
+        # with an EventSpool, pours survive a dropped link or a restart
+        self.transport = Transport(client, spool=spool)
         self.index = index
         self.sensor = sensor
         self.running = False
         self.disconnect = False
+        self.active = False
 
         self.pouring = False
         self.gallonsPoured = 0
+        
+        # sensor calibration, flow (L/min) = hertz / k_factor + flow_offset
+        self.k_factor = k_factor
+        self.flow_offset = flow_offset
+        
+        # pulse intervals in ns at or above this are gaps, not flow
+        self.maxPulseInterval = int(min(1e9 / (k_factor * min_flow), Dispenser.POUR_TIMEOUT * 1e9))
+        
+        # edge timestamps captured by the GPIO callback thread
+        self.pulses = collections.deque(maxlen=Dispenser.PULSE_BUFFER_SIZE)
+        self.pulsesDropped = 0
+        self.lastPinChange = 0
+        
+        # set on every edge, may be shared by dispensers on one loop
+        if pulseEvent is None:
+            pulseEvent = threading.Event()
+        self.pulseEvent = pulseEvent
+        self.connectEvent = threading.Event()
+        
+        # monotonic nanosecond time source, replaceable for simulation
+        self.clock = monotonic_ns
+        
+        # sensor path health, summarized every stats_interval seconds
+        self.stats = PulseStats()
+        self.stats_interval = stats_interval
+        self.statsStart = self.clock()
+        self.pourCpu = 0
+        
+        # open trace file of the pour being profiled, if any
+        self.traceArmed = False
+        self.trace = None
 
     def publish_data(self, event, data):
         data['beverage'] = self.index
-        self.client.publishEvent(event, 'json', data)
+        self.transport.event(event, data)
 
-    def loop(self):
-        self.publish_data('online', {'state': True})
+    def pulse_callback(self, channel):
+        # keep the edge callback as short as possible, integration is
+        # done by loop() on its own thread
+        if len(self.pulses) == self.pulses.maxlen:
+            self.pulsesDropped += 1
+        self.pulses.append(self.clock())
+        self.pulseEvent.set()
+
+    def drain_pulses(self):
+        pulses = []
+        while True:
+            try:
+                pulses.append(self.pulses.popleft())
+            except IndexError:
+                return pulses
+
+    def integrate(self, pulses, lastPinChange):
+        """
+        Converts a batch of pulse timestamps (ns) to gallons. Every pulse
+        contributes 1 / (60 * k_factor) liters, and every interval below
+        maxPulseInterval flow_offset L/min over its length; the interval
+        before the first pulse of a pour is a gap and adds no offset.
+        """
+        
+        if numpy is not None and len(pulses) >= Dispenser.VECTOR_BATCH_SIZE:
+            times = numpy.fromiter(pulses, dtype=numpy.int64, count=len(pulses))
+            deltas = numpy.diff(numpy.concatenate(([lastPinChange], times)))
+            duration = int(deltas[(deltas > 0) & (deltas < self.maxPulseInterval)].sum())
+        else:
+            duration = 0
+            for pinChange in pulses:
+                pinDelta = pinChange - lastPinChange
+                if 0 < pinDelta < self.maxPulseInterval:
+                    duration += pinDelta
+                lastPinChange = pinChange
+        
+        liters = len(pulses) / (60.0 * self.k_factor) + self.flow_offset * duration / 60e9
+        return liters * Dispenser.LITERS_TO_GAL
+
+    def start(self):
+        # announces the wire version, the monitor answers with a 'wire' command
+        self.publish_data('online', {'state': True, 'wire': wire.VERSION})
         
         self.disconnect = False
         self.pouring = False
         self.gallonsPoured = 0
         
-        lastPinState = False
-        pinState = 0
-        lastPinChange = int(time.time() * 1000)
-        pourStart = 0
-        pinChange = lastPinChange
-        pinDelta = 0
-        hertz = 0
-        flow = 0
-        
-        while self.running and not self.disconnect:
-            currentTime = int(time.time() * 1000)
+        self.pulses.clear()
+        self.lastPinChange = self.clock()
+        
+        GPIO.add_event_detect(self.sensor, GPIO.RISING, callback=self.pulse_callback)
+        self.active = True
+
+    def process(self):
+        cpuStart = thread_cpu_ns()
+        now = self.clock()
+        pulses = self.drain_pulses()
+        self.stats.iterations += 1
+        
+        if pulses and not self.pouring:
+            self.pouring = True
+            self.pourCpu = 0
+            if self.traceArmed:
+                self.start_trace()
+            self.publish_data('pouring', {'state': True})
+        
+        if pulses:
+            self.gallonsPoured += self.integrate(pulses, self.lastPinChange)
+            self.stats.observe(pulses, self.lastPinChange, now, self.maxPulseInterval)
+            if self.trace is not None:
+                self.trace.write('wake %d %d\n' % (now, len(pulses)))
+                self.trace.write(''.join('pulse %d\n' % pulse for pulse in pulses))
+            self.lastPinChange = pulses[-1]
+        
+        if self.pouring and (now - self.lastPinChange) > Dispenser.POUR_TIMEOUT * 1e9:
+            self.pourCpu += thread_cpu_ns() - cpuStart
+            cpuStart = None
+            self.stats.pours += 1
+            self.stats.pourCpu += self.pourCpu
+            
+            if self.trace is not None:
+                self.stop_trace()
             
-            if GPIO.input(self.sensor):
-                pinState = True
-            else:
-                pinState = False
-
-            if pinState != lastPinState and pinState:
-                if not self.pouring:
-                    pourStart = currentTime
-                    self.pouring = True
-                    self.publish_data('pouring', {'state': True})
+            if self.gallonsPoured > Dispenser.GAL_LIMIT:
+                # publish amount of liquid dispensed
+                self.publish_data('dispensed', {'amount': self.gallonsPoured})
                 
-                pinChange = currentTime
-                pinDelta = pinChange - lastPinChange
+                # print last amount poured
+                print self.gallonsPoured, 'gal'
                 
-                if pinDelta < 1000 and pinDelta != 0:
-                    # calculate the instantaneous speed
-                    hertz = 1000.0000 / pinDelta
-                    flow = hertz / ( 60 * 7.5 ) # L/s
-                    self.gallonsPoured += flow * pinDelta * Dispenser.LITERS_TO_GAL / 1000.0
-
-            if self.pouring and pinState == lastPinState and (currentTime - lastPinChange) > 3000:
-                if self.gallonsPoured > Dispenser.GAL_LIMIT:
-                    # publish amount of liquid dispensed
-                    self.publish_data('dispensed', {'amount': self.gallonsPoured})
-                    
-                    # print last amount poured
-                    print self.gallonsPoured, 'gal'
-                    
-                    # reset gallons poured
-                    self.gallonsPoured = 0
-
-                # reset pouring flag
-                self.pouring = False
-                self.publish_data('pouring', {'state': False})
+                # reset gallons poured
+                self.gallonsPoured = 0
 
-            lastPinChange = pinChange
-            lastPinState = pinState
+            # reset pouring flag
+            self.pouring = False
+            self.publish_data('pouring', {'state': False})
+        
+        if self.pouring and cpuStart is not None:
+            self.pourCpu += thread_cpu_ns() - cpuStart
+        
+        if self.stats_interval > 0 and now - self.statsStart >= self.stats_interval * 1e9:
+            summary = self.stats.summary(now - self.statsStart, self.pulsesDropped)
+            summary['unsent'] = self.transport.unsent
+            self.publish_data('stats', summary)
+            self.stats = PulseStats(self.stats.period)
+            self.statsStart = now
+    
+    def trace_next_pour(self):
+        """Writes every pulse and loop wake of the next pour to a trace file."""
+        
+        self.traceArmed = True
+    
+    def start_trace(self):
+        self.traceArmed = False
+        if not os.path.isdir(Dispenser.TRACE_DIR):
+            os.makedirs(Dispenser.TRACE_DIR)
+        path = os.path.join(Dispenser.TRACE_DIR, 'bev%d-%d.trace' % (self.index + 1, int(time.time() * 1000)))
+        self.trace = open(path, 'w')
+        self.trace.write('start %d %d\n' % (self.clock(), self.lastPinChange))
+    
+    def stop_trace(self):
+        self.trace.write('dispensed %.6f\n' % self.gallonsPoured)
+        self.trace.write('cpu %d\n' % self.pourCpu)
+        self.trace.close()
+        print 'Wrote trace ' + self.trace.name
+        self.trace = None
+
+    def stop(self):
+        GPIO.remove_event_detect(self.sensor)
+        self.active = False
+
+    def loop(self):
+        self.start()
+        self.pulseEvent.clear()
+        
+        try:
+            while self.running and not self.disconnect:
+                # sleep until an edge arrives or a pour may have timed out
+                self.pulseEvent.wait(Dispenser.IDLE_WAIT)
+                self.pulseEvent.clear()
+                
+                self.process()
+        finally:
+            self.stop()
 
         self.cleanup()
 
     def cleanup(self):
+        if self.trace is not None:
+            self.stop_trace()
+        
         if self.pouring:
             self.publish_data('dispensed', {'amount': self.gallonsPoured})
             time.sleep(0.2)
             self.publish_data('pouring', {'state': False})
             time.sleep(0.2)
+            self.pouring = False
         
         self.publish_data('online', {'state': False})
+        self.transport.flush()
         
         self.running = False
+        self.connectEvent.clear()
+
+    def wait_for_connect(self, timeout=1.0):
+        # block without spinning until the device is connected, a timeout
+        # keeps the caller responsive to KeyboardInterrupt
+        return self.connectEvent.wait(timeout)
 
     def connect_device(self):
         self.running = True
+        self.connectEvent.set()
+        self.pulseEvent.set()
     
     def disconnect_device(self):
         self.disconnect = True
+        self.pulseEvent.set()
+
+
+class PulseStats:
+    """
+    Health of one dispenser's sensor path over a stats window: how often
+    the loop ran, how regular the pulse intervals were, how many edges
+    look missed, and how much loop CPU each pour took.
+    """
+    
+    # an interval this many times the usual period suggests missed edges
+    MISSED_EDGE_FACTOR = 1.5
+    
+    # intervals beyond this many periods are a slowed pour, not missed edges
+    MISSED_EDGE_LIMIT = 4.5
+    
+    # weight of each interval in the usual pulse period
+    PERIOD_WEIGHT = 0.2
+    
+    def __init__(self, period=0.0):
+        self.iterations = 0
+        self.pulses = 0
+        self.intervals = 0
+        self.intervalTotal = 0
+        self.jitterTotal = 0
+        self.missed = 0
+        self.maxLatency = 0
+        self.pours = 0
+        self.pourCpu = 0
+        
+        # usual pulse interval in ns, carried over between windows
+        self.period = period
+        self.lastInterval = None
+    
+    def observe(self, pulses, lastPinChange, now, maxInterval):
+        self.pulses += len(pulses)
+        self.maxLatency = max(self.maxLatency, now - pulses[0])
+        
+        # each interval corrects the period the next one is judged by, so
+        # intervals are taken one at a time however the pulses were batched
+        period = self.period
+        lastInterval = self.lastInterval
+        intervals = 0
+        intervalTotal = 0
+        jitterTotal = 0
+        missed = 0
+        for pinChange in pulses:
+            pinDelta = pinChange - lastPinChange
+            lastPinChange = pinChange
+            if not 0 < pinDelta < maxInterval:
+                continue
+            
+            if period == 0:
+                period = float(pinDelta)
+            ratio = pinDelta / period
+            sample = pinDelta
+            if PulseStats.MISSED_EDGE_FACTOR < ratio < PulseStats.MISSED_EDGE_LIMIT:
+                missed += int(round(ratio)) - 1
+                # the period the missed edges would have split it into
+                sample = pinDelta / round(ratio)
+            
+            if lastInterval is not None:
+                jitterTotal += abs(pinDelta - lastInterval)
+            intervals += 1
+            intervalTotal += pinDelta
+            lastInterval = pinDelta
+            
+            period += PulseStats.PERIOD_WEIGHT * (sample - period)
+        
+        self.period = period
+        self.lastInterval = lastInterval
+        self.intervals += intervals
+        self.intervalTotal += intervalTotal
+        self.jitterTotal += jitterTotal
+        self.missed += missed
+    
+    def summary(self, window, dropped):
+        """Compact dict of the window's rates, window given in ns."""
+        
+        seconds = window / 1e9
+        data = {
+            'window_s': round(seconds, 1),
+            'loop_hz': round(self.iterations / seconds, 2),
+            'pulses': self.pulses,
+            'missed': self.missed,
+            'dropped': dropped,
+            'latency_ms': round(self.maxLatency / 1e6, 3),
+            'pours_per_hour': round(self.pours * 3600.0 / seconds, 2)
+        }
+        if self.intervals != 0:
+            data['period_us'] = round(self.intervalTotal / 1e3 / self.intervals, 1)
+        if self.intervals > 1:
+            data['jitter_us'] = round(self.jitterTotal / 1e3 / (self.intervals - 1), 1)
+        if self.pours != 0:
+            data['cpu_ms_per_pour'] = round(self.pourCpu / 1e6 / self.pours, 3)
+        return data
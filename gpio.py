@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+import ctypes
+import ctypes.util
+import os
+import random
+import threading
+import time
+
+
+class SimulatedGPIO:
+    """
+    Stand-in for the RPi.GPIO module so the clients can be run and
+    benchmarked on machines without GPIO hardware. Pins are held in
+    memory and edge callbacks are fired by play(), which drives a
+    pulse train through a pin on a virtual clock.
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}
+        self.directions = {}
+        self.detects = {}
+        self.lock = threading.Lock()
+
+        # virtual clock in seconds, advanced by play() and advance()
+        self.now = 0.0
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, channels, direction, pull_up_down=None, initial=None):
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels]
+        for channel in channels:
+            self.directions[channel] = direction
+            if initial is not None:
+                self.levels[channel] = initial
+            elif pull_up_down == SimulatedGPIO.PUD_UP:
+                self.levels[channel] = SimulatedGPIO.HIGH
+            else:
+                self.levels.setdefault(channel, SimulatedGPIO.LOW)
+
+    def input(self, channel):
+        return self.levels.get(channel, SimulatedGPIO.LOW)
+
+    def output(self, channels, values):
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels]
+        if not isinstance(values, (list, tuple)):
+            values = [values] * len(channels)
+        for channel, value in zip(channels, values):
+            self.levels[channel] = SimulatedGPIO.HIGH if value else SimulatedGPIO.LOW
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self.lock:
+            if channel in self.detects:
+                raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+            callbacks = [callback] if callback is not None else []
+            self.detects[channel] = [edge, callbacks, bouncetime, None]
+
+    def add_event_callback(self, channel, callback):
+        with self.lock:
+            self.detects[channel][1].append(callback)
+
+    def remove_event_detect(self, channel):
+        with self.lock:
+            self.detects.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        with self.lock:
+            if channel is None:
+                self.levels.clear()
+                self.directions.clear()
+                self.detects.clear()
+            else:
+                self.levels.pop(channel, None)
+                self.directions.pop(channel, None)
+                self.detects.pop(channel, None)
+
+    def time(self):
+        return self.now
+
+    def time_ns(self):
+        return int(round(self.now * 1e9))
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def set_level(self, channel, level):
+        """Drive an input pin and fire any matching edge callbacks."""
+
+        previous = self.levels.get(channel, SimulatedGPIO.LOW)
+        level = SimulatedGPIO.HIGH if level else SimulatedGPIO.LOW
+        self.levels[channel] = level
+        if level == previous:
+            return
+
+        with self.lock:
+            detect = self.detects.get(channel)
+            if detect is None:
+                return
+            edge, callbacks, bouncetime, last_edge = detect
+            if edge == SimulatedGPIO.RISING and not level:
+                return
+            if edge == SimulatedGPIO.FALLING and level:
+                return
+            if bouncetime and last_edge is not None and (self.now - last_edge) * 1000.0 < bouncetime:
+                return
+            detect[3] = self.now
+            callbacks = list(callbacks)
+
+        for callback in callbacks:
+            callback(channel)
+
+    def play(self, channel, train, realtime=False):
+        """
+        Drive a pulse train through an input pin. Each entry of train
+        is the time in seconds of a rising edge relative to the start of
+        playback. The virtual clock follows the train; with realtime
+        set the call also sleeps between edges.
+        """
+
+        start = self.now
+        wall_start = time.time()
+        for edge in train:
+            if realtime:
+                delay = edge - (time.time() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.now = start + edge
+            self.set_level(channel, SimulatedGPIO.HIGH)
+            self.set_level(channel, SimulatedGPIO.LOW)
+        return len(train)
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+_CLOCK_MONOTONIC = 1
+_clock_gettime = None
+
+if not hasattr(time, 'monotonic_ns'):
+    try:
+        _librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        _clock_gettime = _librt.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    except (OSError, AttributeError, TypeError):
+        _clock_gettime = None
+
+
+def monotonic_ns():
+    """
+    Nanoseconds from a clock that never jumps with wall time changes.
+    Falls back to the wall clock only where no monotonic source exists.
+    """
+
+    if hasattr(time, 'monotonic_ns'):
+        return time.monotonic_ns()
+    if _clock_gettime is not None:
+        ts = _timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) == 0:
+            return ts.tv_sec * 1000000000 + ts.tv_nsec
+    return int(time.time() * 1e9)
+
+
+_CLOCK_THREAD_CPUTIME_ID = 3
+
+
+def thread_cpu_ns():
+    """
+    Nanoseconds of CPU time used by the calling thread. Falls back to the
+    whole process where no per-thread clock exists.
+    """
+
+    if hasattr(time, 'thread_time_ns'):
+        return time.thread_time_ns()
+    if _clock_gettime is not None:
+        ts = _timespec()
+        if _clock_gettime(_CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) == 0:
+            return ts.tv_sec * 1000000000 + ts.tv_nsec
+    return int(time.clock() * 1e9)
+
+
+def constant_flow(hertz, duration):
+    """Edge times for a steady flow at the given pulse rate."""
+
+    count = int(hertz * duration)
+    return [(i + 1) / float(hertz) for i in range(count)]
+
+
+def bursty_flow(hertz, duration, burst, gap):
+    """Edge times for pours of burst seconds separated by gap seconds."""
+
+    train = []
+    offset = 0.0
+    while offset < duration:
+        length = min(burst, duration - offset)
+        train.extend(offset + edge for edge in constant_flow(hertz, length))
+        offset += burst + gap
+    return train
+
+
+def jitter(train, amount, seed=None):
+    """Move each edge by up to amount seconds while keeping the order."""
+
+    rng = random.Random(seed)
+    jittered = []
+    last = 0.0
+    for edge in train:
+        edge = max(last, edge + rng.uniform(-amount, amount))
+        jittered.append(edge)
+        last = edge
+    return jittered
+
+
+def drop_edges(train, probability, seed=None):
+    """Remove each edge with the given probability, as a noisy sensor would."""
+
+    rng = random.Random(seed)
+    return [edge for edge in train if rng.random() >= probability]
+
+
+# use the real GPIO module unless the simulator is requested; a Pi that
+# cannot open its pins must fail rather than quietly report no pours
+if os.getenv('GPIO_BACKEND') == 'sim':
+    GPIO = SimulatedGPIO()
+else:
+    try:
+        import RPi.GPIO as GPIO
+    except (ImportError, RuntimeError) as e:
+        print 'Cannot use RPi.GPIO (' + str(e) + '), set GPIO_BACKEND=sim to run without a Pi'
+        raise
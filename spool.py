@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+import json
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+
+class EventSpool:
+    """
+    Store-and-forward buffer of outgoing events in a memory-mapped ring
+    file. Every event gets a sequence number, the random epoch of the
+    spool file and the time it was added, and stays in the ring until
+    the broker acknowledges it, so events published while the link is
+    down, or before a crash or power cut, are sent again in order later.
+    Writes land in the page cache and are synced to the SD card at most
+    once per sync_interval. When the ring fills up the oldest events are
+    dropped.
+    """
+
+    MAGIC = 'BEVSPOOL'
+    VERSION = 2
+
+    # magic, version, epoch, next sequence, offsets of the oldest record and the next write
+    HEADER = struct.Struct('<8sIQQQQ')
+
+    # payload length, 0 marking a wrap to the start, and sequence
+    RECORD = struct.Struct('<IQ')
+
+    SIZE = 1 << 20
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, path, size=SIZE, sync_interval=SYNC_INTERVAL):
+        self.path = path
+        self.size = size
+        self.sync_interval = sync_interval
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.file = open(path, mode)
+        if os.path.getsize(path) != size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.dropped = 0
+        self.dirty = False
+        self.synced = time.time()
+
+        magic, version, self.epoch, self.next_seq, self.head, self.tail = EventSpool.HEADER.unpack_from(self.map)
+        if magic != EventSpool.MAGIC or version != EventSpool.VERSION:
+            # a new spool numbers from 1 under a new epoch, which the
+            # monitor sees as a new sequence however the clock is set
+            self.epoch = random.SystemRandom().getrandbits(63) or 1
+            self.next_seq = 1
+            self.head = self.tail = EventSpool.HEADER.size
+            self.write_header()
+        else:
+            self.recover()
+
+        # next record to send, the oldest unacknowledged one after a rewind
+        self.cursor = self.head
+
+        # last time the broker acknowledged something or a replay started
+        self.progress = time.time()
+
+    def write_header(self):
+        EventSpool.HEADER.pack_into(self.map, 0, EventSpool.MAGIC, EventSpool.VERSION,
+                                    self.epoch, self.next_seq, self.head, self.tail)
+        self.dirty = True
+
+    def recover(self):
+        """Cuts the ring at the first record a crash left torn."""
+
+        offset = self.head
+        while offset != self.tail:
+            offset = self.start(offset)
+            length, seq = EventSpool.RECORD.unpack_from(self.map, offset)
+            end = offset + EventSpool.RECORD.size + length
+            if end > self.size:
+                break
+            try:
+                json.loads(self.map[offset + EventSpool.RECORD.size:end])
+            except ValueError:
+                break
+            offset = end
+        if offset != self.tail:
+            self.tail = offset
+            self.write_header()
+
+    def start(self, offset):
+        """Offset of the record at or wrapped around from the given offset."""
+
+        if offset + EventSpool.RECORD.size > self.size:
+            return EventSpool.HEADER.size
+        if EventSpool.RECORD.unpack_from(self.map, offset)[0] == 0:
+            return EventSpool.HEADER.size
+        return offset
+
+    def place(self, need):
+        """Offset where a record of need bytes fits, or None when the ring is full."""
+
+        first = EventSpool.HEADER.size
+        if self.head == self.tail:
+            self.head = self.tail = self.cursor = first
+            return first if first + need < self.size else None
+        if self.tail > self.head:
+            if self.tail + need <= self.size:
+                return self.tail
+            # the head never catches the tail, which would read as empty
+            if first + need < self.head:
+                return first
+            return None
+        if self.tail + need < self.head:
+            return self.tail
+        return None
+
+    def drop_oldest(self):
+        offset = self.start(self.head)
+        length = EventSpool.RECORD.unpack_from(self.map, offset)[0]
+        if self.cursor == self.head:
+            self.cursor = offset + EventSpool.RECORD.size + length
+        self.head = offset + EventSpool.RECORD.size + length
+        self.dropped += 1
+
+    def append(self, name, data):
+        """Adds an event, stamping its data with the epoch, next sequence number and time."""
+
+        with self.lock:
+            seq = self.next_seq
+            data['epoch'] = self.epoch
+            data['seq'] = seq
+            # replays reach the monitor late, the time keeps them in their hour
+            data['time'] = int(time.time() * 1000)
+            payload = json.dumps([name, data])
+            need = EventSpool.RECORD.size + len(payload)
+            if need >= self.size - EventSpool.HEADER.size:
+                raise ValueError('Event too large for the spool: ' + name)
+
+            offset = self.place(need)
+            while offset is None:
+                self.drop_oldest()
+                offset = self.place(need)
+
+            if offset != self.tail and self.tail + EventSpool.RECORD.size <= self.size:
+                EventSpool.RECORD.pack_into(self.map, self.tail, 0, 0)
+            EventSpool.RECORD.pack_into(self.map, offset, len(payload), seq)
+            self.map[offset + EventSpool.RECORD.size:offset + need] = payload
+
+            self.next_seq = seq + 1
+            self.tail = offset + need
+            self.write_header()
+            self.available.notify()
+            return seq
+
+    def take(self, timeout):
+        """Returns the next unsent (seq, name, data), waiting up to timeout."""
+
+        with self.lock:
+            if self.cursor == self.tail:
+                self.available.wait(timeout)
+                if self.cursor == self.tail:
+                    return None
+
+            offset = self.start(self.cursor)
+            length, seq = EventSpool.RECORD.unpack_from(self.map, offset)
+            payload = self.map[offset + EventSpool.RECORD.size:offset + EventSpool.RECORD.size + length]
+            self.cursor = offset + EventSpool.RECORD.size + length
+
+        name, data = json.loads(payload)
+        return seq, name, data
+
+    def ack(self, seq):
+        """Frees every record up to seq, called once the broker has it."""
+
+        with self.lock:
+            while self.head != self.tail:
+                offset = self.start(self.head)
+                length, first = EventSpool.RECORD.unpack_from(self.map, offset)
+                if first > seq:
+                    break
+                if self.cursor == self.head:
+                    self.cursor = offset + EventSpool.RECORD.size + length
+                self.head = offset + EventSpool.RECORD.size + length
+            self.write_header()
+            self.progress = time.time()
+
+    def rewind(self):
+        """Sends again from the oldest unacknowledged record."""
+
+        with self.lock:
+            self.cursor = self.head
+            self.progress = time.time()
+
+    def stalled(self, timeout):
+        """Whether sent records have waited over timeout seconds for an ack."""
+
+        with self.lock:
+            return self.head != self.cursor and time.time() - self.progress > timeout
+
+    def backlog(self):
+        with self.lock:
+            if self.tail >= self.head:
+                return self.tail - self.head
+            return self.size - self.head + self.tail
+
+    def sync(self, force=False):
+        """Writes the ring to disk if sync_interval has passed since the last time."""
+
+        with self.lock:
+            if not self.dirty or (not force and time.time() - self.synced < self.sync_interval):
+                return
+            self.dirty = False
+            self.synced = time.time()
+        self.map.flush()
+
+    def close(self):
+        self.sync(True)
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GPIO_BACKEND', 'sim')
+
+from dispenser import Dispenser, PulseStats
+from gpio import constant_flow, drop_edges, jitter
+
+
+# pulse gaps in ns treated as flow, as for the reference sensor
+MAX_INTERVAL = int(1e9 / (Dispenser.DEFAULT_K_FACTOR * Dispenser.MIN_FLOW))
+
+
+class PulseStatsTest(unittest.TestCase):
+    def train(self):
+        # a noisy 200 Hz pour with missed edges, then a second pour after a gap
+        edges = drop_edges(jitter(constant_flow(200, 5.0), 0.0005, seed=1), 0.02, seed=2)
+        edges += [edge + 60.0 for edge in constant_flow(50, 2.0)]
+        return [int(edge * 1e9) for edge in edges]
+
+    def observe(self, pulses, batch):
+        stats = PulseStats()
+        last = 0
+        for start in range(0, len(pulses), batch):
+            chunk = pulses[start:start + batch]
+            stats.observe(chunk, last, chunk[-1], MAX_INTERVAL)
+            last = chunk[-1]
+        return stats
+
+    def test_batching_does_not_change_summary(self):
+        pulses = self.train()
+        whole = self.observe(pulses, len(pulses))
+        self.assertGreater(whole.missed, 0)
+
+        window = pulses[-1]
+        expected = whole.summary(window, 0)
+        del expected['latency_ms']
+        for batch in (1, 3, Dispenser.VECTOR_BATCH_SIZE - 1, Dispenser.VECTOR_BATCH_SIZE, 500):
+            stats = self.observe(pulses, batch)
+            summary = stats.summary(window, 0)
+            del summary['latency_ms']
+            self.assertEqual(summary, expected)
+            self.assertAlmostEqual(stats.period, whole.period)
+
+    def test_missed_edges_do_not_skew_period(self):
+        period = int(1e9 / 200)
+        pulses = [period * (i + 1) for i in range(400) if i % 10 != 5]
+        stats = self.observe(pulses, len(pulses))
+        self.assertEqual(stats.missed, 40)
+        self.assertAlmostEqual(stats.period, period, delta=1)
+
+
+class IntegrateTest(unittest.TestCase):
+    def test_vector_and_scalar_integration_agree(self):
+        dispenser = Dispenser(None, 0, 36, flow_offset=0.05)
+        pulses = [int(edge * 1e9) for edge in jitter(constant_flow(100, 3.0), 0.001, seed=3)]
+
+        # the pour starts after a pause longer than any pulse interval
+        idle = pulses[0] - 2 * dispenser.maxPulseInterval
+
+        scalar = 0.0
+        for start in range(0, len(pulses), Dispenser.VECTOR_BATCH_SIZE - 1):
+            chunk = pulses[start:start + Dispenser.VECTOR_BATCH_SIZE - 1]
+            scalar += dispenser.integrate(chunk, pulses[start - 1] if start else idle)
+        vector = dispenser.integrate(pulses, idle)
+        self.assertAlmostEqual(scalar, vector)
+
+        # every pulse is counted, the offset only adds flow between pulses
+        liters = len(pulses) / (60.0 * Dispenser.DEFAULT_K_FACTOR) + 0.05 * (pulses[-1] - pulses[0]) / 60e9
+        self.assertAlmostEqual(vector, liters * Dispenser.LITERS_TO_GAL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from spool import EventSpool
+
+
+class EventSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'bev1.spool')
+        self.spools = []
+
+    def tearDown(self):
+        for spool in self.spools:
+            if not spool.file.closed:
+                spool.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, size=EventSpool.SIZE):
+        spool = EventSpool(self.path, size)
+        self.spools.append(spool)
+        return spool
+
+    def take_all(self, spool):
+        records = []
+        while True:
+            record = spool.take(0)
+            if record is None:
+                return records
+            records.append(record)
+
+    def test_events_are_stamped(self):
+        spool = self.open()
+        data = {'beverage': 0, 'amount': 0.5}
+        seq = spool.append('dispensed', data)
+
+        self.assertEqual(seq, 1)
+        self.assertEqual(data['epoch'], spool.epoch)
+        self.assertAlmostEqual(data['time'] / 1000.0, time.time(), delta=5)
+        self.assertEqual(spool.take(0), (1, 'dispensed', data))
+
+    def test_reopen_keeps_epoch_and_unacknowledged_events(self):
+        spool = self.open()
+        for index in range(3):
+            spool.append('dispensed', {'beverage': index, 'amount': 0.5})
+        spool.take(0)
+        spool.ack(1)
+        epoch = spool.epoch
+        spool.close()
+
+        spool = self.open()
+        self.assertEqual(spool.epoch, epoch)
+        self.assertEqual([(seq, data['beverage']) for seq, name, data in self.take_all(spool)], [(2, 1), (3, 2)])
+        self.assertEqual(spool.append('refill', {'beverage': 0}), 4)
+
+    def test_new_or_corrupt_spool_starts_a_new_epoch(self):
+        spool = self.open()
+        spool.append('refill', {'beverage': 0})
+        epoch = spool.epoch
+        spool.close()
+
+        with open(self.path, 'r+b') as f:
+            f.write('NOTSPOOL')
+        spool = self.open()
+        self.assertNotEqual(spool.epoch, epoch)
+        self.assertEqual(self.take_all(spool), [])
+        self.assertEqual(spool.append('refill', {'beverage': 0}), 1)
+
+    def test_rewind_resends_unacknowledged_events_in_order(self):
+        spool = self.open()
+        for index in range(4):
+            spool.append('dispensed', {'beverage': index, 'amount': 0.5})
+        self.assertEqual([record[0] for record in self.take_all(spool)], [1, 2, 3, 4])
+        spool.ack(2)
+        self.assertTrue(spool.stalled(-1))
+
+        spool.rewind()
+        self.assertEqual([record[0] for record in self.take_all(spool)], [3, 4])
+        spool.ack(4)
+        self.assertEqual(spool.backlog(), 0)
+        self.assertFalse(spool.stalled(-1))
+
+    def test_full_ring_wraps_and_drops_the_oldest(self):
+        spool = self.open(1024)
+        for index in range(100):
+            spool.append('dispensed', {'beverage': 1, 'amount': float(index)})
+        self.assertGreater(spool.dropped, 0)
+
+        seqs = [record[0] for record in self.take_all(spool)]
+        self.assertEqual(seqs, range(seqs[0], 101))
+        self.assertEqual(len(seqs), 100 - spool.dropped)
+
+        # the wrapped ring reads back the same after a restart
+        spool.close()
+        spool = self.open(1024)
+        self.assertEqual([record[0] for record in self.take_all(spool)], seqs)
+
+    def test_torn_record_is_cut_on_recovery(self):
+        spool = self.open()
+        spool.append('dispensed', {'beverage': 0, 'amount': 0.5})
+        spool.append('dispensed', {'beverage': 1, 'amount': 0.5})
+        torn = spool.tail + EventSpool.RECORD.size
+        spool.append('dispensed', {'beverage': 2, 'amount': 0.5})
+        spool.close()
+
+        # a power cut after the header was written but before the payload
+        with open(self.path, 'r+b') as f:
+            f.seek(torn + 5)
+            f.write('\0' * 10)
+
+        spool = self.open()
+        self.assertEqual([record[0] for record in self.take_all(spool)], [1, 2])
+        self.assertEqual(spool.append('refill', {'beverage': 0}), 4)
+        self.assertEqual([record[0] for record in self.take_all(spool)], [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
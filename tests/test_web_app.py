@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from web_app import MonitorApplication
+from web_broker import LocalBroker
+from web_forecast import ConsumptionForecaster
+
+
+MONITOR_CONFIG = os.path.join(ROOT, 'config', 'data', 'monitor.cfg')
+IOT_CONFIG = os.path.join(ROOT, 'config', 'bluemix', 'app.cfg')
+
+
+class MonitorApplicationTest(unittest.TestCase):
+    # seconds allowed for a dependency to be tried in the background
+    START_TIMEOUT = 10.0
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.app = MonitorApplication(MONITOR_CONFIG, IOT_CONFIG, client=LocalBroker(), data_dir=self.data_dir)
+
+    def tearDown(self):
+        if self.app is not None:
+            self.app.disconnect()
+        shutil.rmtree(self.data_dir)
+
+    def wait_for(self, app, name, state):
+        deadline = time.time() + MonitorApplicationTest.START_TIMEOUT
+        while app.health.report()['dependencies'][name]['state'] != state:
+            self.assertLess(time.time(), deadline, name + ' never became ' + state)
+            time.sleep(0.01)
+
+    def test_forecast_advance_changes_etag(self):
+        etag = self.app.get_snapshot('beverage')[0]
+        self.assertEqual(self.app.get_snapshot('beverage')[0], etag)
+
+        self.app.update_forecast(time.time() + 3600)
+        self.assertNotEqual(self.app.get_snapshot('beverage')[0], etag)
+
+    def test_idle_beverage_snapshot_is_strict_json(self):
+        # nobody drinks the beverage, so it never runs out
+        self.app.update_beverage(1, {'name': None, 'tap': None, 'storage': None, 'average_dispensed': '0'})
+        self.app.update_system({'tap_size': None, 'order_amount': None, 'max_storage': None, 'days_to_order': '5000'})
+
+        def reject(constant):
+            raise ValueError('not json: ' + constant)
+
+        beverages = json.loads(self.app.get_snapshot('beverage')[1], parse_constant=reject)
+        self.assertEqual(beverages[1]['days_left'], ConsumptionForecaster.MAX_DAYS)
+        json.loads(json.dumps(self.app.get_beverage_data(1)), parse_constant=reject)
+
+        # an idle beverage is never ordered, however far ahead orders are made
+        self.assertEqual(beverages[1]['last_order'], 0)
+        self.assertNotEqual(beverages[0]['last_order'], 0)
+
+    def test_dispense_history_written_off_the_state_writer(self):
+        threads = []
+        record = self.app.history.record
+
+        def recording(*args):
+            threads.append(threading.current_thread())
+            record(*args)
+        self.app.history.record = recording
+
+        self.app.apply_event('dispensed', {'beverage': 1, 'amount': 0.5})
+        self.app.pipeline.stop()
+
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], self.app.engine.writer)
+        self.assertEqual(self.app.history.daily_totals(1, 1)[0][1:], (0.5, 1))
+
+    def test_replayed_events_are_dropped_within_an_epoch(self):
+        def pour(epoch, seq):
+            self.app.handle_event('dispensed', {'beverage': 0, 'amount': 0.5, 'epoch': epoch, 'seq': seq}, 'Bev2')
+        daily_total = self.app.monitor.get_beverage(0).daily_total
+
+        pour(5, 3)
+        pour(5, 3)
+        pour(5, 2)
+        self.assertEqual(self.app.monitor.get_beverage(0).daily_total, daily_total + 0.5)
+
+        # the device lost its spool and counts again from 1
+        pour(6, 1)
+        self.assertEqual(self.app.monitor.get_beverage(0).daily_total, daily_total + 1.0)
+        self.assertEqual(self.app.sequences, {'bev2': (6, 1)})
+
+        # a restart loads the saved config, as web_backing does
+        self.app.disconnect()
+        self.app = MonitorApplication(self.app.update_config_path, IOT_CONFIG, client=LocalBroker(), data_dir=self.data_dir)
+        self.assertEqual(self.app.sequences, {'bev2': (6, 1)})
+
+    def test_failed_event_is_not_marked_seen(self):
+        data = {'beverage': 0, 'amount': 0.5, 'epoch': 5, 'seq': 1}
+        dispense = self.app.monitor.dispense_beverage
+
+        def failing(*args):
+            raise IOError('disk full')
+        self.app.monitor.dispense_beverage = failing
+        self.assertRaises(IOError, self.app.handle_event, 'dispensed', dict(data), 'bev2')
+        self.assertEqual(self.app.sequences, {})
+
+        # the device resends it and this time it is applied
+        self.app.monitor.dispense_beverage = dispense
+        self.app.handle_event('dispensed', dict(data), 'bev2')
+        self.assertEqual(self.app.sequences, {'bev2': (5, 1)})
+
+    def test_spooled_pour_counts_in_the_hour_it_was_poured(self):
+        now = int(time.time() * 1000)
+        poured = self.app.history.hour_start(now) - 3 * 3600 * 1000 + 60 * 1000
+        self.app.handle_event('dispensed', {'beverage': 1, 'amount': 0.5, 'epoch': 5, 'seq': 1, 'time': poured}, 'bev2')
+
+        # a device clock running ahead is held to the time of arrival
+        self.app.handle_event('dispensed', {'beverage': 1, 'amount': 0.25, 'epoch': 5, 'seq': 2, 'time': now + 3600 * 1000}, 'bev2')
+        self.app.pipeline.stop()
+
+        hours = self.app.history.hourly_totals(1, 2)
+        self.assertEqual(hours[1], (self.app.history.hour_start(poured), 0.5, 1))
+        self.assertEqual(hours[0][1:], (0.25, 1))
+        self.assertLessEqual(hours[0][0], int(time.time() * 1000))
+
+    def test_merge_overlapping_weeks(self):
+        history = self.app.history
+        today = history.day_start(int(time.time() * 1000))
+        days = [today]
+        for count in range(10):
+            days.append(history.day_start(days[-1] - 1))
+
+        # local rollups for yesterday back to three days ago, and today so far
+        local = [self.app.week_row(0, day, 1.0) for day in days[:4]]
+
+        # cloudant totals posted five minutes after the midnight ending each day
+        remote = [{'key': None, 'value': {'beverage': 1, 'date': end + 5 * 60 * 1000, 'amount_dispensed': 2.0}}
+                  for end in days[1:10]]
+
+        week = self.app.merge_week(0, local, remote, today)
+        self.assertEqual([row['key'] for row in week], days[1:8])
+        self.assertEqual([row['value']['amount_dispensed'] for row in week], [1.0] * 3 + [2.0] * 4)
+
+    def test_disconnect_without_broker(self):
+        self.app.disconnect()
+        self.app = None
+
+        # no broker connection was ever made, shutdown still saves state
+        app = MonitorApplication(MONITOR_CONFIG, os.path.join(self.data_dir, 'missing.cfg'), data_dir=self.data_dir)
+        self.wait_for(app, 'iot', 'failed')
+        self.wait_for(app, 'scheduler', 'ready')
+        if os.path.exists(app.forecast_path):
+            os.remove(app.forecast_path)
+
+        app.disconnect()
+        self.assertIsNone(app.transport)
+        self.assertTrue(os.path.exists(app.forecast_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
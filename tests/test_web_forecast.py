@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+import numpy
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from web_forecast import ConsumptionForecaster
+
+
+# a fixed hour, the profiles start flat so any one will do
+NOW = 1792497600.0
+
+
+class ConsumptionForecasterTest(unittest.TestCase):
+    def setUp(self):
+        self.forecast = ConsumptionForecaster(4)
+        for index, average in enumerate((24.0, 12.0, 0.0, 48.0)):
+            self.forecast.reset(index, average, NOW)
+
+    def test_idle_beverage_has_finite_days_left(self):
+        days = self.forecast.days_left(numpy.array([10.0, 10.0, 10.0]), [0, 1, 2], NOW)
+        self.assertEqual(days[2], ConsumptionForecaster.MAX_DAYS)
+        self.assertTrue(numpy.isfinite(days).all())
+
+        single = self.forecast.days_left(numpy.array([10.0]), [2], NOW)
+        self.assertEqual(single[0], ConsumptionForecaster.MAX_DAYS)
+
+    def test_days_left_is_capped(self):
+        days = self.forecast.days_left(numpy.array([1e9, 1e9]), [0, 1], NOW)
+        self.assertTrue((days == ConsumptionForecaster.MAX_DAYS).all())
+        self.assertEqual(self.forecast.days_left(numpy.array([1e9]), [0], NOW)[0], ConsumptionForecaster.MAX_DAYS)
+
+    def test_single_and_vector_forecasts_agree(self):
+        storage = numpy.array([10.0, 3.0, 5.0, 100.0])
+        days = self.forecast.days_left(storage, [0, 1, 2, 3], NOW)
+        for index in range(4):
+            single = self.forecast.days_left(storage[index:index + 1], [index], NOW)[0]
+            self.assertAlmostEqual(single, days[index])
+
+        # a flat profile of 1 gallon an hour drains 10 gallons in 10 hours
+        self.assertAlmostEqual(days[0], 10.0 / 24.0)
+
+    def test_late_amount_matches_recording_in_time(self):
+        late = ConsumptionForecaster(4)
+        for index, average in enumerate((24.0, 12.0, 0.0, 48.0)):
+            late.reset(index, average, NOW)
+
+        # ten days of pours, one of them replayed after the rest
+        for hour in range(240):
+            amount = 1.0 + hour % 7
+            self.forecast.record(0, amount, NOW + hour * 3600)
+            if hour != 30:
+                late.record(0, amount, NOW + hour * 3600)
+        late.record(0, 1.0 + 30 % 7, NOW + 30 * 3600)
+
+        for name in ('recent', 'profile', 'amount', 'hour'):
+            numpy.testing.assert_array_almost_equal(getattr(late, name), getattr(self.forecast, name))
+
+    def test_save_and_load_round_trip(self):
+        self.forecast.record(0, 3.0, NOW)
+        self.forecast.advance_all(4, NOW + 3600)
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'forecast.npz')
+            self.forecast.save(path, 4)
+            restored = ConsumptionForecaster(8)
+            restored.load(path, 4)
+        finally:
+            shutil.rmtree(directory)
+
+        for name in ConsumptionForecaster.ARRAYS:
+            numpy.testing.assert_array_equal(getattr(restored, name)[:4], getattr(self.forecast, name))
+        storage = numpy.array([10.0, 3.0, 5.0, 100.0])
+        numpy.testing.assert_array_almost_equal(restored.days_left(storage, [0, 1, 2, 3], NOW + 3600),
+                                                self.forecast.days_left(storage, [0, 1, 2, 3], NOW + 3600))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from web_outbox import CloudantOutbox
+
+
+class FakeResponse:
+    def __init__(self, status_code, results):
+        self.status_code = status_code
+        self.results = results
+
+    def json(self):
+        return self.results
+
+
+class FakeConnector:
+    """Answers bulk writes from a list of outcomes, the last one repeating."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def post_bulk(self, batch):
+        with self.lock:
+            self.batches.append([dict(document) for document in batch])
+            outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if outcome == 'down':
+            raise IOError('cloudant unreachable')
+        if outcome == 'conflict':
+            return FakeResponse(201, [{'id': document['_id'], 'error': 'conflict'} for document in batch])
+        return FakeResponse(outcome, [{'id': document['_id'], 'ok': True} for document in batch])
+
+
+class CloudantOutboxTest(unittest.TestCase):
+    # seconds allowed for the sender to catch up
+    TIMEOUT = 5.0
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox.jsonl')
+        self.outboxes = []
+
+        self.timing = (CloudantOutbox.BATCH_DELAY, CloudantOutbox.MIN_BACKOFF)
+        CloudantOutbox.BATCH_DELAY = 0.01
+        CloudantOutbox.MIN_BACKOFF = 0.01
+
+    def tearDown(self):
+        for outbox in self.outboxes:
+            outbox.close()
+            outbox.worker.join(CloudantOutboxTest.TIMEOUT)
+        CloudantOutbox.BATCH_DELAY, CloudantOutbox.MIN_BACKOFF = self.timing
+        shutil.rmtree(self.directory)
+
+    def open(self, connector):
+        outbox = CloudantOutbox(connector, self.path)
+        self.outboxes.append(outbox)
+        return outbox
+
+    def wait_until_sent(self, outbox):
+        deadline = time.time() + CloudantOutboxTest.TIMEOUT
+        while True:
+            with outbox.condition:
+                if not outbox.pending:
+                    return
+            self.assertLess(time.time(), deadline, 'outbox never drained')
+            time.sleep(0.01)
+
+    def stored(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_documents_survive_a_restart(self):
+        connector = FakeConnector('down')
+        outbox = self.open(connector)
+        outbox.post_many([{'beverage': 1, 'amount_dispensed': 1.5}, {'beverage': 2, 'amount_dispensed': 0.5}])
+        posted = self.stored()
+        self.assertEqual([document['beverage'] for document in posted], [1, 2])
+        outbox.close()
+
+        connector = FakeConnector(201)
+        outbox = self.open(connector)
+        self.assertEqual(outbox.pending, posted)
+        self.wait_until_sent(outbox)
+        self.assertEqual(connector.batches[-1], posted)
+        self.assertEqual(self.stored(), [])
+
+    def test_torn_line_is_dropped_on_recovery(self):
+        with open(self.path, 'w') as f:
+            f.write(json.dumps({'_id': 'a', 'beverage': 1}) + '\n')
+            f.write(json.dumps({'_id': 'b', 'beverage': 2})[:10])
+
+        outbox = self.open(FakeConnector('down'))
+        self.assertEqual(outbox.pending, [{'_id': 'a', 'beverage': 1}])
+
+    def test_failed_writes_are_retried_with_the_same_ids(self):
+        connector = FakeConnector('down', 500, 201)
+        outbox = self.open(connector)
+        outbox.post({'beverage': 1, 'amount_dispensed': 1.5})
+        self.wait_until_sent(outbox)
+
+        self.assertEqual(len(connector.batches), 3)
+        self.assertEqual(len(set(batch[0]['_id'] for batch in connector.batches)), 1)
+        self.assertEqual(outbox.backoff, CloudantOutbox.MIN_BACKOFF)
+
+    def test_conflict_counts_as_written(self):
+        connector = FakeConnector('conflict')
+        outbox = self.open(connector)
+        outbox.post({'_id': 'daily-1', 'beverage': 1})
+        self.wait_until_sent(outbox)
+        self.assertEqual(len(connector.batches), 1)
+        self.assertEqual(self.stored(), [])
+
+    def test_backlog_is_sent_in_bounded_batches(self):
+        with open(self.path, 'w') as f:
+            for index in range(CloudantOutbox.BATCH_SIZE * 2 + 1):
+                f.write(json.dumps({'_id': str(index), 'beverage': 1}) + '\n')
+
+        connector = FakeConnector(201)
+        outbox = self.open(connector)
+        self.wait_until_sent(outbox)
+        self.assertEqual([len(batch) for batch in connector.batches], [CloudantOutbox.BATCH_SIZE] * 2 + [1])
+        self.assertEqual([document['_id'] for batch in connector.batches for document in batch],
+                         [str(index) for index in range(CloudantOutbox.BATCH_SIZE * 2 + 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+import json
+import os
+import Queue
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from web_broker import LocalBroker
+from web_partition import OVERFLOWED, UNROUTED, PartitionEvent, PartitionedMonitor
+
+
+MONITOR_CONFIG = os.path.join(ROOT, 'config', 'data', 'monitor.cfg')
+IOT_CONFIG = os.path.join(ROOT, 'config', 'bluemix', 'app.cfg')
+
+VENUES = """
+[venue downtown]
+monitor_config=%(monitor_config)s
+data_dir=%(data_dir)s/downtown
+device_prefix=dispenser
+status_device=status
+
+[venue uptown]
+monitor_config=%(monitor_config)s
+data_dir=%(data_dir)s/uptown
+device_prefix=uptown-dispenser
+status_device=uptown-status
+"""
+
+
+def write_venues(data_dir):
+    path = os.path.join(data_dir, 'venues.cfg')
+    with open(path, 'w') as f:
+        f.write(VENUES % {'monitor_config': MONITOR_CONFIG, 'data_dir': data_dir})
+    return path
+
+
+class RoutingMonitor(PartitionedMonitor):
+    """The routing half of a PartitionedMonitor, with queues for partitions."""
+
+    def __init__(self, venues_config, size):
+        self.venues = []
+        self.options = {}
+        self.devices = {}
+        self.configure_venues(venues_config)
+        self.partitions = dict((venue, (None, Queue.Queue(size))) for venue in self.venues)
+
+    def routed(self, venue):
+        queue = self.partitions[venue][1]
+        events = []
+        while not queue.empty():
+            events.append(queue.get()[4])
+        return events
+
+
+class RoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.monitor = RoutingMonitor(write_venues(self.data_dir), 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_owner_by_status_device_or_prefix(self):
+        self.assertEqual(self.monitor.owner('status'), 'downtown')
+        self.assertEqual(self.monitor.owner('uptown-status'), 'uptown')
+        self.assertEqual(self.monitor.owner('dispenser3'), 'downtown')
+        self.assertEqual(self.monitor.owner('uptown-dispenser12'), 'uptown')
+
+        # a prefix only matches when a beverage number follows it
+        self.assertIsNone(self.monitor.owner('dispenser'))
+        self.assertIsNone(self.monitor.owner('dispenser-x'))
+        self.assertIsNone(self.monitor.owner('midtown-dispenser1'))
+
+    def test_events_are_routed_to_their_venue(self):
+        unrouted = UNROUTED.values.get((), 0)
+        for device in ('dispenser1', 'uptown-dispenser1', 'status', 'midtown-status'):
+            self.monitor.route(PartitionEvent('online', '{}', 'json', device))
+
+        self.assertEqual(self.monitor.routed('downtown'), ['dispenser1', 'status'])
+        self.assertEqual(self.monitor.routed('uptown'), ['uptown-dispenser1'])
+        self.assertEqual(UNROUTED.values.get((), 0), unrouted + 1)
+
+    def test_full_partition_drops_and_counts(self):
+        dropped = OVERFLOWED.values.get(('uptown',), 0)
+        for number in range(5):
+            self.monitor.route(PartitionEvent('dispensed', '{}', 'json', 'uptown-dispenser' + str(number)))
+        self.monitor.route(PartitionEvent('dispensed', '{}', 'json', 'dispenser1'))
+
+        self.assertEqual(self.monitor.routed('uptown'), ['uptown-dispenser0', 'uptown-dispenser1'])
+        self.assertEqual(self.monitor.routed('downtown'), ['dispenser1'])
+        self.assertEqual(OVERFLOWED.values.get(('uptown',), 0), dropped + 3)
+
+
+class PartitionedMonitorTest(unittest.TestCase):
+    # seconds allowed for the partitions to start and apply an event
+    TIMEOUT = 20.0
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.monitor = PartitionedMonitor(write_venues(self.data_dir), IOT_CONFIG, client=LocalBroker())
+
+        # events reach a partition's monitor once it has subscribed
+        deadline = time.time() + PartitionedMonitorTest.TIMEOUT
+        while self.monitor.get_health()['status'] == 'starting':
+            self.assertLess(time.time(), deadline, 'partitions never started')
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.monitor.disconnect()
+        shutil.rmtree(self.data_dir)
+
+    def storage(self, venue):
+        return [beverage['storage'] for beverage in self.monitor.partition(venue).get_all_beverages()]
+
+    def test_event_changes_only_its_venue(self):
+        downtown, uptown = self.storage('downtown'), self.storage('uptown')
+        payload = json.dumps({'beverage': 1, 'amount': 0.5})
+        self.monitor.route(PartitionEvent('dispensed', payload, 'json', 'uptown-dispenser2'))
+
+        deadline = time.time() + PartitionedMonitorTest.TIMEOUT
+        while self.storage('uptown') == uptown:
+            self.assertLess(time.time(), deadline, 'uptown never applied the event')
+            time.sleep(0.05)
+        self.assertEqual(self.storage('downtown'), downtown)
+
+
+if __name__ == '__main__':
+    unittest.main()
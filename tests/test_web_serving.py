@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+import multiprocessing
+import os
+import sys
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from web_serving import ServingPool, SharedSnapshots, snapshot_key
+
+
+class FakePartition:
+    def __init__(self):
+        self.feed = FakeFeed()
+        self.release = threading.Event()
+
+    def get_snapshot(self, name):
+        return ('"1"', '[]', '')
+
+    def get_all_beverages(self):
+        return []
+
+    def wait(self):
+        self.release.wait()
+        return 'released'
+
+    def ping(self):
+        return 'pong'
+
+
+class FakeFeed:
+    def __init__(self):
+        self.observers = []
+
+
+class FakeMonitor:
+    def __init__(self, venues):
+        self.venues = venues
+        self.partitions = dict((venue, FakePartition()) for venue in venues)
+
+    def partition(self, venue):
+        return self.partitions[venue]
+
+    def add_state_observer(self, observer):
+        pass
+
+    def get_health(self):
+        return 'ok'
+
+
+class SharedSnapshotsTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshots = SharedSnapshots(slots=2, slot_size=4096)
+
+    def test_round_trip(self):
+        key = snapshot_key(u'Downtown', 'beverage')
+        self.assertTrue(self.snapshots.write(key, '"1"', '[]', 'gz'))
+        self.assertTrue(self.snapshots.write(key, '"2"', '[{}]', 'gzip'))
+        self.assertEqual(self.snapshots.read(key), ('"2"', '[{}]', 'gzip'))
+
+        # a worker finds the slot from the key stored in shared memory
+        self.snapshots.index = {}
+        self.assertEqual(self.snapshots.read(key), ('"2"', '[{}]', 'gzip'))
+        self.assertIsNone(self.snapshots.read(snapshot_key(None, 'system')))
+
+    def test_oversized_or_extra_snapshots_are_missing(self):
+        self.assertFalse(self.snapshots.write('/beverage', '"1"', 'x' * 4096, ''))
+        self.assertIsNone(self.snapshots.read('/beverage'))
+
+        self.assertTrue(self.snapshots.write('/system', '"1"', '{}', ''))
+        self.assertFalse(self.snapshots.write('/other', '"1"', '{}', ''))
+
+    def test_data_stored_out_of_order_is_not_returned(self):
+        self.snapshots.write('/beverage', '"1"', '[1, 2, 3]', '')
+
+        # the body changed under an even sequence, as a reordered store would
+        start = SharedSnapshots.HEADER.size + len('"1"')
+        self.snapshots.map[start:start + 1] = '{'
+        self.assertIsNone(self.snapshots.read('/beverage'))
+
+        self.snapshots.write('/beverage', '"2"', '[1, 2, 3]', '')
+        self.assertEqual(self.snapshots.read('/beverage'), ('"2"', '[1, 2, 3]', ''))
+
+
+class ServingPoolTest(unittest.TestCase):
+    # seconds a reply may take once nothing holds it up
+    TIMEOUT = 5.0
+
+    def setUp(self):
+        # no workers are forked, the test stands in for worker 0
+        self.pool = ServingPool(0, '127.0.0.1', 0)
+        self.pool.replies.append(multiprocessing.Queue())
+        self.monitor = self.pool.start(lambda: FakeMonitor(['slow', 'fast']))
+
+    def tearDown(self):
+        self.monitor.partition('slow').release.set()
+        self.pool.stopped.set()
+        self.pool.socket.close()
+
+    def replies(self, count):
+        replies = {}
+        while len(replies) < count:
+            message = self.pool.replies[0].get(timeout=ServingPoolTest.TIMEOUT)
+            if message[0] == 'reply':
+                replies[message[1]] = message[3]
+        return replies
+
+    def test_slow_venue_does_not_hold_up_the_others(self):
+        # more stalled calls than the owner has threads in all
+        stalled = 4 * (ServingPool.LANE_THREADS * 3)
+        for request in range(stalled):
+            self.pool.requests.put(('venue', 0, request, 'slow', 'wait', ()))
+        self.pool.requests.put(('venue', 0, 'fast', 'fast', 'ping', ()))
+        self.pool.requests.put(('monitor', 0, 'health', None, 'get_health', ()))
+        self.assertEqual(self.replies(2), {'fast': 'pong', 'health': 'ok'})
+
+        self.monitor.partition('slow').release.set()
+        self.assertEqual(self.replies(stalled), dict((request, 'released') for request in range(stalled)))
+
+    def test_exited_worker_gets_no_more_messages(self):
+        replies = self.pool.replies[0]
+        # the worker exits once it has the venues sent at startup
+        while replies.get(timeout=ServingPoolTest.TIMEOUT)[0] != 'venues':
+            pass
+        self.pool.replies.append(multiprocessing.Queue())
+        self.pool.retire(0)
+        self.assertIsNone(self.pool.replies[0])
+
+        self.pool.requests.put(('venue', 0, 'lost', 'fast', 'ping', ()))
+        self.pool.requests.put(('venue', 1, 'kept', 'fast', 'ping', ()))
+        self.pool.mirror('fast', 0, {'name': 'Stout'})
+        received = []
+        while len(received) < 2:
+            message = self.pool.replies[1].get(timeout=ServingPoolTest.TIMEOUT)
+            if message[0] in ('reply', 'feed'):
+                received.append(message[:2])
+        self.assertEqual(sorted(received), [('feed', 'fast'), ('reply', 'kept')])
+        self.assertTrue(replies.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from web_app import MonitorApplication
+from web_broker import LocalBroker
+from web_store import StateStore
+
+
+MONITOR_CONFIG = os.path.join(ROOT, 'config', 'data', 'monitor.cfg')
+IOT_CONFIG = os.path.join(ROOT, 'config', 'bluemix', 'app.cfg')
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.data_dir, 'current.cfg')
+        self.journal_path = os.path.join(self.data_dir, 'current.journal')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.data_dir)
+
+    def crashed_store(self):
+        # timers that never fire, as if the power went before the snapshot
+        store = StateStore(self.snapshot_path, self.journal_path, snapshot_delay=3600, sync_delay=3600)
+        store.load(MONITOR_CONFIG)
+        self.stores.append(store)
+        return store
+
+    def reopened(self):
+        store = StateStore(self.snapshot_path, self.journal_path)
+        self.stores.append(store)
+        return store
+
+    def test_journal_replay_restores_changes(self):
+        store = self.crashed_store()
+        store.record('beverage1', {'storage': 90.5, 'daily_total': 2.25})
+        store.record('beverage1', {'storage': 88.0})
+        store.record('beverage2', {'last_order': None, 'name': 'Stout'})
+        store.sync()
+        self.assertFalse(os.path.exists(self.snapshot_path))
+
+        parser = self.reopened().load(MONITOR_CONFIG)
+        self.assertEqual(parser.get('beverage1', 'storage'), '88.0')
+        self.assertEqual(parser.get('beverage1', 'daily_total'), '2.25')
+        self.assertEqual(parser.get('beverage2', 'name'), 'Stout')
+        self.assertFalse(parser.has_option('beverage2', 'last_order'))
+
+    def test_torn_journal_line_is_ignored(self):
+        store = self.crashed_store()
+        store.record('beverage1', {'storage': 90.5})
+        store.sync()
+        with open(self.journal_path, 'a') as f:
+            f.write('{"section": "beverage1", "values": {"stor')
+
+        parser = self.reopened().load(MONITOR_CONFIG)
+        self.assertEqual(parser.get('beverage1', 'storage'), '90.5')
+
+    def test_snapshot_folds_journal(self):
+        store = self.crashed_store()
+        store.record('beverage1', {'storage': 90.5})
+        store.close()
+        self.assertFalse(os.path.exists(self.journal_path))
+
+        parser = self.reopened().load(self.snapshot_path)
+        self.assertEqual(parser.get('beverage1', 'storage'), '90.5')
+
+    def test_unchanged_values_are_not_journaled(self):
+        store = self.crashed_store()
+        store.record('beverage1', {'storage': 100.0, 'name': 'Blue Moon'})
+        self.assertFalse(os.path.exists(self.journal_path))
+
+
+class MonitorRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.crash_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+        shutil.rmtree(self.crash_dir)
+
+    def test_restart_from_journal_restores_state(self):
+        app = MonitorApplication(MONITOR_CONFIG, IOT_CONFIG, client=LocalBroker(), data_dir=self.data_dir)
+        app.apply_event('dispensed', {'beverage': 0, 'amount': 1.5})
+        app.apply_event('dispensed', {'beverage': 0, 'amount': 0.25})
+
+        # the journal as a power cut leaves it, before any snapshot
+        app.pipeline.stop()
+        app.store.sync()
+        journal = os.path.basename(MonitorApplication.UPDATE_JOURNAL_PATH)
+        shutil.copy(os.path.join(self.data_dir, journal), self.crash_dir)
+        expected = app.engine.state.beverages[0]
+        app.disconnect()
+
+        restarted = MonitorApplication(MONITOR_CONFIG, IOT_CONFIG, client=LocalBroker(), data_dir=self.crash_dir)
+        try:
+            beverage = restarted.engine.state.beverages[0]
+            self.assertEqual(beverage.daily_total, 1.75)
+            self.assertEqual(beverage.daily_total, expected.daily_total)
+            self.assertEqual(beverage.storage, expected.storage)
+            self.assertEqual(beverage.tap, expected.tap)
+        finally:
+            restarted.disconnect()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from transport import Transport
+from web_app import MonitorApplication
+from web_broker import LocalBroker
+
+import wire
+
+
+MONITOR_CONFIG = os.path.join(ROOT, 'config', 'data', 'monitor.cfg')
+IOT_CONFIG = os.path.join(ROOT, 'config', 'bluemix', 'app.cfg')
+
+
+class WireFormatTest(unittest.TestCase):
+    def round_trip(self, name, data):
+        payload = wire.pack(name, data)
+        self.assertEqual(wire.unpack(payload), (name, data))
+        return payload
+
+    def test_device_events_round_trip(self):
+        self.round_trip('dispensed', {'beverage': 2, 'amount': 0.125, 'epoch': 2 ** 63 - 1, 'seq': 7, 'time': 1792337632123})
+        self.round_trip('pouring', {'beverage': 0, 'state': True, 'epoch': 1, 'seq': 7, 'time': 1792337632123})
+        self.round_trip('online', {'beverage': 65535, 'state': False, 'epoch': 1, 'seq': 8, 'time': 1792337632124})
+        self.round_trip('refill', {'beverage': 1, 'epoch': 1, 'seq': 2 ** 64 - 1, 'time': 1792337632125})
+
+    def test_events_without_sequence_round_trip(self):
+        self.round_trip('dispensed', {'beverage': 1, 'amount': 0.5})
+        self.round_trip('dispensed', {'beverage': 1, 'amount': 0.5, 'time': 1792337632123})
+        self.round_trip('pouring', {'beverage': 1, 'state': False})
+        self.round_trip('refill', {'beverage': 1})
+
+    def test_info_is_reduced_to_masks(self):
+        beverages = [{'name': 'Beverage ' + str(index), 'storage': 10.0, 'online': index % 3 == 0, 'pouring': index % 4 == 1}
+                     for index in range(11)]
+        payload = wire.pack('info', {'beverages': beverages})
+        self.assertEqual(len(payload), wire.HEADER.size + wire.BEVERAGE.size + 2 * 2)
+
+        name, data = wire.unpack(payload)
+        self.assertEqual(name, 'info')
+        self.assertEqual(data['beverages'], [{'online': beverage['online'], 'pouring': beverage['pouring']}
+                                             for beverage in beverages])
+
+    def test_unknown_version_or_code_is_rejected(self):
+        payload = wire.pack('refill', {'beverage': 1})
+        self.assertRaises(ValueError, wire.unpack, chr(wire.VERSION + 1) + payload[1:])
+        self.assertRaises(ValueError, wire.unpack, payload[:1] + chr(200) + payload[2:])
+
+
+class TransportNegotiationTest(unittest.TestCase):
+    TARGET = ('RaspberryPi', 'bev1')
+
+    def setUp(self):
+        self.client = LocalBroker()
+        self.transport = Transport(self.client)
+
+    def test_only_negotiated_targets_get_compact_messages(self):
+        self.transport.command('RaspberryPi', 'bev1', 'info', {'beverages': []})
+        self.transport.negotiate(TransportNegotiationTest.TARGET, wire.VERSION)
+        self.transport.command('RaspberryPi', 'bev1', 'info', {'beverages': []})
+        self.transport.command('RaspberryPi', 'bev2', 'info', {'beverages': []})
+        self.transport.command('RaspberryPi', 'bev1', 'connect', {'beverage': 0})
+        self.transport.negotiate(TransportNegotiationTest.TARGET, 0)
+        self.transport.command('RaspberryPi', 'bev1', 'info', {'beverages': []})
+
+        formats = [(message.deviceId, message.command, message.format) for message in self.client.commands]
+        self.assertEqual(formats, [('bev1', 'info', 'json'), ('bev1', 'info', wire.FORMAT), ('bev2', 'info', 'json'),
+                                   ('bev1', 'connect', 'json'), ('bev1', 'info', 'json')])
+
+
+class MonitorNegotiationTest(unittest.TestCase):
+    # seconds allowed for the broker subscription to come up
+    START_TIMEOUT = 10.0
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.client = LocalBroker()
+        self.app = MonitorApplication(MONITOR_CONFIG, IOT_CONFIG, client=self.client, data_dir=self.data_dir)
+        deadline = time.time() + MonitorNegotiationTest.START_TIMEOUT
+        while not self.app.health.ready('iot'):
+            self.assertLess(time.time(), deadline, 'iot never became ready')
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.app.disconnect()
+        shutil.rmtree(self.data_dir)
+
+    def wire_commands(self):
+        self.app.pipeline.stop()
+        return [(message.deviceId, message.data) for message in self.client.commands if message.command == 'wire']
+
+    def test_matching_version_is_agreed(self):
+        self.app.handle_event('online', {'beverage': 1, 'state': True, 'wire': wire.VERSION}, 'bev2')
+        self.assertEqual(self.wire_commands(), [('bev2', {'version': wire.VERSION})])
+        self.assertEqual(self.app.transport.versions, {('RaspberryPi', 'bev2'): wire.VERSION})
+
+    def test_unknown_version_falls_back_to_json(self):
+        self.app.transport.negotiate(('RaspberryPi', 'status'), wire.VERSION)
+        self.app.handle_event('startup', {'wire': wire.VERSION + 1}, 'status')
+        self.assertEqual(self.wire_commands(), [('status', {'version': 0})])
+        self.assertEqual(self.app.transport.versions, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+import functools
+import Queue
+import threading
+import time
+import wire
+
+
+AT_MOST_ONCE = 0
+AT_LEAST_ONCE = 1
+
+# delivery of each message class; amounts that change inventory or bill a
+# pour must arrive, a missed pouring toggle or log line is superseded soon
+MESSAGE_QOS = {
+    'dispensed': AT_LEAST_ONCE,
+    'refill': AT_LEAST_ONCE,
+    'order': AT_LEAST_ONCE,
+    'online': AT_LEAST_ONCE,
+    'startup': AT_LEAST_ONCE,
+    'connect': AT_LEAST_ONCE,
+    'disconnect': AT_LEAST_ONCE,
+    'info': AT_LEAST_ONCE,
+    'trace': AT_LEAST_ONCE,
+    'pouring': AT_MOST_ONCE,
+    'log': AT_MOST_ONCE,
+    'stats': AT_MOST_ONCE,
+    'batch': AT_MOST_ONCE
+}
+
+# low priority telemetry, sent together in one 'batch' event per window
+BATCHED = frozenset(['stats'])
+
+
+def qos(name):
+    return MESSAGE_QOS.get(name, AT_MOST_ONCE)
+
+
+def persistent_session(options):
+    """
+    Asks the broker to keep the client's session across reconnects, so
+    QoS 1 messages sent while it was away are delivered when it returns.
+    """
+
+    options['clean-session'] = 'false'
+    return options
+
+
+def unbatch(data):
+    """The (event, data) pairs carried by a 'batch' event."""
+
+    return [(message['event'], message['data']) for message in data['messages']]
+
+
+class Transport:
+    """
+    Publishes events and commands through an ibmiotf device, gateway or
+    application client with the QoS of their message class. Messages of
+    BATCHED classes are held for up to batch_window seconds and sent as
+    a single 'batch' event per target. Messages with a compact layout
+    go out in the wire format to targets that negotiated a version, and
+    as json to everyone else. Given an EventSpool, a device's QoS 1
+    events are stored with sequence numbers and sent from it in order by
+    a forwarding thread, which sends them again from the oldest one the
+    broker has not acknowledged after a failed publish or ACK_TIMEOUT.
+    A device's QoS 0 messages are queued for a sender thread, so the
+    caller never waits on the network; they are dropped and counted in
+    unsent while the queue is full or the client is disconnected.
+    """
+
+    BATCH_WINDOW = 1.0
+
+    # messages in one batch before it is sent without waiting
+    BATCH_SIZE = 50
+
+    # seconds to wait for the broker to acknowledge a spooled event
+    ACK_TIMEOUT = 30.0
+
+    # seconds between attempts to send while the broker is unreachable
+    RETRY_WAIT = 1.0
+
+    # QoS 0 messages waiting for the sender thread
+    OUTGOING_SIZE = 64
+
+    def __init__(self, client, batch_window=BATCH_WINDOW, batched=BATCHED, spool=None):
+        self.client = client
+        self.batch_window = batch_window
+        self.batched = batched
+        self.spool = spool
+
+        # wire version agreed with each target, () for the device itself
+        self.versions = {}
+
+        self.pending = {}
+        self.timer = None
+        self.lock = threading.Lock()
+
+        self.outgoing = Queue.Queue(Transport.OUTGOING_SIZE)
+        self.sender = None
+        self.unsent = 0
+
+        if spool is not None:
+            self.forwarder = threading.Thread(target=self.forward, name='spool-forwarder')
+            self.forwarder.daemon = True
+            self.forwarder.start()
+
+    def event(self, name, data, deviceType=None, deviceId=None):
+        """Publishes an event, from a device when no deviceType is given."""
+
+        if deviceType is None:
+            target = ()
+        else:
+            target = (deviceType, deviceId)
+
+        if self.spool is not None and target == () and qos(name) >= AT_LEAST_ONCE:
+            self.spool.append(name, data)
+        elif name in self.batched and self.batch_window > 0:
+            self.hold(target, name, data)
+        else:
+            self.deliver(target, name, data)
+
+    def command(self, deviceType, deviceId, name, data):
+        format, data = self.encode((deviceType, deviceId), name, data)
+        return self.client.publishCommand(deviceType, deviceId, name, format, data, qos=qos(name))
+
+    def deliver(self, target, name, data):
+        if target == () and qos(name) == AT_MOST_ONCE:
+            self.post(name, data)
+        else:
+            self.send(target, name, data)
+
+    def post(self, name, data):
+        with self.lock:
+            if self.sender is None:
+                self.sender = threading.Thread(target=self.drain, name='transport-sender')
+                self.sender.daemon = True
+                self.sender.start()
+        try:
+            self.outgoing.put_nowait((name, data))
+        except Queue.Full:
+            self.unsent += 1
+
+    def drain(self):
+        while True:
+            name, data = self.outgoing.get()
+            if not self.connected():
+                # a stale toggle is worth less than the wait on a dead link
+                self.unsent += 1
+                continue
+            try:
+                self.send((), name, data)
+            except Exception as e:
+                print 'Failed to send ' + name + ': ' + str(e)
+                self.unsent += 1
+
+    def connected(self):
+        connectEvent = getattr(self.client, 'connectEvent', None)
+        return connectEvent is None or connectEvent.is_set()
+
+    def send(self, target, name, data, **kwargs):
+        format, data = self.encode(target, name, data)
+        args = target + (name, format, data)
+        return self.client.publishEvent(*args, qos=qos(name), **kwargs)
+
+    def forward(self):
+        while True:
+            record = self.spool.take(Transport.RETRY_WAIT)
+            self.spool.sync()
+            if record is None:
+                if self.spool.stalled(Transport.ACK_TIMEOUT):
+                    self.spool.rewind()
+                continue
+
+            seq, name, data = record
+            try:
+                sent = self.send((), name, data, on_publish=functools.partial(self.spool.ack, seq))
+            except Exception as e:
+                print 'Failed to send ' + name + ': ' + str(e)
+                sent = False
+            if not sent:
+                # everything after the failed event goes again, in order
+                self.spool.rewind()
+                time.sleep(Transport.RETRY_WAIT)
+
+    def negotiate(self, target, version):
+        """Sends compact messages to target from now on, or json for version 0."""
+
+        if version:
+            self.versions[target] = version
+        else:
+            self.versions.pop(target, None)
+
+    def encode(self, target, name, data):
+        if wire.compact(name) and self.versions.get(target) == wire.VERSION:
+            return wire.FORMAT, wire.pack(name, data)
+        return 'json', data
+
+    def hold(self, target, name, data):
+        with self.lock:
+            messages = self.pending.setdefault(target, [])
+            messages.append({'event': name, 'data': data})
+            full = len(messages) >= Transport.BATCH_SIZE
+            if full:
+                del self.pending[target]
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if full:
+            self.deliver(target, 'batch', {'messages': messages})
+
+    def flush(self):
+        """Sends every held batch now."""
+
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        for target, messages in pending.items():
+            self.deliver(target, 'batch', {'messages': messages})
+
+        if self.spool is not None:
+            self.spool.sync(True)
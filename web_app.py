@@ -1,14 +1,31 @@
 #!/usr/bin/python
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from transport import Transport, persistent_session, qos, unbatch
+from web_feed import BeverageFeed
+from web_engine import StateEngine, serialized
+from web_forecast import ConsumptionForecaster
+from web_health import Health
+from web_history import DispenseHistory
+from web_jobs import JobEngine
+from web_metrics import registry
+from web_outbox import CloudantOutbox
+from web_pipeline import EventPipeline
+from web_store import StateStore
 
-import ConfigParser
+import collections
+import functools
+import gzip
 import ibmiotf.application
 import json
+import numpy
 import os
 import requests
+import requests.adapters
+import StringIO
+import threading
 import time
+import wire
 
 
 class MonitorApplication:
@@ -18,24 +35,86 @@ class MonitorApplication:
     DEFAULT_DAYS_TO_ORDER = 1
     
     UPDATE_CONFIG_PATH = 'config/data/current.cfg'
+    UPDATE_JOURNAL_PATH = 'config/data/current.journal'
+    HISTORY_PATH = 'config/data/history.db'
+    OUTBOX_PATH = 'config/data/outbox.jsonl'
+    FORECAST_PATH = 'config/data/forecast.npz'
+    JOBS_PATH = 'config/data/jobs.db'
     
-    def __init__(self, monitor_config, iot_config):
+    # days of usage served per beverage
+    WEEK_DAYS = 7
+    
+    # beverages reset per state change in the nightly analysis
+    ANALYSIS_BATCH = 16
+    
+    DEVICE_PREFIX = 'bev'
+    STATUS_DEVICE = 'status'
+    
+    # 'batch' carries several low priority events from one device
+    DEVICE_EVENTS = ('dispensed', 'refill', 'online', 'pouring', 'startup', 'stats', 'batch')
+    
+    def __init__(self, monitor_config, iot_config, client=None, venue=None, data_dir=None,
+                 device_prefix=DEVICE_PREFIX, status_device=STATUS_DEVICE):
         self.iot_config = iot_config
         self.monitor_config = monitor_config
         
+        # a venue partition keeps its data files in its own directory and
+        # addresses its own dispenser and status devices
+        self.venue = venue
+        self.device_prefix = device_prefix
+        self.status_device = status_device
+        self.update_config_path = self.data_path(MonitorApplication.UPDATE_CONFIG_PATH, data_dir)
+        self.history_path = self.data_path(MonitorApplication.HISTORY_PATH, data_dir)
+        self.outbox_path = self.data_path(MonitorApplication.OUTBOX_PATH, data_dir)
+        self.forecast_path = self.data_path(MonitorApplication.FORECAST_PATH, data_dir)
+        self.jobs_path = self.data_path(MonitorApplication.JOBS_PATH, data_dir)
+        self.store = StateStore(self.update_config_path, self.data_path(MonitorApplication.UPDATE_JOURNAL_PATH, data_dir))
+        
+        # an injected client is already connected, e.g. a partition's link
+        # to the process that owns the broker connection
+        self.client = client
+        self.transport = None
+        
+        # encoded api responses, rebuilt only when the state version moves
+        self.snapshots = {}
+        
+        # latest sensor path summary sent by each dispenser
+        self.device_stats = {}
+        self.snapshot_epoch = int(time.time())
+        
         self.configure_monitor(monitor_config)
-        self.configure_iot(iot_config)
+        self.configure_engine()
+        self.configure_pipeline()
+        self.configure_feed()
+        self.configure_history()
         self.configure_cloudant()
-        self.configure_scheduler()
+        
+        # everything that may wait on the network comes up in the
+        # background, the state above is served as soon as it is loaded
+        self.health = Health()
+        self.health.start('iot', self.configure_iot, (iot_config,), check=self.check_iot)
+        self.health.start('cloudant', self.cloudant.check)
+        self.health.start('scheduler', self.configure_scheduler)
     
     def __exit__(self, exc_type, exc_value, traceback):
         self.disconnect()
     
-    def configure_monitor(self, config):
-        parser = ConfigParser.ConfigParser()
+    def data_path(self, path, data_dir):
+        if data_dir is None:
+            return path
+        return os.path.join(data_dir, os.path.basename(path))
+    
+    def partition(self, venue=None):
+        # a single application serves every venue it is asked for
+        return self
+    
+    def add_state_observer(self, observer):
+        """Calls observer(venue) whenever a new state is visible to readers."""
         
-        with open(config) as f:
-            parser.readfp(f)
+        self.engine.observers.append(lambda state: observer(self.venue))
+    
+    def configure_monitor(self, config):
+        parser = self.store.load(config)
         
         tap_size = parser.get('monitor', 'tap_size')
         order_amount = parser.get('monitor', 'order_amount')
@@ -53,6 +132,13 @@ class MonitorApplication:
         
         self.monitor = Monitor(float(tap_size), float(order_amount), float(max_storage), float(days_to_order))
         
+        # spool epoch and last sequence applied from each device
+        self.sequences = {}
+        if parser.has_section('sequences'):
+            for device, value in parser.items('sequences'):
+                epoch, seq = value.split(':') if ':' in value else (0, value)
+                self.sequences[device] = (int(epoch), int(seq))
+        
         while parser.has_section('beverage' + str(len(self.monitor.beverages) + 1)):
             section = 'beverage' + str(len(self.monitor.beverages) + 1)
             
@@ -79,66 +165,155 @@ class MonitorApplication:
             if auto_update is None or len(auto_update) == 0:
                 auto_update = False
                 
-            self.monitor.add_beverage(Beverage(name, float(tap), float(storage), float(total_dispensed), int(days_dispensed), long(last_order), auto_update == 'True'))
+            beverage = Beverage(name, float(tap), float(storage), float(total_dispensed), int(days_dispensed), long(last_order), auto_update == 'True')
+            if parser.has_option(section, 'daily_total'):
+                beverage.daily_total = float(parser.get(section, 'daily_total'))
+            self.monitor.add_beverage(beverage)
+        
+        # forecasts start from the lifetime averages until a saved one is found
+        self.monitor.forecast.load(self.forecast_path, self.monitor.count)
     
-    def configure_iot(self, config):
-        options = ibmiotf.application.ParseConfigFile(config)
-        self.client = ibmiotf.application.Client(options)
+    def configure_engine(self):
+        # all changes to the monitor are applied by the engine's writer thread
+        self.engine = StateEngine(self.monitor.snapshot, lambda: self.monitor.version)
+    
+    def configure_pipeline(self):
+        self.pipeline = EventPipeline(self.process_event)
         
-        self.client.connect()
+        registry.sampled('monitor_events_received_total', 'counter', 'Device events received from the broker.',
+                         lambda: self.pipeline.received)
+        registry.sampled('monitor_events_dropped_total', 'counter', 'Device events dropped on a full pipeline.',
+                         lambda: self.pipeline.dropped)
+        registry.sampled('monitor_events_failed_total', 'counter', 'Device events whose processing raised.',
+                         lambda: self.pipeline.failed)
+        registry.sampled('monitor_ingest_queue_depth', 'gauge', 'Device events waiting to be processed.',
+                         lambda: self.pipeline.ingest_queue.qsize())
+        registry.sampled('monitor_lane_queue_depth', 'gauge', 'Publishes and writes waiting on each pipeline lane.',
+                         lambda: [((str(number),), lane.qsize()) for number, lane in enumerate(self.pipeline.lanes)],
+                         ('lane',))
+        for name, help in DEVICE_STATS:
+            registry.sampled('dispenser_' + name, 'gauge', help, functools.partial(self.get_device_stat, name), ('beverage',))
+        registry.sampled('monitor_engine_queue_depth', 'gauge', 'Changes waiting for the state writer.',
+                         lambda: self.engine.commands.qsize())
+    
+    def configure_feed(self):
+        self.feed = BeverageFeed()
+        self.feed.reset(self.get_all_beverages())
+    
+    def configure_history(self):
+        self.history = DispenseHistory(self.history_path)
+    
+    def configure_iot(self, config):
+        if self.client is None:
+            # a persistent session keeps the QoS 1 device events sent while
+            # the monitor restarts
+            options = persistent_session(ibmiotf.application.ParseConfigFile(config))
+            client = wire.register(ibmiotf.application.Client(options))
+            
+            client.connect()
+            self.client = client
         
+        self.transport = Transport(self.client)
         self.client.deviceEventCallback = self.event_callback
         
-        self.client.subscribeToDeviceEvents(event='dispensed')
-        self.client.subscribeToDeviceEvents(event='refill')
-        self.client.subscribeToDeviceEvents(event='online')
-        self.client.subscribeToDeviceEvents(event='pouring')
-        self.client.subscribeToDeviceEvents(event='startup')
+        for event in MonitorApplication.DEVICE_EVENTS:
+            self.client.subscribeToDeviceEvents(event=event, qos=qos(event))
+    
+    def check_iot(self):
+        # the client reconnects by itself after its first connection
+        connected = getattr(self.client, 'connectEvent', None)
+        if connected is not None and not connected.is_set():
+            return 'reconnecting to the broker'
+        return None
     
     def configure_cloudant(self):
         self.cloudant = CloudantConnector('beverage_dispense')
+        self.outbox = CloudantOutbox(self.cloudant, self.outbox_path)
+        registry.sampled('monitor_outbox_pending', 'gauge', 'Documents waiting to be written to Cloudant.',
+                         lambda: len(self.outbox.pending))
     
     def configure_scheduler(self):
-        self.sched = BackgroundScheduler()
-        next_date = datetime.now() + timedelta(days=1)
-        run_time = datetime(next_date.year, next_date.month, next_date.day, 0, 0, 0, 0)
-        self.sched.add_job(self.update_event, 'date', run_date=run_time)
-        self.sched.start()
+        self.jobs = JobEngine(self.jobs_path)
+        self.jobs.add_daily('nightly-analysis', self.update_event)
+        self.jobs.add_hourly('forecast', self.update_forecast)
     
     def update_event(self):
-        for index in range(len(self.monitor.beverages)):
-            beverage = self.monitor.get_beverage(index)
-            if beverage.auto_update:
-                self.update_beverage_analysis(index)
-        self.sched.shutdown(wait=False)
-        self.configure_scheduler()
-            
+        indexes = [index for index, beverage in enumerate(self.engine.state.beverages) if beverage.auto_update]
+        batches = [indexes[start:start + MonitorApplication.ANALYSIS_BATCH]
+                   for start in range(0, len(indexes), MonitorApplication.ANALYSIS_BATCH)]
+        
+        # each batch is one short state change on the writer thread, so
+        # live events interleave with the analysis, and the batches'
+        # publishes and config writes go out on their pipeline lanes
+        for batch in batches:
+            self.analyze_beverages(batch)
+        
+        self.update_forecast()
     
     def event_callback(self, command):
-        if command.event == 'startup':
+        # runs on the mqtt network thread, so only queue the raw message
+        self.pipeline.ingest(command.event, command.payload, command.format, command.deviceId)
+    
+    def process_event(self, event, payload, format='json', device=None):
+        if format == wire.FORMAT:
+            event, data = wire.unpack(payload)
+            self.handle_event(event, data, device)
+        elif event == 'batch':
+            for inner, data in unbatch(json.loads(payload)):
+                self.handle_event(inner, data, device)
+        else:
+            self.handle_event(event, json.loads(payload or '{}'), device)
+    
+    def handle_event(self, event, data, device=None):
+        with EVENT_SECONDS.time((event,)):
+            if self.replayed(device, data):
+                DUPLICATE_EVENTS.inc((event,))
+                return
+            
+            if 'wire' in data:
+                self.negotiate(event, data)
+            
+            if event == 'stats':
+                # diagnostics only, the monitor state is untouched
+                self.device_stats[int(data['beverage'])] = data
+            else:
+                self.apply_event(event, data, device)
+    
+    @serialized
+    def apply_event(self, event, data, device=None):
+        if event == 'startup':
             data = {'beverages': self.get_all_beverages()}
-            self.send_command('status', 'info', data)
+            self.send_command(self.status_device, 'info', data)
         else:
-            data = json.loads(command.payload)
             index = int(data['beverage'])
             
-            if command.event == 'dispensed':
+            if event == 'dispensed':
                 dispensed_amount = float(data['amount'])
-                self.monitor.dispense_beverage(index, dispensed_amount)
+                # a spooled pour counts in the hour it was poured, not the
+                # hour it was replayed, unless the device clock is ahead
+                now = int(time.time() * 1000)
+                timestamp = min(int(data.get('time', now)), now)
+                self.monitor.dispense_beverage(index, dispensed_amount, timestamp)
+                # the sqlite transaction runs on the beverage's lane
+                self.pipeline.emit(index, self.history.record, index, dispensed_amount, timestamp)
                 if self.monitor.order_status(index):
                     self.publish_order(index)
-            elif command.event == 'refill':
+            elif event == 'refill':
                 self.monitor.refill_beverage(index)
-            elif command.event == 'online':
+            elif event == 'online':
                 status = data['state']
                 self.monitor.toggle_online(index, status)
                 info = {'beverages': self.get_all_beverages()}
-                self.send_command('status', 'info', info)
-            elif command.event == 'pouring':
+                self.send_command(self.status_device, 'info', info)
+            elif event == 'pouring':
                 status = data['state']
                 self.monitor.toggle_pouring(index, status)
             
             self.publish_beverage(index)
+        
+        # only an event that was applied in full counts as seen
+        if 'seq' in data and device is not None:
+            self.applied(device, int(data.get('epoch', 0)), int(data['seq']))
 
     def publish_order(self, index):
         beverage = self.monitor.get_beverage(index)
@@ -147,60 +322,110 @@ class MonitorApplication:
     
     def publish_beverage(self, index):
         data = self.get_beverage_data(index)
+        self.feed.publish(index, data)
         self.publish(index, 'log', data)
         self.update_config(index)
     
     def publish(self, index, event, data):
         data['beverage'] = index
-        self.client.publishEvent('Webpage', 'web', event, 'json', data)
+        self.pipeline.emit(index, self.deliver, 'event', event, data, 'Webpage', 'web')
     
     def send_command(self, deviceId, command, data):
-        self.client.publishCommand('RaspberryPi', deviceId, command, 'json', data)
+        self.pipeline.emit(deviceId, self.deliver, 'command', 'RaspberryPi', deviceId, command, data)
+    
+    def replayed(self, device, data):
+        """
+        Whether a spooled device event was already applied. Devices send
+        their events in sequence order and replay them after a dropped
+        link, so anything at or below the last sequence seen is a repeat.
+        Sequences restart under a new epoch when a device's spool does,
+        so only events of the epoch last seen are compared.
+        """
+        
+        if 'seq' not in data or device is None:
+            return False
+        last = self.sequences.get(device.lower())
+        return last is not None and last[0] == int(data.get('epoch', 0)) and int(data['seq']) <= last[1]
+    
+    def applied(self, device, epoch, seq):
+        device = device.lower()
+        self.sequences[device] = (epoch, seq)
+        self.pipeline.emit(device, self.record_config, 'sequences', {device: '%d:%d' % (epoch, seq)})
+    
+    def negotiate(self, event, data):
+        """Agrees a wire version with a device announcing the ones it knows."""
+        
+        if event == 'startup':
+            device = self.status_device
+        else:
+            device = self.device_prefix + str(int(data['beverage']) + 1)
+        
+        version = wire.VERSION if int(data['wire']) == wire.VERSION else 0
+        self.transport.negotiate(('RaspberryPi', device), version)
+        self.send_command(device, 'wire', {'version': version})
+    
+    def deliver(self, kind, *args):
+        if self.transport is None:
+            UNDELIVERED.inc((kind,))
+            print 'Dropped ' + kind + ', not connected to the broker'
+            return
+        
+        with PUBLISH_SECONDS.time((kind,)):
+            getattr(self.transport, kind)(*args)
     
     def toggle_device_connection(self, index, command):
-        device = 'bev' + str(index + 1)
+        device = self.device_prefix + str(index + 1)
         data = {'beverage': index}
         self.send_command(device, command, data)
     
     def update_config(self, index):
         beverage = self.monitor.get_beverage(index)
-        parser = ConfigParser.ConfigParser()
-        
-        if os.path.exists(MonitorApplication.UPDATE_CONFIG_PATH):
-            with open(MonitorApplication.UPDATE_CONFIG_PATH) as f:
-                parser.readfp(f)
-            os.remove(MonitorApplication.UPDATE_CONFIG_PATH)
-        else:
-            with open(self.monitor_config) as f:
-                parser.readfp(f)
-        
-        config = open(MonitorApplication.UPDATE_CONFIG_PATH, 'w')
         
         section = 'beverage' + str(index + 1)
-        parser.set(section, 'name', beverage.name)
-        parser.set(section, 'tap', beverage.tap)
-        parser.set(section, 'storage', beverage.storage)
-        parser.set(section, 'total_dispensed', beverage.total_dispensed)
-        parser.set(section, 'days_dispensed', beverage.days_dispensed)
-        parser.set(section, 'auto_update', beverage.auto_update)
+        values = {
+            'name': beverage.name,
+            'tap': beverage.tap,
+            'storage': beverage.storage,
+            'total_dispensed': beverage.total_dispensed,
+            'days_dispensed': beverage.days_dispensed,
+            'daily_total': beverage.daily_total,
+            'auto_update': beverage.auto_update
+        }
         if beverage.last_order != 0:
-            parser.set(section, 'last_order', beverage.last_order)
+            values['last_order'] = beverage.last_order
+        
+        self.pipeline.emit(index, self.record_config, section, values)
+    
+    def update_system_config(self):
+        values = {
+            'tap_size': self.monitor.tap_size,
+            'order_amount': self.monitor.order_amount,
+            'max_storage': self.monitor.max_storage,
+            'days_to_order': self.monitor.days_to_order
+        }
         
-        parser.write(config)
-        config.close()
+        self.pipeline.emit('monitor', self.record_config, 'monitor', values)
     
-    def post_daily_total(self, index):
+    def record_config(self, section, values):
+        with CONFIG_WRITE_SECONDS.time():
+            self.store.record(section, values)
+    
+    def get_daily_total(self, index):
         beverage = self.monitor.get_beverage(index)
         data = {
             'beverage': index + 1,
             'date': int(time.time() * 1000),
             'amount_dispensed': beverage.daily_total
         }
-        self.cloudant.post_json(data)
+        if self.venue is not None:
+            data['venue'] = self.venue
+        return data
     
-    def get_weekly_totals(self, index):
-        beverage = self.monitor.get_beverage(index)
-        week_info = self.cloudant.get_data('by-bev' + str(index + 1), True, 7)
+    def get_weekly_totals(self, index, week_info=None):
+        beverage = self.engine.state.beverages[index]
+        
+        if week_info is None:
+            week_info = self.get_all_weeks([index])[0]
         
         data = {
             'total_dispensed': beverage.total_dispensed,
@@ -212,11 +437,68 @@ class MonitorApplication:
         
         return data
     
+    def get_all_weekly_totals(self):
+        indexes = range(len(self.engine.state.beverages))
+        return [self.get_weekly_totals(index, week_info) for index, week_info in zip(indexes, self.get_all_weeks(indexes))]
+    
+    def get_all_weeks(self, indexes):
+        """
+        Returns the last seven complete days of each beverage. Daily
+        rollups are kept locally, cloudant fills in the days recorded
+        before the local store existed; without cloudant only the local
+        days are returned. The day in progress is served as 'day'.
+        """
+        
+        today = self.history.day_start(int(time.time() * 1000))
+        weeks = [self.get_local_week(index, today) for index in indexes]
+        
+        # beverages missing local days are fetched from cloudant together
+        views = ['by-bev' + str(index + 1) for index, week_info in zip(indexes, weeks)
+                 if len(week_info) < MonitorApplication.WEEK_DAYS]
+        try:
+            # one more row covers a total posted for the day in progress
+            remote = self.cloudant.get_views(views, True, MonitorApplication.WEEK_DAYS + 1)
+        except Exception as e:
+            print 'Cloudant usage read failed:', e
+            remote = {}
+        
+        return [self.merge_week(index, week_info, remote.get('by-bev' + str(index + 1)) or [], today)
+                for index, week_info in zip(indexes, weeks)]
+    
+    def get_local_week(self, index, today):
+        week_info = []
+        for day, amount, count in self.history.daily_totals(index, MonitorApplication.WEEK_DAYS + 1):
+            if day < today:
+                week_info.append(self.week_row(index, day, amount))
+        return week_info[:MonitorApplication.WEEK_DAYS]
+    
+    def week_row(self, index, day, amount):
+        return {'key': day, 'value': {'beverage': index + 1, 'date': day, 'amount_dispensed': amount}}
+    
+    def merge_week(self, index, local, remote, today):
+        """
+        Newest complete days of both, before the day starting at today,
+        taking each day from the local store when it has it.
+        """
+        
+        days = dict((row['key'], row) for row in local if row['key'] < today)
+        
+        # cloudant totals are posted by the nightly analysis just after the
+        # midnight ending the day they cover, a manual analysis may add
+        # more; both sides key days by the local midnight of day_start
+        remote_days = collections.OrderedDict()
+        for row in remote:
+            day = self.history.day_start(row['value']['date'] - DispenseHistory.HOUR_MS)
+            if day < today:
+                remote_days[day] = remote_days.get(day, 0.0) + row['value']['amount_dispensed']
+        for day, amount in remote_days.items():
+            if day not in days:
+                days[day] = self.week_row(index, day, amount)
+        
+        return [days[day] for day in sorted(days, reverse=True)[:MonitorApplication.WEEK_DAYS]]
+    
     def get_all_beverages(self):
-        beverages = []
-        for index in range(len(self.monitor.beverages)):
-            beverages.append(self.get_beverage_data(index))
-        return beverages
+        return self.monitor.rows(BEVERAGE_FIELDS)
     
     def get_beverage_data(self, index):
         beverage = self.monitor.get_beverage(index)
@@ -224,7 +506,7 @@ class MonitorApplication:
             'name': beverage.name,
             'tap': beverage.tap,
             'storage': beverage.storage,
-            'days_left': beverage.storage * beverage.days_dispensed / beverage.total_dispensed,
+            'days_left': float(self.monitor.days_left([index])[0]),
             'last_order': beverage.last_order,
             'online': beverage.online,
             'pouring': beverage.pouring,
@@ -243,6 +525,34 @@ class MonitorApplication:
         }
         return data
     
+    def get_snapshot(self, name):
+        """
+        Returns (etag, json, gzipped json) for the 'beverage' or 'system'
+        data, encoded once per state version.
+        """
+        
+        state = self.engine.state
+        snapshot = self.snapshots.get(name)
+        if snapshot is not None and snapshot[0] == state.version:
+            return snapshot[1:]
+        
+        if name == 'beverage':
+            data = [dict((field, getattr(beverage, field)) for field in BEVERAGE_FIELDS) for beverage in state.beverages]
+        else:
+            data = dict(state.system._asdict())
+        body = json.dumps(data)
+        
+        buf = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+            f.write(body)
+        
+        # concurrent requests may both encode a new version, the last
+        # one stored wins and either result is correct
+        etag = '"%s-%d-%d"' % (name, self.snapshot_epoch, state.version)
+        self.snapshots[name] = (state.version, etag, body, buf.getvalue())
+        return etag, body, buf.getvalue()
+    
+    @serialized
     def update_beverage(self, index, data):
         if data['name'] is not None and len(data['name']) != 0:
             name = data['name']
@@ -265,6 +575,7 @@ class MonitorApplication:
         
         self.publish_beverage(index)
     
+    @serialized
     def update_system(self, data):
         if data['tap_size'] is not None and len(data['tap_size']) != 0:
             tap_size = float(data['tap_size'])
@@ -281,94 +592,270 @@ class MonitorApplication:
         if data['days_to_order'] is not None and len(data['days_to_order']) != 0:
             days_to_order = float(data['days_to_order'])
             self.monitor.update_days_to_order(days_to_order)
-            for index in range(len(self.monitor.beverages)):
-                if self.monitor.order_status(index):
-                    self.publish_order(index)
+            for index in self.monitor.order_all():
+                self.publish_order(index)
+                self.update_config(index)
+        
+        # tap sizes and orders may have changed any beverage
+        for index, data in enumerate(self.get_all_beverages()):
+            self.feed.publish(index, data)
+        
+        self.update_system_config()
     
+    @serialized
     def update_order_analysis(self):
-        for index in range(len(self.monitor.beverages)):
-            self.update_beverage_analysis(index)
-            time.sleep(0.2)
+        self.analyze_beverages(range(len(self.monitor.beverages)))
+        self.update_forecast()
     
+    @serialized
     def update_beverage_analysis(self, index):
-        self.post_daily_total(index)
-        self.monitor.reset_total_dispensed(index)
-        self.publish_beverage(index)
+        self.analyze_beverages([index])
+    
+    @serialized
+    def analyze_beverages(self, indexes):
+        # totals are on disk in the outbox before any of them is reset
+        self.outbox.post_many([self.get_daily_total(index) for index in indexes])
+        
+        for index in indexes:
+            self.monitor.reset_total_dispensed(index)
+            self.publish_beverage(index)
+    
+    @serialized
+    def update_forecast(self, now=None):
+        # idle beverages only fold in their quiet hours here
+        self.monitor.advance_forecast(now)
+        for index, data in enumerate(self.get_all_beverages()):
+            self.feed.publish(index, data)
+        self.save_forecast()
     
+    @serialized
     def switch_auto_update(self, index, status):
         self.monitor.toggle_auto_update(index, status)
         self.publish_beverage(index)
     
+    def save_forecast(self):
+        self.monitor.forecast.save(self.forecast_path, self.monitor.count)
+    
+    def get_pipeline_stats(self):
+        return self.pipeline.stats()
+    
+    def get_job_stats(self):
+        if not self.health.ready('scheduler'):
+            return {}
+        return self.jobs.stats()
+    
+    def get_health(self):
+        return self.health.report()
+    
+    def get_device_stat(self, name):
+        return [((str(index + 1),), data[name]) for index, data in self.device_stats.items() if name in data]
+    
+    def metric_families(self):
+        return registry.collect()
+    
     def disconnect(self):
-        if hasattr(self, 'client'):
+        if hasattr(self, 'health'):
+            self.health.stop()
+        if hasattr(self, 'jobs'):
+            # a running analysis still needs the engine and pipeline
+            self.jobs.shutdown()
+        if hasattr(self, 'pipeline'):
+            # let queued events and publishes finish first
+            self.pipeline.stop()
+        if getattr(self, 'transport', None) is not None:
+            self.transport.flush()
+        if getattr(self, 'client', None) is not None:
             self.client.disconnect()
-        if hasattr(self, 'sched'):
-            self.sched.shutdown()
+        if hasattr(self, 'engine'):
+            self.engine.stop()
+        if hasattr(self, 'outbox'):
+            self.outbox.close()
+        if hasattr(self, 'history'):
+            self.history.close()
+        if hasattr(self, 'monitor'):
+            self.save_forecast()
+        self.store.close()
 
 
 class Monitor:
     MIN_TAP_SIZE = 1.0
     MIN_STORAGE_SIZE = 1.0
     
+    # beverage slots allocated before the columns first grow
+    INITIAL_CAPACITY = 16
+    
+    # per-beverage values stored as one array each
+    COLUMNS = (
+        ('tap', numpy.float64),
+        ('storage', numpy.float64),
+        ('total_dispensed', numpy.float64),
+        ('days_dispensed', numpy.int64),
+        ('daily_total', numpy.float64),
+        ('last_order', numpy.int64),
+        ('online', numpy.bool_),
+        ('pouring', numpy.bool_),
+        ('auto_update', numpy.bool_)
+    )
+    
     def __init__(self, tap_size, order_amount, max_storage, days_to_order):
         self.tap_size = tap_size
         self.order_amount = order_amount
         self.max_storage = max_storage
         self.days_to_order = days_to_order
+        
+        # views onto the columns, one per beverage
         self.beverages = []
+        
+        # immutable beverage states and the indexes changed since they were built
+        self.states = []
+        self.changed = set()
+        
+        self.count = 0
+        self.columns = {'name': []}
+        for name, dtype in Monitor.COLUMNS:
+            self.columns[name] = numpy.zeros(Monitor.INITIAL_CAPACITY, dtype=dtype)
+        self.forecast = ConsumptionForecaster(Monitor.INITIAL_CAPACITY)
+        
+        # incremented on every change so readers can tell when state moved
+        self.version = 0
+    
+    def column(self, name):
+        return self.columns[name][:self.count]
+    
+    def grow(self):
+        for name, dtype in Monitor.COLUMNS:
+            column = numpy.zeros(len(self.columns[name]) * 2, dtype=dtype)
+            column[:self.count] = self.columns[name][:self.count]
+            self.columns[name] = column
+        self.forecast.grow(len(self.columns['tap']))
     
     def add_beverage(self, beverage):
+        self.version += 1
+        if self.count == len(self.columns['tap']):
+            self.grow()
+        
+        index = self.count
+        self.columns['name'].append(beverage.values['name'])
+        for name, dtype in Monitor.COLUMNS:
+            self.columns[name][index] = beverage.values[name]
+        self.count += 1
+        
+        beverage.bind(self, index)
         self.beverages.append(beverage)
+        self.changed.add(index)
+        self.forecast.reset(index, beverage.total_dispensed / beverage.days_dispensed)
     
     def get_beverage(self, index):
         return self.beverages[index]
     
+    def advance_forecast(self, now=None):
+        # the days left of every beverage move with the forecast
+        self.version += 1
+        self.forecast.advance_all(self.count, now)
+        self.changed.update(range(self.count))
+    
+    def days_left(self, indexes=None):
+        if indexes is None:
+            indexes = numpy.arange(self.count)
+        storage = self.columns['storage'][indexes]
+        return self.forecast.days_left(storage, indexes)
+    
+    def rows(self, fields, indexes=None):
+        """
+        Returns a dict of the given fields for every beverage (or those at
+        indexes), read a column at a time rather than a beverage at a time.
+        """
+        
+        if indexes is None:
+            indexes = range(self.count)
+        
+        values = []
+        for field in fields:
+            if field == 'days_left':
+                values.append(self.days_left(indexes).tolist())
+            elif field == 'name':
+                values.append([self.columns['name'][index] for index in indexes])
+            else:
+                values.append(self.column(field)[indexes].tolist())
+        return [dict(zip(fields, row)) for row in zip(*values)]
+    
+    def snapshot(self):
+        """
+        Returns an immutable MonitorState, rebuilding only the beverage
+        states that changed since the previous snapshot.
+        """
+        
+        changed = sorted(self.changed)
+        self.changed.clear()
+        
+        for index, row in zip(changed, self.rows(BeverageState._fields, changed)):
+            if index < len(self.states):
+                self.states[index] = BeverageState(**row)
+            else:
+                self.states.append(BeverageState(**row))
+        
+        system = SystemState(self.MIN_TAP_SIZE, self.MIN_STORAGE_SIZE, self.tap_size,
+                             self.max_storage, self.order_amount, self.days_to_order)
+        return MonitorState(self.version, tuple(self.states), system)
+    
     def update_name(self, index, name):
+        self.version += 1
         beverage = self.get_beverage(index)
         beverage.name = name
         
     def update_tap(self, index, tap):
+        self.version += 1
         beverage = self.get_beverage(index)
         beverage.tap = tap
     
     def update_storage(self, index, storage):
+        self.version += 1
         beverage = self.get_beverage(index)
         beverage.storage = storage
     
     def update_average_dispensed(self, index, average_dispensed):
+        self.version += 1
         beverage = self.get_beverage(index)
         beverage.total_dispensed = average_dispensed
         beverage.days_dispensed = 1
+        self.forecast.set_average(index, average_dispensed)
     
     def update_tap_size(self, tap_size):
+        self.version += 1
         self.tap_size = tap_size
-        for beverage in self.beverages:
-            if beverage.tap > tap_size:
-                beverage.tap = tap_size
+        tap = self.column('tap')
+        numpy.minimum(tap, tap_size, out=tap)
+        self.changed.update(range(self.count))
     
     def update_order_amount(self, order_amount):
+        self.version += 1
         self.order_amount = order_amount
     
     def update_max_storage(self, max_storage):
+        self.version += 1
         self.max_storage = max_storage
     
     def update_days_to_order(self, days_to_order):
+        self.version += 1
         self.days_to_order = days_to_order
     
     def reset_total_dispensed(self, index):
+        self.version += 1
         beverage = self.get_beverage(index)
         beverage.total_dispensed += beverage.daily_total
         beverage.days_dispensed += 1
         beverage.daily_total = 0.0
     
     def refill_beverage(self, index):
+        self.version += 1
         beverage = self.get_beverage(index)
         if beverage.storage < self.tap_size:
             beverage.tap = beverage.storage
         else:
             beverage.tap = self.tap_size
     
-    def dispense_beverage(self, index, dispensed_amount):
+    def dispense_beverage(self, index, dispensed_amount, timestamp=None):
+        self.version += 1
         beverage = self.get_beverage(index)
         beverage.tap -= dispensed_amount
         beverage.storage -= dispensed_amount
@@ -378,22 +865,39 @@ class Monitor:
             beverage.storage = 0.0
 		
         beverage.daily_total += dispensed_amount
+        self.forecast.record(index, dispensed_amount, timestamp / 1000.0 if timestamp is not None else None)
     
     def order_status(self, index):
-        beverage = self.get_beverage(index)
-        days_left = beverage.storage * beverage.days_dispensed / beverage.total_dispensed
-        if days_left <= self.days_to_order:
+        days_left = self.days_left([index])[0]
+        if self.due(days_left):
             self.make_order(index)
             return True
         else:
             return False
     
+    def order_all(self):
+        """Orders every beverage that is due at once, returning their indexes."""
+        
+        due = numpy.flatnonzero(self.due(self.days_left()))
+        if len(due) != 0:
+            self.version += 1
+            self.column('storage')[due] += self.order_amount
+            self.column('last_order')[due] = int(time.time() * 1000)
+            self.changed.update(due.tolist())
+        return due.tolist()
+    
+    def due(self, days_left):
+        # a beverage nobody drinks is never due, whatever days_to_order is
+        return (days_left < ConsumptionForecaster.MAX_DAYS) & (days_left <= self.days_to_order)
+    
     def make_order(self, index):
+        self.version += 1
         beverage = self.get_beverage(index)
         beverage.storage += self.order_amount
         beverage.last_order = int(time.time() * 1000)
     
     def toggle_online(self, index, status):
+        self.version += 1
         beverage = self.get_beverage(index)
         if status:
             beverage.online = True
@@ -401,6 +905,7 @@ class Monitor:
             beverage.online = False
     
     def toggle_pouring(self, index, status):
+        self.version += 1
         beverage = self.get_beverage(index)
         if status:
             beverage.pouring = True
@@ -408,27 +913,109 @@ class Monitor:
             beverage.pouring = False
     
     def toggle_auto_update(self, index, status):
+        self.version += 1
         beverage = self.get_beverage(index)
         beverage.auto_update = status
 
 
-class Beverage:
+# latency of the event, disk and network paths, served at /metrics
+EVENT_SECONDS = registry.histogram('monitor_event_seconds', 'Time to process a device event.', ('event',))
+CONFIG_WRITE_SECONDS = registry.histogram('monitor_config_write_seconds', 'Time to journal a config change.')
+PUBLISH_SECONDS = registry.histogram('monitor_publish_seconds', 'Time to hand an event or command to the broker.', ('kind',))
+CLOUDANT_SECONDS = registry.histogram('monitor_cloudant_request_seconds', 'Time of Cloudant requests.', ('operation',))
+UNDELIVERED = registry.counter('monitor_undelivered_total', 'Events and commands dropped while not connected to the broker.', ('kind',))
+DUPLICATE_EVENTS = registry.counter('monitor_duplicate_events_total', 'Replayed device events dropped as already applied.', ('event',))
+
+# sensor path summaries published by the dispensers, served as gauges
+DEVICE_STATS = (
+    ('loop_hz', 'Dispenser loop iterations per second.'),
+    ('period_us', 'Mean flow pulse interval in microseconds.'),
+    ('jitter_us', 'Mean change between successive pulse intervals in microseconds.'),
+    ('missed', 'Flow pulse edges suspected missed in the last stats window.'),
+    ('dropped', 'Flow pulses dropped on a full buffer since the dispenser started.'),
+    ('unsent', 'Pouring and log events dropped while the link was down since the dispenser started.'),
+    ('latency_ms', 'Longest delay from a pulse to its processing in the last stats window.'),
+    ('pours_per_hour', 'Pours per hour over the last stats window.'),
+    ('cpu_ms_per_pour', 'Dispenser loop CPU milliseconds per pour.')
+)
+
+# fields of a beverage served by the api
+BEVERAGE_FIELDS = ('name', 'tap', 'storage', 'days_left', 'last_order', 'online', 'pouring', 'auto_update')
+
+# immutable views of the monitor handed to readers by the state engine
+BeverageState = collections.namedtuple('BeverageState', BEVERAGE_FIELDS + ('total_dispensed', 'days_dispensed', 'daily_total'))
+SystemState = collections.namedtuple('SystemState', ['min_tap_size', 'min_storage_size', 'tap_size', 'max_storage', 'order_amount', 'days_to_order'])
+MonitorState = collections.namedtuple('MonitorState', ['version', 'beverages', 'system'])
+
+
+def beverage_column(name, cast):
+    # property reading one beverage's value out of the monitor columns,
+    # or out of its own values until it is added to a monitor
+    def get(self):
+        if self.monitor is None:
+            return self.values[name]
+        return cast(self.monitor.columns[name][self.index])
+    
+    def set(self, value):
+        if self.monitor is None:
+            self.values[name] = value
+        else:
+            self.monitor.columns[name][self.index] = value
+            self.monitor.changed.add(self.index)
+    
+    return property(get, set)
+
+
+class Beverage(object):
+    __slots__ = ('monitor', 'index', 'values')
+    
     def __init__(self, name, tap, storage, total_dispensed, days_dispensed, last_order, auto_update):
-        self.name = name
-        self.tap = tap
-        self.storage = storage
-        self.total_dispensed = total_dispensed
-        self.days_dispensed = days_dispensed
-        self.last_order = last_order
-        self.auto_update = auto_update
-        
-        self.daily_total = 0.0
-        self.online = False
-        self.pouring = False
+        self.monitor = None
+        self.index = None
+        self.values = {
+            'name': name,
+            'tap': tap,
+            'storage': storage,
+            'total_dispensed': total_dispensed,
+            'days_dispensed': days_dispensed,
+            'last_order': last_order,
+            'auto_update': auto_update,
+            'daily_total': 0.0,
+            'online': False,
+            'pouring': False
+        }
+    
+    def bind(self, monitor, index):
+        self.monitor = monitor
+        self.index = index
+        self.values = None
+    
+    name = beverage_column('name', lambda value: value)
+    tap = beverage_column('tap', float)
+    storage = beverage_column('storage', float)
+    total_dispensed = beverage_column('total_dispensed', float)
+    days_dispensed = beverage_column('days_dispensed', int)
+    daily_total = beverage_column('daily_total', float)
+    last_order = beverage_column('last_order', int)
+    online = beverage_column('online', bool)
+    pouring = beverage_column('pouring', bool)
+    auto_update = beverage_column('auto_update', bool)
 
 
 class CloudantConnector:
+    # seconds a view result is served from the cache
+    CACHE_TTL = 60.0
+    
+    # connections kept open to the cloudant host
+    POOL_SIZE = 8
+    
+    REQUEST_TIMEOUT = 10.0
+    
     def __init__(self, database):
+        self.username = None
+        self.password = None
+        host = None
+        
         # get credentials for cloudant database
         if 'VCAP_SERVICES' in os.environ:
             # credentials are given by bluemix environment
@@ -448,17 +1035,92 @@ class CloudantConnector:
                 self.password = creds['password']
                 host = creds['host']
         
-        self.url = 'https://' + host + '/' + database
+        # CLOUDANT_URL points the connector at another server, e.g. the
+        # local stand-in used by bench_monitor.py
+        base = os.getenv('CLOUDANT_URL')
+        if base is None and host is not None:
+            base = 'https://' + host
+        
+        # without credentials every request fails, and the health check says why
+        self.url = None
+        if base is not None:
+            self.url = base + '/' + database
+        
+        # one keep-alive session avoids a tls handshake per request
+        self.session = requests.Session()
+        if self.username is not None:
+            self.session.auth = (self.username, self.password)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=CloudantConnector.POOL_SIZE)
+        if base is not None:
+            self.session.mount(base, adapter)
+        self.pool = ThreadPool(CloudantConnector.POOL_SIZE)
+        
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.generation = 0
     
     def get_data(self, view, descending, limit):
-        view_url = self.url + '/_design/data/_view/' + view
+        key = (view, descending, limit)
+        
+        with self.cache_lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > time.time():
+                return cached[1]
+            generation = self.generation
+        
+        view_url = self.database_url() + '/_design/data/_view/' + view
         args = {'descending': descending, 'limit': limit}
         
-        response = requests.get(view_url, params=args, auth=(self.username, self.password))
-        if 'rows' in response.json():
-            return response.json()['rows']
+        with CLOUDANT_SECONDS.time(('view',)):
+            response = self.session.get(view_url, params=args, timeout=CloudantConnector.REQUEST_TIMEOUT)
+        body = response.json()
+        if 'rows' in body:
+            rows = body['rows']
         else:
-            return ''
+            rows = ''
+        
+        with self.cache_lock:
+            # results fetched while a write was in flight may already be stale
+            if generation == self.generation:
+                self.cache[key] = (time.time() + CloudantConnector.CACHE_TTL, rows)
+        
+        return rows
+    
+    def get_views(self, views, descending, limit):
+        """Fetches several views concurrently over the pooled session."""
+        
+        if len(views) == 0:
+            return {}
+        
+        results = self.pool.map(lambda view: self.get_data(view, descending, limit), views)
+        return dict(zip(views, results))
+    
+    def invalidate(self):
+        with self.cache_lock:
+            self.cache.clear()
+            self.generation += 1
+    
+    def database_url(self):
+        if self.url is None:
+            raise IOError('Cloudant credentials are not configured')
+        return self.url
+    
+    def check(self):
+        """Raises unless the database answers."""
+        
+        with CLOUDANT_SECONDS.time(('check',)):
+            self.session.get(self.database_url(), timeout=CloudantConnector.REQUEST_TIMEOUT).raise_for_status()
     
     def post_json(self, data):
-        return requests.post(self.url, json=data, auth=(self.username, self.password))
\ No newline at end of file
+        try:
+            with CLOUDANT_SECONDS.time(('post',)):
+                return self.session.post(self.database_url(), json=data, timeout=CloudantConnector.REQUEST_TIMEOUT)
+        finally:
+            self.invalidate()
+    
+    def post_bulk(self, documents):
+        try:
+            with CLOUDANT_SECONDS.time(('bulk',)):
+                return self.session.post(self.database_url() + '/_bulk_docs', json={'docs': documents}, timeout=CloudantConnector.REQUEST_TIMEOUT)
+        finally:
+            self.invalidate()
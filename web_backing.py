@@ -1,7 +1,11 @@
 #!/usr/bin/python
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, Response, abort, g, render_template, request, jsonify, redirect, url_for, stream_with_context
 from web_app import Monitor, MonitorApplication
+from web_broker import LocalBroker
+from web_metrics import registry, render
+from web_partition import PartitionedMonitor
+from web_serving import ServingPool
 import atexit
 import cf_deployment_tracker
 import ibmiotf.device
@@ -10,11 +14,11 @@ import os
 import re
 import requests
 import socket
+import threading
 import time
 
 
-# emit Bluemix deployment event
-cf_deployment_tracker.track()
+started = time.time()
 
 # deploy app locally or through bluemix
 app = Flask(__name__)
@@ -23,13 +27,75 @@ app = Flask(__name__)
 # default the port to 8080 on local machine
 port = int(os.getenv('PORT', 8080))
 
+# WEB_WORKERS above 1 serves requests from that many worker processes,
+# with this process owning the monitor state for all of them
+workers = int(os.getenv('WEB_WORKERS', '1'))
+
 # monitor application setup
 iot_config = 'config/bluemix/app.cfg'
+venues_config = 'config/data/venues.cfg'
 if os.path.exists(MonitorApplication.UPDATE_CONFIG_PATH):
     monitor_config = MonitorApplication.UPDATE_CONFIG_PATH
 else:
     monitor_config = 'config/data/monitor.cfg'
-monitor_app = MonitorApplication(monitor_config, iot_config)
+
+# IOT_BROKER=local runs against an in-process broker instead of bluemix
+if os.getenv('IOT_BROKER') == 'local':
+    client = LocalBroker()
+else:
+    client = None
+
+def create_monitor():
+    # with a venues config each venue is served by its own worker process
+    if os.path.exists(venues_config):
+        return PartitionedMonitor(venues_config, iot_config, client=client)
+    return MonitorApplication(monitor_config, iot_config, client=client)
+
+# workers are forked before the monitor starts any threads
+if workers > 1:
+    pool = ServingPool(workers, '0.0.0.0', port)
+    monitor_app = pool.start(create_monitor)
+else:
+    pool = None
+    monitor_app = create_monitor()
+
+# emit Bluemix deployment event, in the background as it is a network call
+if pool is None or pool.index is None:
+    tracker = threading.Thread(target=cf_deployment_tracker.track, name='deployment-tracker')
+    tracker.daemon = True
+    tracker.start()
+
+def monitor():
+    """Returns the monitor of the venue named by the request, if any."""
+    
+    try:
+        return monitor_app.partition(request.args.get('venue'))
+    except KeyError:
+        abort(404)
+
+# time taken by each route, up to the response being returned
+REQUEST_SECONDS = registry.histogram('http_request_seconds', 'Time to handle an API request.', ('route', 'method', 'status'))
+
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+
+@app.after_request
+def observe_request(response):
+    observe_route(response.status_code)
+    return response
+
+@app.teardown_request
+def observe_failure(exc):
+    # failed requests skip after_request
+    if exc is not None:
+        observe_route(500)
+
+def observe_route(status):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.time() - start, (route, request.method, str(status)))
 
 @app.route('/')
 def main_page():
@@ -62,7 +128,7 @@ def put_system():
     # get data from json parameter
     data = request.json['system']
     
-    monitor_app.update_system(data)
+    monitor().update_system(data)
     
     return ''
 
@@ -85,7 +151,7 @@ def put_beverage():
     data = request.json['beverage']
     index = int(data['index'])
     
-    monitor_app.update_beverage(index, data)
+    monitor().update_beverage(index, data)
     
     return ''
 
@@ -109,7 +175,7 @@ def put_control():
     else:
         command = 'disconnect'
     
-    monitor_app.toggle_device_connection(index, command)
+    monitor().toggle_device_connection(index, command)
     
     return ''
 
@@ -119,9 +185,9 @@ def put_usage_update():
     index = int(request.json['beverage'])
     
     if (index == -1):
-        monitor_app.update_order_analysis()
+        monitor().update_order_analysis()
     else:
-        monitor_app.update_beverage_analysis(index)
+        monitor().update_beverage_analysis(index)
     
     return ''
 
@@ -131,7 +197,7 @@ def put_auto_update():
     index = int(request.json['beverage'])
     state = request.json['state']
     
-    monitor_app.switch_auto_update(index, state)
+    monitor().switch_auto_update(index, state)
     
     return ''
 
@@ -141,31 +207,98 @@ def view_usage():
     
     return render_template('view/usage.html')
 
+def snapshot_response(name):
+    """
+    Serves a pre-encoded monitor snapshot. Clients that already hold the
+    current version get an empty 304, others get gzip when accepted.
+    """
+    
+    etag, body, gzipped = monitor().get_snapshot(name)
+    
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    # If-None-Match is '*' or a list of quoted tags, compared weakly as
+    # the RFC asks, never as a substring of the header
+    if request.if_none_match.contains_weak(etag.strip('"')):
+        return Response(status=304, headers=headers)
+    
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        body = gzipped
+    
+    return Response(body, mimetype='application/json', headers=headers)
+
 @app.route( '/data/beverage', methods=['GET'] )
 def get_beverage_data():
     """Retrieves beverage information from database."""
     
     # return all beverage information
-    return jsonify(monitor_app.get_all_beverages())
+    return snapshot_response('beverage')
+
+@app.route( '/data/stream', methods=['GET'] )
+def get_beverage_stream():
+    """
+    Streams beverage changes as server-sent events. A snapshot of all
+    beverages is sent first, followed by only the fields that change.
+    """
+    
+    stream = stream_with_context(monitor().feed.subscribe())
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream, mimetype='text/event-stream', headers=headers)
 
 @app.route( '/data/system', methods=['GET'] )
 def get_system_data():
     """Retrieves system information from database."""
     
     # return system information
-    return jsonify(monitor_app.get_system_info())
+    return snapshot_response('system')
+
+@app.route( '/data/pipeline', methods=['GET'] )
+def get_pipeline_data():
+    """Retrieves event counts and queue depths of the event pipeline."""
+    
+    return jsonify(monitor().get_pipeline_stats())
+
+@app.route( '/data/jobs', methods=['GET'] )
+def get_job_data():
+    """Retrieves the schedule and recent run timings of background jobs."""
+    
+    return jsonify(monitor().get_job_stats())
 
 @app.route( '/data/usage', methods=['GET'] )
 def get_beverage_usage():
     """Retrieves data to display for beverage usage."""
     
-    data = []
-    for index in range(len(monitor_app.monitor.beverages)):
-        data.append(monitor_app.get_weekly_totals(index))
+    data = monitor().get_all_weekly_totals()
     
     # return beverage usage data
     return jsonify(data)
 
+@app.route( '/metrics', methods=['GET'] )
+def get_metrics():
+    """Latency histograms, event counters and queue depths in the Prometheus text format."""
+    
+    return Response(render(monitor_app.metric_families()), mimetype='text/plain; version=0.0.4')
+
+@app.route( '/health/live', methods=['GET'] )
+def get_liveness():
+    """Answers as long as the server runs, whatever its dependencies' state."""
+    
+    return jsonify({'status': 'alive', 'uptime': time.time() - started})
+
+@app.route( '/health/ready', methods=['GET'] )
+def get_readiness():
+    """
+    Reports the broker connection, Cloudant and the scheduler. Answers 503
+    until each has been tried once, then 200 with any that still fail
+    reported as degraded.
+    """
+    
+    report = monitor_app.get_health()
+    response = jsonify(report)
+    if report['status'] == 'starting':
+        response.status_code = 503
+    return response
+
 @atexit.register
 def shutdown():
     # close mqtt client when terminating web server
@@ -173,8 +306,12 @@ def shutdown():
 
 if __name__ == '__main__':
     try:
-        # run app on localhost when called from terminal
-        app.run( host='0.0.0.0', port=port, debug=False )
+        if pool is not None:
+            pool.serve(app)
+        else:
+            # run app on localhost when called from terminal
+            # threaded so open event streams do not block other requests
+            app.run( host='0.0.0.0', port=port, debug=False, threaded=True )
     except socket.error:
         # ignore errors caused by premature exit
         pass
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+import json
+import threading
+import time
+import wire
+
+
+class LocalMessage:
+    """Device event or command in the shape ibmiotf hands to callbacks."""
+
+    def __init__(self, deviceType, deviceId, name, data, qos=0, format='json'):
+        self.deviceType = deviceType
+        self.deviceId = deviceId
+        self.device = deviceType + ':' + deviceId
+        self.event = name
+        self.command = name
+        self.format = format
+        if format == wire.FORMAT:
+            self.payload = data
+            self.data = wire.unpack(data)[1]
+        else:
+            self.payload = json.dumps(data)
+            self.data = data
+        self.qos = qos
+        self.timestamp = time.time()
+
+
+class LocalBroker:
+    """
+    In-process stand-in for ibmiotf.application.Client, used to run the
+    monitor without the Watson IOT broker. Device events are injected
+    with inject(), and published events and commands are recorded and
+    handed to any listeners registered for them. Like a persistent MQTT
+    session, QoS 1 events injected while disconnected are kept and
+    delivered on connect() unless clean_session is set.
+    """
+
+    def __init__(self, clean_session=False):
+        self.deviceEventCallback = None
+        self.clean_session = clean_session
+        self.connected = True
+
+        # qos of each subscribed event
+        self.subscriptions = {}
+
+        self.events = []
+        self.commands = []
+        self.queued = []
+        self.eventListeners = []
+        self.commandListeners = {}
+        self.lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            self.connected = True
+            queued = self.queued
+            self.queued = []
+        for message in queued:
+            self.deliver(message)
+
+    def disconnect(self):
+        self.connected = False
+
+    def subscribeToDeviceEvents(self, deviceType='+', deviceId='+', event='+', msgFormat='+', qos=0):
+        self.subscriptions[event] = qos
+        return True
+
+    def publishEvent(self, deviceType, deviceId, event, msgFormat, data, qos=0, on_publish=None):
+        message = LocalMessage(deviceType, deviceId, event, data, qos, msgFormat)
+        with self.lock:
+            self.events.append(message)
+            listeners = list(self.eventListeners)
+        for listener in listeners:
+            listener(message)
+        if on_publish is not None:
+            on_publish()
+        return True
+
+    def publishCommand(self, deviceType, deviceId, command, msgFormat, data=None, qos=0, on_publish=None):
+        message = LocalMessage(deviceType, deviceId, command, data, qos, msgFormat)
+        with self.lock:
+            self.commands.append(message)
+            listeners = list(self.commandListeners.get(deviceId, []))
+        for listener in listeners:
+            listener(message)
+        if on_publish is not None:
+            on_publish()
+        return True
+
+    def onEvent(self, listener):
+        """Calls listener with every event the application publishes."""
+
+        with self.lock:
+            self.eventListeners.append(listener)
+
+    def onCommand(self, deviceId, listener):
+        """Calls listener with every command sent to the given device."""
+
+        with self.lock:
+            self.commandListeners.setdefault(deviceId, []).append(listener)
+
+    def inject(self, deviceType, deviceId, event, data, qos=0, msgFormat='json'):
+        """
+        Delivers a device event as if it had arrived from the broker. The
+        event is delivered at the lower of its own and the subscription's
+        QoS, so while disconnected only QoS 1 events are kept.
+        """
+
+        if event in self.subscriptions:
+            granted = self.subscriptions[event]
+        elif '+' in self.subscriptions:
+            granted = self.subscriptions['+']
+        else:
+            return False
+        message = LocalMessage(deviceType, deviceId, event, data, min(qos, granted), msgFormat)
+
+        with self.lock:
+            if not self.connected:
+                if message.qos > 0 and not self.clean_session:
+                    self.queued.append(message)
+                    return True
+                return False
+        return self.deliver(message)
+
+    def deliver(self, message):
+        if self.deviceEventCallback is None:
+            return False
+        self.deviceEventCallback(message)
+        return True
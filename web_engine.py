@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import functools
+import Queue
+import sys
+import threading
+import traceback
+
+
+class StateEngine:
+    """
+    Runs every change to the monitor on one writer thread, in the order
+    the changes were submitted. After each change the writer publishes a
+    new immutable state built by build_state, which readers on any
+    thread can use through the state attribute without taking a lock.
+    """
+
+    def __init__(self, build_state, version):
+        self.build_state = build_state
+        self.version = version
+
+        self.commands = Queue.Queue()
+        self.state = build_state()
+        self.state_version = version()
+
+        # callables given each new state on the writer thread, once it is
+        # what readers see
+        self.observers = []
+
+        self.writer = threading.Thread(target=self.run, name='state-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def submit(self, function, *args):
+        """Queues a change without waiting for it to be applied."""
+
+        self.commands.put((function, args, None))
+
+    def call(self, function, *args):
+        """Queues a change and waits for its result."""
+
+        if threading.current_thread() is self.writer:
+            # nested calls from a running command are already serialized
+            return function(*args)
+
+        reply = [threading.Event(), None, None]
+        self.commands.put((function, args, reply))
+        reply[0].wait()
+        if reply[2] is not None:
+            raise reply[2][0], reply[2][1], reply[2][2]
+        return reply[1]
+
+    def run(self):
+        while True:
+            function, args, reply = self.commands.get()
+            if function is None:
+                return
+
+            try:
+                result = function(*args)
+                if reply is not None:
+                    reply[1] = result
+            except Exception:
+                if reply is not None:
+                    reply[2] = sys.exc_info()
+                else:
+                    traceback.print_exc()
+            finally:
+                self.refresh()
+                if reply is not None:
+                    reply[0].set()
+
+    def refresh(self):
+        version = self.version()
+        if version != self.state_version:
+            # assigning a reference is atomic, readers see old or new state
+            self.state = self.build_state()
+            self.state_version = version
+            for observer in self.observers:
+                observer(self.state)
+
+    def stop(self):
+        self.commands.put((None, None, None))
+
+
+def serialized(method):
+    """Runs a MonitorApplication method on its state writer thread."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        return self.engine.call(method, self, *args)
+    return wrapper
+
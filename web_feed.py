@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+import json
+import Queue
+import threading
+
+
+class BeverageFeed:
+    """
+    Pushes beverage changes to dashboard pages as server-sent events.
+    Each subscriber gets a full snapshot when it connects and then only
+    the fields that changed, so traffic follows state changes rather
+    than the number of open pages.
+    """
+
+    # messages buffered per subscriber before it is dropped as too slow
+    QUEUE_SIZE = 256
+
+    # seconds between keep-alive comments on an idle stream
+    HEARTBEAT = 15.0
+
+    def __init__(self):
+        self.beverages = []
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+        # callables given every published beverage, e.g. to mirror the
+        # feed into another process
+        self.observers = []
+
+    def reset(self, beverages):
+        with self.lock:
+            self.beverages = [dict(beverage) for beverage in beverages]
+            subscribers = list(self.subscribers)
+            message = self.format('snapshot', self.beverages)
+        for queue in subscribers:
+            self.send(queue, message)
+
+    def publish(self, index, data):
+        """Sends the fields of a beverage that differ from the last update."""
+
+        for observer in self.observers:
+            observer(index, data)
+
+        with self.lock:
+            while len(self.beverages) <= index:
+                self.beverages.append({})
+            current = self.beverages[index]
+
+            changes = {}
+            for key, value in data.items():
+                if key != 'beverage' and current.get(key) != value:
+                    changes[key] = value
+            if not changes:
+                return
+
+            current.update(changes)
+            subscribers = list(self.subscribers)
+            message = self.format('delta', {'index': index, 'changes': changes})
+
+        for queue in subscribers:
+            self.send(queue, message)
+
+    def send(self, queue, message):
+        try:
+            queue.put_nowait(message)
+        except Queue.Full:
+            # the stream closes and the browser reconnects for a fresh snapshot
+            with self.lock:
+                self.subscribers.discard(queue)
+
+    def format(self, event, data):
+        return 'event: ' + event + '\ndata: ' + json.dumps(data) + '\n\n'
+
+    def subscribe(self):
+        """Generator of event stream text for one connected page."""
+
+        queue = Queue.Queue(BeverageFeed.QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(queue)
+            snapshot = self.format('snapshot', self.beverages)
+
+        try:
+            yield snapshot
+            while True:
+                with self.lock:
+                    if queue not in self.subscribers:
+                        return
+                try:
+                    yield queue.get(timeout=BeverageFeed.HEARTBEAT)
+                except Queue.Empty:
+                    yield ': keep-alive\n\n'
+        finally:
+            with self.lock:
+                self.subscribers.discard(queue)
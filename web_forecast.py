@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+from datetime import datetime
+
+import numpy
+import os
+import time
+
+
+class ConsumptionForecaster:
+    """
+    Online forecast of how fast each beverage is drunk. Dispensed amounts
+    are summed into the current hour, and each finished hour updates an
+    exponentially weighted profile of consumption for that hour of the
+    week, so weekend and evening peaks shape the forecast. A faster pair
+    of averages compares recent hours with what the profile expected for
+    them and scales the whole profile when trade runs above or below it.
+    A dispense costs O(1) and all state is held in fixed-size arrays,
+    one row per beverage.
+    """
+
+    HOURS_PER_WEEK = 168
+
+    # per-beverage arrays, saved and grown together
+    ARRAYS = ('profile', 'recent', 'expected', 'hour', 'amount')
+
+    # weight of a finished hour in the recent averages, about two days of memory
+    RECENT_WEIGHT = 0.02
+
+    # weight of a finished hour in the profile for its hour of the week
+    PROFILE_WEIGHT = 0.2
+
+    # days left of a beverage nobody drinks; forecasts stay finite so
+    # they encode as json numbers
+    MAX_DAYS = 3650.0
+
+    def __init__(self, capacity, recent_weight=RECENT_WEIGHT, profile_weight=PROFILE_WEIGHT):
+        self.recent_weight = recent_weight
+        self.profile_weight = profile_weight
+
+        # gallons per hour for each hour of the week, from monday 0:00
+        self.profile = numpy.zeros((capacity, ConsumptionForecaster.HOURS_PER_WEEK), dtype=numpy.float64)
+
+        # recent gallons per hour, and the profile's gallons over the same hours
+        self.recent = numpy.zeros(capacity, dtype=numpy.float64)
+        self.expected = numpy.zeros(capacity, dtype=numpy.float64)
+
+        # hour being summed, counted in local time from a monday, and its total
+        self.hour = numpy.zeros(capacity, dtype=numpy.int64)
+        self.amount = numpy.zeros(capacity, dtype=numpy.float64)
+
+        # cumulative demand over the week ahead, and the hour it was built
+        # for, so forecasts only walk the profile once an hour
+        self.curve = numpy.zeros((capacity, ConsumptionForecaster.HOURS_PER_WEEK), dtype=numpy.float64)
+        self.curve_hour = numpy.full(capacity, -1, dtype=numpy.int64)
+
+        # local hour of the current wall clock hour and its bounds in seconds
+        self.clock = (0.0, 0.0, 0)
+
+    def grow(self, capacity):
+        count = len(self.recent)
+        for name in ConsumptionForecaster.ARRAYS:
+            column = getattr(self, name)
+            grown = numpy.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:count] = column
+            setattr(self, name, grown)
+
+        curve = numpy.zeros((capacity, ConsumptionForecaster.HOURS_PER_WEEK), dtype=numpy.float64)
+        curve[:count] = self.curve
+        self.curve = curve
+        curve_hour = numpy.full(capacity, -1, dtype=numpy.int64)
+        curve_hour[:count] = self.curve_hour
+        self.curve_hour = curve_hour
+
+    def local_hour(self, now=None):
+        """Hours since the epoch in local time, so hour % 168 is Monday 0:00 based."""
+
+        if now is None:
+            now = time.time()
+        start, end, hour = self.clock
+        if start <= now < end:
+            return hour
+
+        local = datetime.fromtimestamp(now)
+        # the epoch fell on a thursday, shift so multiples of 168 are mondays
+        days = (local.date() - datetime(1970, 1, 5).date()).days
+        hour = days * 24 + local.hour
+
+        start = now - local.minute * 60 - local.second - local.microsecond / 1e6
+        self.clock = (start, start + 3600, hour)
+        return hour
+
+    def reset(self, index, daily_average, now=None):
+        """Starts a beverage from a flat week at its average daily consumption."""
+
+        hourly = daily_average / 24.0
+        self.profile[index] = hourly
+        self.recent[index] = hourly
+        self.expected[index] = hourly
+        self.hour[index] = self.local_hour(now)
+        self.amount[index] = 0.0
+        self.curve_hour[index] = -1
+
+    def set_average(self, index, daily_average):
+        """Rescales a beverage to a new average, keeping its weekly pattern."""
+
+        hourly = daily_average / 24.0
+        mean = self.profile[index].mean()
+        if mean > 0:
+            self.profile[index] *= hourly / mean
+        else:
+            self.profile[index] = hourly
+        self.recent[index] = hourly
+        self.expected[index] = hourly
+        self.curve_hour[index] = -1
+
+    def record(self, index, amount, now=None):
+        hour = self.local_hour(now)
+        if hour > self.hour[index]:
+            self.advance(index, hour)
+        if hour < self.hour[index]:
+            self.record_late(index, amount, hour)
+        else:
+            self.amount[index] += amount
+
+    def record_late(self, index, amount, hour):
+        """
+        Adds an amount from an hour already folded in, e.g. a pour replayed
+        after an outage. The averages are linear in each hour's amount, so
+        adding its weight, decayed by the folds since, matches the state
+        had it arrived in time.
+        """
+
+        late = int(self.hour[index]) - hour
+        self.recent[index] += self.recent_weight * amount * (1.0 - self.recent_weight) ** (late - 1)
+
+        # the slot was folded again once for each week since
+        slot = hour % ConsumptionForecaster.HOURS_PER_WEEK
+        weeks = (late - 1) // ConsumptionForecaster.HOURS_PER_WEEK
+        self.profile[index, slot] += self.profile_weight * amount * (1.0 - self.profile_weight) ** weeks
+        self.curve_hour[index] = -1
+
+    def advance(self, index, hour):
+        """Folds the hours finished before the given hour into the forecast."""
+
+        finished = hour - int(self.hour[index])
+        if finished <= 0:
+            return
+
+        profile = self.profile[index]
+        recent = self.recent[index]
+        expected = self.expected[index]
+        amount = self.amount[index]
+
+        # a beverage idle for over a week only needs its last week replayed,
+        # the hours before that just decay the recent averages
+        replay = min(finished, ConsumptionForecaster.HOURS_PER_WEEK)
+        decay = (1.0 - self.recent_weight) ** (finished - replay)
+        recent *= decay
+        expected = expected * decay + (1.0 - decay) * profile.mean()
+        start = hour - replay
+
+        for step in range(replay):
+            slot = (start + step) % ConsumptionForecaster.HOURS_PER_WEEK
+            observed = amount if step == 0 and finished == replay else 0.0
+
+            recent += self.recent_weight * (observed - recent)
+            expected += self.recent_weight * (profile[slot] - expected)
+            profile[slot] += self.profile_weight * (observed - profile[slot])
+
+        self.recent[index] = recent
+        self.expected[index] = expected
+        self.hour[index] = hour
+        self.amount[index] = 0.0
+        self.curve_hour[index] = -1
+
+    def advance_all(self, count, now=None):
+        hour = self.local_hour(now)
+        for index in range(count):
+            self.advance(index, hour)
+
+    def build_curves(self, indexes, hour):
+        slot = hour % ConsumptionForecaster.HOURS_PER_WEEK
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            scale = self.recent[indexes] / self.expected[indexes]
+        scale[~numpy.isfinite(scale)] = 1.0
+
+        demand = scale[:, None] * numpy.roll(self.profile[indexes], -slot, axis=1)
+        self.curve[indexes] = demand.cumsum(axis=1)
+        self.curve_hour[indexes] = hour
+
+    def days_left(self, storage, indexes, now=None):
+        """
+        Days until the given storage runs out at the forecast rate, walking
+        the weekly pattern forward from the current hour, at most MAX_DAYS.
+        """
+
+        hours = ConsumptionForecaster.HOURS_PER_WEEK
+        hour = self.local_hour(now)
+        indexes = numpy.asarray(indexes, dtype=numpy.intp)
+
+        stale = indexes[self.curve_hour[indexes] != hour]
+        if len(stale) != 0:
+            self.build_curves(stale, hour)
+
+        if len(indexes) == 1:
+            # a single dispense only needs its own beverage, skip the array setup
+            return numpy.array([self.runout(indexes[0], float(storage[0]))])
+
+        total = self.curve[indexes]
+        week = total[:, -1]
+
+        # the hour in progress has already drunk part of its forecast, which
+        # leaves as much more storage for the hours after it
+        storage = storage + numpy.minimum(self.amount[indexes], total[:, 0])
+
+        # a beverage nobody drinks never runs out
+        idle = week <= 0
+        weeks = numpy.floor(storage / numpy.where(idle, numpy.inf, week))
+        remaining = storage - weeks * week
+
+        # first hour whose cumulative demand reaches the remaining storage
+        hour = numpy.minimum((total < remaining[:, None]).sum(axis=1), hours - 1)
+        rows = numpy.arange(len(hour))
+        before = total[rows, hour - 1]
+        before[hour == 0] = 0.0
+        demand = total[rows, hour] - before
+        fraction = numpy.divide(remaining - before, demand, out=numpy.zeros(len(hour)), where=demand > 0)
+
+        days = (weeks * hours + hour + fraction) / 24.0
+        days[idle] = ConsumptionForecaster.MAX_DAYS
+        return numpy.minimum(days, ConsumptionForecaster.MAX_DAYS)
+
+    def runout(self, index, storage):
+        """days_left for one beverage whose curve is current."""
+
+        hours = ConsumptionForecaster.HOURS_PER_WEEK
+        total = self.curve[index]
+        week = total[-1]
+        if week <= 0:
+            return ConsumptionForecaster.MAX_DAYS
+
+        storage += min(self.amount[index], total[0])
+        weeks = storage // week
+        remaining = storage - weeks * week
+
+        hour = min(int(total.searchsorted(remaining)), hours - 1)
+        before = total[hour - 1] if hour > 0 else 0.0
+        demand = total[hour] - before
+        fraction = (remaining - before) / demand if demand > 0 else 0.0
+        return min((weeks * hours + hour + fraction) / 24.0, ConsumptionForecaster.MAX_DAYS)
+
+    def save(self, path, count):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            numpy.savez(f, **dict((name, getattr(self, name)[:count]) for name in ConsumptionForecaster.ARRAYS))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+
+    def load(self, path, count):
+        """Restores saved forecasts for the beverages the file covers."""
+
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            saved = numpy.load(f)
+            known = min(count, len(saved['recent']))
+            for name in ConsumptionForecaster.ARRAYS:
+                getattr(self, name)[:known] = saved[name][:known]
+        self.curve_hour[:known] = -1
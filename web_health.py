@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+import threading
+import time
+
+
+class Health:
+    """
+    State of the external dependencies of an application. Each one is
+    brought up on its own background thread by start(), retried with
+    exponential backoff while it fails, so startup never waits on the
+    network and the health endpoints report what is still missing.
+    """
+
+    # retry delays in seconds, doubled after each failure
+    MIN_BACKOFF = 1.0
+    MAX_BACKOFF = 60.0
+
+    def __init__(self):
+        self.dependencies = {}
+        self.checks = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def set(self, name, state, detail=None):
+        with self.lock:
+            self.dependencies[name] = {'state': state, 'detail': detail, 'since': int(time.time() * 1000)}
+
+    def start(self, name, function, args=(), check=None):
+        """
+        Runs function(*args) in the background until it succeeds. check,
+        if given, later returns why a ready dependency is degraded, or
+        None while it is fine.
+        """
+
+        self.set(name, 'starting')
+        if check is not None:
+            self.checks[name] = check
+
+        thread = threading.Thread(target=self.run, args=(name, function, args), name='start-' + name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self, name, function, args):
+        backoff = Health.MIN_BACKOFF
+        while not self.stopped.is_set():
+            try:
+                function(*args)
+            except Exception as e:
+                print 'Starting ' + name + ' failed: ' + str(e)
+                self.set(name, 'failed', str(e) or e.__class__.__name__)
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, Health.MAX_BACKOFF)
+            else:
+                self.set(name, 'ready')
+                return
+
+    def ready(self, name):
+        with self.lock:
+            dependency = self.dependencies.get(name)
+            return dependency is not None and dependency['state'] == 'ready'
+
+    def report(self):
+        """
+        Returns each dependency and the overall status: 'starting' until
+        every dependency has been tried once, then 'ok' or 'degraded'.
+        """
+
+        with self.lock:
+            dependencies = dict((name, dict(dependency)) for name, dependency in self.dependencies.items())
+
+        for name, check in self.checks.items():
+            if dependencies[name]['state'] == 'ready':
+                detail = check()
+                if detail is not None:
+                    dependencies[name].update(state='degraded', detail=detail)
+
+        return {'status': overall(dependencies.values()), 'dependencies': dependencies}
+
+    def stop(self):
+        self.stopped.set()
+
+
+def overall(dependencies):
+    states = set(dependency['state'] for dependency in dependencies)
+    if 'starting' in states:
+        return 'starting'
+    if states - set(['ready']):
+        return 'degraded'
+    return 'ok'
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+import sqlite3
+import threading
+import time
+
+
+class DispenseHistory:
+    """
+    Local SQLite store of every dispensed event. Hourly and daily rollups
+    are updated in the same transaction as each insert, so usage queries
+    never have to scan the raw events.
+    """
+
+    HOUR_MS = 3600 * 1000
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS events (time INTEGER NOT NULL, beverage INTEGER NOT NULL, amount REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS events_by_time ON events (beverage, time)',
+        'CREATE TABLE IF NOT EXISTS hourly (beverage INTEGER NOT NULL, time INTEGER NOT NULL, amount REAL NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (beverage, time))',
+        'CREATE TABLE IF NOT EXISTS daily (beverage INTEGER NOT NULL, time INTEGER NOT NULL, amount REAL NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (beverage, time))'
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        # the connection is shared by the mqtt, scheduler and flask threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            for statement in DispenseHistory.SCHEMA:
+                self.db.execute(statement)
+
+    def hour_start(self, timestamp):
+        return timestamp - timestamp % DispenseHistory.HOUR_MS
+
+    def day_start(self, timestamp):
+        # rollup days follow local midnight like the nightly analysis
+        day = time.localtime(timestamp / 1000.0)
+        return int(time.mktime((day.tm_year, day.tm_mon, day.tm_mday, 0, 0, 0, 0, 0, -1)) * 1000)
+
+    def record(self, index, amount, timestamp=None):
+        """Stores a dispensed amount and folds it into the rollups."""
+
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT INTO events VALUES (?, ?, ?)', (timestamp, index, amount))
+                for table, bucket in (('hourly', self.hour_start(timestamp)), ('daily', self.day_start(timestamp))):
+                    self.db.execute('INSERT OR IGNORE INTO ' + table + ' VALUES (?, ?, 0.0, 0)', (index, bucket))
+                    self.db.execute('UPDATE ' + table + ' SET amount = amount + ?, count = count + 1 WHERE beverage = ? AND time = ?',
+                                    (amount, index, bucket))
+
+    def events(self, index, start, end=None):
+        """Returns (time, amount) of each dispensed event in [start, end)."""
+
+        if end is None:
+            end = int(time.time() * 1000) + 1
+
+        with self.lock:
+            cursor = self.db.execute('SELECT time, amount FROM events WHERE beverage = ? AND time >= ? AND time < ? ORDER BY time',
+                                     (index, start, end))
+            return cursor.fetchall()
+
+    def hourly_totals(self, index, limit):
+        return self.totals('hourly', index, limit)
+
+    def daily_totals(self, index, limit):
+        return self.totals('daily', index, limit)
+
+    def totals(self, table, index, limit):
+        """Returns the latest (time, amount, count) rollups, newest first."""
+
+        with self.lock:
+            cursor = self.db.execute('SELECT time, amount, count FROM ' + table + ' WHERE beverage = ? ORDER BY time DESC LIMIT ?',
+                                     (index, limit))
+            return cursor.fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
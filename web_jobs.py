@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from datetime import datetime, timedelta
+
+import sqlite3
+import threading
+import time
+import traceback
+
+
+class JobLog:
+    """
+    SQLite record of every scheduled job run, with the slot it ran for
+    and how long it took. The last completed slot of a job is what lets
+    a restarted application tell that a run was missed.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS runs (job TEXT NOT NULL, scheduled INTEGER NOT NULL, started INTEGER NOT NULL, '
+        'seconds REAL NOT NULL, ok INTEGER NOT NULL, error TEXT)',
+        'CREATE INDEX IF NOT EXISTS runs_by_job ON runs (job, scheduled)'
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        # the connection is shared by the scheduler and flask threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            for statement in JobLog.SCHEMA:
+                self.db.execute(statement)
+
+    def record(self, job, scheduled, started, seconds, error=None):
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                                (job, scheduled, started, seconds, error is None, error))
+
+    def last_completed(self, job):
+        """Returns the latest slot the job finished successfully, or None."""
+
+        with self.lock:
+            cursor = self.db.execute('SELECT MAX(scheduled) FROM runs WHERE job = ? AND ok', (job,))
+            return cursor.fetchone()[0]
+
+    def recent(self, job, limit):
+        with self.lock:
+            cursor = self.db.execute('SELECT scheduled, started, seconds, ok, error FROM runs WHERE job = ? '
+                                     'ORDER BY started DESC LIMIT ?', (job, limit))
+            return [{'scheduled': scheduled, 'started': started, 'seconds': seconds, 'ok': bool(ok), 'error': error}
+                    for scheduled, started, seconds, ok, error in cursor.fetchall()]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class JobEngine:
+    """
+    One long-lived scheduler for the application's recurring jobs. Runs
+    are recorded in a JobLog, and a daily job whose latest slot passed
+    while the application was down is run once when it is added, so a
+    restart around midnight no longer skips the day.
+    """
+
+    # runs kept in the stats of each job
+    RECENT_RUNS = 10
+
+    def __init__(self, log_path):
+        self.log = JobLog(log_path)
+        self.jobs = {}
+
+        # overlapping runs of a job are merged into one, and a late run
+        # still goes ahead however late it is
+        self.sched = BackgroundScheduler(job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': None})
+        self.sched.start()
+
+    def last_slot(self, hour, minute, now=None):
+        """The most recent run time at or before now, of an hourly job when hour is None."""
+
+        if now is None:
+            now = datetime.now()
+        if hour is None:
+            slot = datetime(now.year, now.month, now.day, now.hour, minute)
+            if slot > now:
+                slot -= timedelta(hours=1)
+            return slot
+        slot = datetime(now.year, now.month, now.day, hour, minute)
+        if slot > now:
+            slot -= timedelta(days=1)
+        return slot
+
+    def add_daily(self, name, function, hour=0, minute=0):
+        self.jobs[name] = (function, hour, minute)
+        self.sched.add_job(self.run, 'cron', args=[name], hour=hour, minute=minute, id=name, replace_existing=True)
+
+        last = self.log.last_completed(name)
+        slot = self.last_slot(hour, minute)
+        if last is not None and last < self.timestamp(slot):
+            print 'Catching up on ' + name + ' missed at ' + str(slot)
+            self.sched.add_job(self.run, args=[name, slot], id=name + '-catch-up', replace_existing=True)
+
+    def add_hourly(self, name, function, minute=0):
+        # missed hours are not caught up, the next run covers them
+        self.jobs[name] = (function, None, minute)
+        self.sched.add_job(self.run, 'cron', args=[name], minute=minute, id=name, replace_existing=True)
+
+    def timestamp(self, slot):
+        return int(time.mktime(slot.timetuple()) * 1000)
+
+    def run(self, name, slot=None):
+        function, hour, minute = self.jobs[name]
+        if slot is None:
+            slot = self.last_slot(hour, minute)
+
+        started = time.time()
+        error = None
+        try:
+            function()
+        except Exception as e:
+            traceback.print_exc()
+            error = str(e)
+        finally:
+            self.log.record(name, self.timestamp(slot), int(started * 1000), time.time() - started, error)
+
+    def stats(self):
+        data = {}
+        for name in self.jobs:
+            job = self.sched.get_job(name)
+            data[name] = {
+                'next_run': str(job.next_run_time) if job is not None else None,
+                'runs': self.log.recent(name, JobEngine.RECENT_RUNS)
+            }
+        return data
+
+    def shutdown(self):
+        self.sched.shutdown()
+        self.log.close()
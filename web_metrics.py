@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+import bisect
+import threading
+import time
+
+
+# seconds, from a fast disk append up to a stalled network call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            samples = [(self.name, zip(self.labels, key), value) for key, value in self.values.items()]
+        return (self.name, 'counter', self.help, samples)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets. An observation is one bisect
+    and a few additions under an uncontended lock, cheap enough for every
+    event and request; buckets are only made cumulative when collected.
+    """
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+
+        # per label values: [count per bucket plus +Inf, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, label_values=()):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            value = self.values.get(label_values)
+            if value is None:
+                value = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            value[0][slot] += 1
+            value[1] += seconds
+
+    def time(self, label_values=()):
+        return HistogramTimer(self, label_values)
+
+    def collect(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+
+        samples = []
+        for key, counts, total in values:
+            labels = zip(self.labels, key)
+            count = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                count += bucket
+                samples.append((self.name + '_bucket', labels + [('le', format_value(bound))], count))
+            samples.append((self.name + '_count', labels, count))
+            samples.append((self.name + '_sum', labels, total))
+        return (self.name, 'histogram', self.help, samples)
+
+
+class HistogramTimer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, self.label_values)
+
+
+class Sampled:
+    """
+    Counter or gauge read from existing state when collected, e.g. queue
+    depths or counts the pipeline already keeps. function returns a value,
+    or a list of (label values, value) when labels are given.
+    """
+
+    def __init__(self, name, type, help, function, labels=()):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.function = function
+        self.labels = labels
+
+    def collect(self):
+        value = self.function()
+        if self.labels:
+            samples = [(self.name, zip(self.labels, key), sample) for key, sample in value]
+        else:
+            samples = [(self.name, [], value)]
+        return (self.name, self.type, self.help, samples)
+
+
+class MetricsRegistry:
+    """The metrics of one process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # registering a name again replaces it, e.g. a restarted component
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def sampled(self, name, type, help, function, labels=()):
+        return self.register(Sampled(name, type, help, function, labels))
+
+    def collect(self):
+        """Returns (name, type, help, samples) of every metric, picklable for other processes."""
+
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        return [metric.collect() for metric in metrics]
+
+
+def label_families(families, name, value):
+    """Adds a label to every sample, e.g. the venue a partition serves."""
+
+    return [(family, type, help, [(sample, [(name, value)] + labels, sample_value)
+                                  for sample, labels, sample_value in samples])
+            for family, type, help, samples in families]
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(families):
+    """Prometheus text exposition of families, merging those sharing a name."""
+
+    merged = {}
+    order = []
+    for name, type, help, samples in families:
+        if name not in merged:
+            merged[name] = (type, help, [])
+            order.append(name)
+        merged[name][2].extend(samples)
+
+    lines = []
+    for name in order:
+        type, help, samples = merged[name]
+        lines.append('# HELP ' + name + ' ' + help)
+        lines.append('# TYPE ' + name + ' ' + type)
+        for sample, labels, value in samples:
+            if labels:
+                text = ','.join(key + '="' + str(label).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                                for key, label in labels)
+                sample += '{' + text + '}'
+            lines.append(sample + ' ' + format_value(value))
+    return '\n'.join(lines) + '\n'
+
+
+# metrics of this process, shared by its modules
+registry = MetricsRegistry()
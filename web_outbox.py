@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+import json
+import os
+import threading
+import uuid
+
+
+class CloudantOutbox:
+    """
+    On-disk queue of documents waiting to be written to Cloudant. post()
+    returns as soon as a document is safely on disk; a background thread
+    sends everything pending through the bulk API and retries with
+    exponential backoff while Cloudant is unreachable.
+    """
+
+    # seconds to collect further documents before a bulk write
+    BATCH_DELAY = 0.5
+
+    # most documents sent in one bulk request
+    BATCH_SIZE = 100
+
+    # retry delays in seconds, doubled after each failure
+    MIN_BACKOFF = 1.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, connector, path):
+        self.connector = connector
+        self.path = path
+
+        self.pending = []
+        self.condition = threading.Condition()
+        self.running = True
+        self.backoff = CloudantOutbox.MIN_BACKOFF
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.pending.append(json.loads(line))
+                    except ValueError:
+                        # a torn final line from a crash mid-write
+                        break
+
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def post(self, data):
+        self.post_many([data])
+
+    def post_many(self, documents):
+        """Queues documents for Cloudant without waiting on the network."""
+
+        with self.condition:
+            with open(self.path, 'a') as f:
+                for document in documents:
+                    document = dict(document)
+                    # a fixed id lets a retried write be recognised as a duplicate
+                    document.setdefault('_id', uuid.uuid4().hex)
+                    f.write(json.dumps(document) + '\n')
+                    self.pending.append(document)
+                f.flush()
+                os.fsync(f.fileno())
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.pending) == 0:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                self.condition.wait(CloudantOutbox.BATCH_DELAY)
+                batch = self.pending[:CloudantOutbox.BATCH_SIZE]
+
+            if self.send(batch):
+                self.backoff = CloudantOutbox.MIN_BACKOFF
+                with self.condition:
+                    self.pending = self.pending[len(batch):]
+                    self.rewrite()
+            else:
+                with self.condition:
+                    self.condition.wait(self.backoff)
+                self.backoff = min(self.backoff * 2, CloudantOutbox.MAX_BACKOFF)
+
+    def send(self, batch):
+        try:
+            response = self.connector.post_bulk(batch)
+        except Exception as e:
+            print 'Cloudant write failed:', e
+            return False
+
+        if response.status_code not in (200, 201, 202):
+            print 'Cloudant write failed:', response.status_code
+            return False
+
+        # a conflict means an earlier attempt already stored the document
+        for result in response.json():
+            if 'error' in result and result['error'] != 'conflict':
+                print 'Cloudant rejected document', result.get('id'), result['error']
+        return True
+
+    def rewrite(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for document in self.pending:
+                f.write(json.dumps(document) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.path)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+
+from transport import persistent_session, qos
+from web_app import MonitorApplication
+from web_feed import BeverageFeed
+from web_health import Health, overall
+from web_metrics import registry, label_families
+
+import ConfigParser
+import ibmiotf.application
+import itertools
+import multiprocessing
+import os
+import Queue
+import threading
+import traceback
+import wire
+
+
+# device events from devices no venue owns
+UNROUTED = registry.counter('partition_events_unrouted_total', 'Device events from devices no venue owns.')
+OVERFLOWED = registry.counter('partition_events_dropped_total', 'Device events dropped as their partition fell behind.', ('venue',))
+
+
+class PartitionClient:
+    """
+    The ibmiotf application client seen by a partition. Publishes and
+    commands are passed to the routing process, which owns the broker
+    connection.
+    """
+
+    def __init__(self, venue, outbound):
+        self.venue = venue
+        self.outbound = outbound
+        self.deviceEventCallback = None
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribeToDeviceEvents(self, **kwargs):
+        return True
+
+    def publishEvent(self, *args, **kwargs):
+        self.outbound.put(('publish', self.venue, args, kwargs))
+        return True
+
+    def publishCommand(self, *args, **kwargs):
+        self.outbound.put(('command', self.venue, args, kwargs))
+        return True
+
+
+class PartitionEvent:
+    def __init__(self, event, payload, format, deviceId):
+        self.event = event
+        self.payload = payload
+        self.format = format
+        self.deviceId = deviceId
+
+
+def run_partition(venue, options, iot_config, inbound, outbound):
+    """Owns the Monitor of one venue, run in its own process."""
+
+    data_dir = options['data_dir']
+    monitor_config = os.path.join(data_dir, os.path.basename(MonitorApplication.UPDATE_CONFIG_PATH))
+    if not os.path.exists(monitor_config):
+        monitor_config = options['monitor_config']
+
+    client = PartitionClient(venue, outbound)
+    app = MonitorApplication(monitor_config, iot_config, client=client, venue=venue, data_dir=data_dir,
+                             device_prefix=options['device_prefix'], status_device=options['status_device'])
+
+    # mirror the beverage feed to the dashboards served by the router
+    outbound.put(('reset', venue, app.get_all_beverages()))
+    app.feed.observers.append(lambda index, data: outbound.put(('feed', venue, index, dict(data))))
+    app.add_state_observer(lambda venue: outbound.put(('changed', venue)))
+
+    try:
+        while True:
+            message = inbound.get()
+            if message[0] == 'event':
+                client.deviceEventCallback(PartitionEvent(*message[1:]))
+            elif message[0] == 'call':
+                request, method, args = message[1:]
+                try:
+                    outbound.put(('reply', request, True, getattr(app, method)(*args)))
+                except Exception as e:
+                    traceback.print_exc()
+                    outbound.put(('reply', request, False, str(e)))
+            elif message[0] == 'stop':
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        app.disconnect()
+
+
+class PartitionedMonitor:
+    """
+    Runs one MonitorApplication per venue in separate worker processes.
+    This process owns the broker connection, routes each device event to
+    the venue that owns the device, forwards the partitions' publishes
+    and serves their state to the Flask API through partition(venue).
+    """
+
+    # seconds a request to a partition may take
+    CALL_TIMEOUT = 30.0
+
+    # seconds a partition may take to report its health
+    HEALTH_TIMEOUT = 2.0
+
+    # events queued per partition before routing drops them, the broker
+    # thread never waits on a slow venue
+    INBOUND_SIZE = 1024
+
+    EVENTS = MonitorApplication.DEVICE_EVENTS
+
+    def __init__(self, venues_config, iot_config, client=None):
+        self.venues = []
+        self.options = {}
+        self.devices = {}
+        self.partitions = {}
+        self.feeds = {}
+        self.state_observers = []
+
+        self.requests = itertools.count()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        self.configure_venues(venues_config)
+
+        # partitions are forked before any broker threads exist
+        self.outbound = multiprocessing.Queue()
+        for venue in self.venues:
+            inbound = multiprocessing.Queue(PartitionedMonitor.INBOUND_SIZE)
+            process = multiprocessing.Process(target=run_partition, name='partition-' + venue,
+                                              args=(venue, self.options[venue], iot_config, inbound, self.outbound))
+            process.daemon = True
+            process.start()
+            self.partitions[venue] = (process, inbound)
+            self.feeds[venue] = BeverageFeed()
+
+        self.forwarder = threading.Thread(target=self.forward, name='partition-forward')
+        self.forwarder.daemon = True
+        self.forwarder.start()
+
+        registry.sampled('partition_inbound_queue_depth', 'gauge', 'Device events waiting for each partition.',
+                         lambda: [((venue,), self.partitions[venue][1].qsize()) for venue in self.venues], ('venue',))
+
+        # the broker connection comes up in the background, publishes
+        # from the partitions are dropped until it has
+        self.client = client
+        self.connected = False
+        self.health = Health()
+        self.health.start('iot', self.configure_iot, (iot_config,))
+
+    def configure_iot(self, iot_config):
+        if self.client is None:
+            options = persistent_session(ibmiotf.application.ParseConfigFile(iot_config))
+            client = wire.register(ibmiotf.application.Client(options))
+            client.connect()
+            self.client = client
+
+        self.client.deviceEventCallback = self.route
+        for event in PartitionedMonitor.EVENTS:
+            self.client.subscribeToDeviceEvents(event=event, qos=qos(event))
+        self.connected = True
+
+    def configure_venues(self, config):
+        parser = ConfigParser.ConfigParser()
+        with open(config) as f:
+            parser.readfp(f)
+
+        for section in parser.sections():
+            if not section.startswith('venue '):
+                continue
+            venue = section[len('venue '):].strip()
+
+            options = {
+                'monitor_config': parser.get(section, 'monitor_config'),
+                'data_dir': parser.get(section, 'data_dir'),
+                'device_prefix': parser.get(section, 'device_prefix'),
+                'status_device': parser.get(section, 'status_device')
+            }
+            if not os.path.isdir(options['data_dir']):
+                os.makedirs(options['data_dir'])
+
+            self.venues.append(venue)
+            self.options[venue] = options
+            self.devices[options['status_device']] = venue
+
+    def owner(self, deviceId):
+        """Returns the venue owning a device, by status id or dispenser prefix."""
+
+        if deviceId in self.devices:
+            return self.devices[deviceId]
+        for venue in self.venues:
+            prefix = self.options[venue]['device_prefix']
+            if deviceId.startswith(prefix) and deviceId[len(prefix):].isdigit():
+                return venue
+        return None
+
+    def route(self, event):
+        venue = self.owner(event.deviceId)
+        if venue is None:
+            UNROUTED.inc()
+            print 'Ignoring ' + event.event + ' event from unknown device ' + event.deviceId
+            return
+        try:
+            self.partitions[venue][1].put_nowait(('event', event.event, event.payload, event.format, event.deviceId))
+        except Queue.Full:
+            OVERFLOWED.inc((venue,))
+            print 'Dropped ' + event.event + ' event for ' + venue + ', partition is full'
+
+    def forward(self):
+        while True:
+            message = self.outbound.get()
+            try:
+                if message[0] in ('publish', 'command') and not self.connected:
+                    print 'Dropped ' + message[0] + ' from ' + message[1] + ', not connected to the broker'
+                elif message[0] == 'publish':
+                    venue, args, kwargs = message[1:]
+                    # tag web events so subscribers can tell venues apart
+                    args[4]['venue'] = venue
+                    self.client.publishEvent(*args, **kwargs)
+                elif message[0] == 'command':
+                    self.client.publishCommand(*message[2], **message[3])
+                elif message[0] == 'feed':
+                    venue, index, data = message[1:]
+                    self.feeds[venue].publish(index, data)
+                elif message[0] == 'reset':
+                    venue, beverages = message[1:]
+                    self.feeds[venue].reset(beverages)
+                elif message[0] == 'changed':
+                    for observer in self.state_observers:
+                        observer(message[1])
+                elif message[0] == 'reply':
+                    request, ok, value = message[1:]
+                    with self.pending_lock:
+                        reply = self.pending.pop(request, None)
+                    if reply is not None:
+                        reply[1] = ok
+                        reply[2] = value
+                        reply[0].set()
+            except Exception:
+                traceback.print_exc()
+
+    def call(self, venue, method, *args):
+        return self.request(venue, method, args, PartitionedMonitor.CALL_TIMEOUT)
+
+    def request(self, venue, method, args, timeout):
+        request = next(self.requests)
+        reply = [threading.Event(), None, None]
+        with self.pending_lock:
+            self.pending[request] = reply
+
+        self.partitions[venue][1].put(('call', request, method, args))
+        if not reply[0].wait(timeout):
+            with self.pending_lock:
+                self.pending.pop(request, None)
+            raise RuntimeError('venue ' + venue + ' did not answer ' + method)
+        if not reply[1]:
+            raise RuntimeError(reply[2])
+        return reply[2]
+
+    def partition(self, venue=None):
+        if venue is None:
+            venue = self.venues[0]
+        if venue not in self.partitions:
+            raise KeyError('unknown venue ' + venue)
+        return Partition(self, venue)
+
+    def add_state_observer(self, observer):
+        """Calls observer(venue) whenever a partition's new state is visible to readers."""
+
+        self.state_observers.append(observer)
+
+    def metric_families(self):
+        """Metrics of this process and of every partition, labelled by venue."""
+
+        families = registry.collect()
+        for venue in self.venues:
+            try:
+                families += label_families(self.call(venue, 'metric_families'), 'venue', venue)
+            except RuntimeError:
+                traceback.print_exc()
+        return families
+
+    def get_health(self):
+        """Health of the broker connection here and of every partition's dependencies."""
+
+        report = self.health.report()
+        for venue in self.venues:
+            name = 'venue ' + venue
+            try:
+                partition = self.request(venue, 'get_health', (), PartitionedMonitor.HEALTH_TIMEOUT)
+            except RuntimeError as e:
+                report['dependencies'][name] = {'state': 'failed', 'detail': str(e)}
+            else:
+                state = {'ok': 'ready'}.get(partition['status'], partition['status'])
+                report['dependencies'][name] = {'state': state, 'dependencies': partition['dependencies']}
+        report['status'] = overall(report['dependencies'].values())
+        return report
+
+    def disconnect(self):
+        self.health.stop()
+        for venue, (process, inbound) in self.partitions.items():
+            inbound.put(('stop',))
+        for venue, (process, inbound) in self.partitions.items():
+            process.join(10.0)
+        if self.client is not None:
+            self.client.disconnect()
+
+
+class Partition:
+    """The MonitorApplication interface of one venue, served by its process."""
+
+    PROXIED = ('update_system', 'update_beverage', 'toggle_device_connection', 'update_order_analysis',
+               'update_beverage_analysis', 'switch_auto_update', 'get_snapshot', 'get_system_info',
+               'get_all_beverages', 'get_all_weekly_totals', 'get_pipeline_stats', 'get_job_stats', 'get_health')
+
+    def __init__(self, router, venue):
+        self.router = router
+        self.venue = venue
+        self.feed = router.feeds[venue]
+
+    def __getattr__(self, name):
+        if name not in Partition.PROXIED:
+            raise AttributeError(name)
+        return lambda *args: self.router.call(self.venue, name, *args)
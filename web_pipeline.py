@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+import Queue
+import threading
+import traceback
+
+
+class EventPipeline:
+    """
+    Moves device events off the MQTT network thread. ingest() only puts
+    the raw message on a bounded queue; a dispatcher thread hands each
+    message to process in arrival order, and slow side effects such as
+    publishing and disk writes are emitted onto ordered lanes so that
+    everything for one key (a beverage) happens in sequence.
+    """
+
+    # raw messages held before the network thread has to wait
+    INGEST_SIZE = 1024
+
+    # seconds the network thread waits on a full queue before dropping
+    INGEST_TIMEOUT = 1.0
+
+    # side effects held per lane before the producer has to wait
+    LANE_SIZE = 1024
+
+    LANES = 4
+
+    def __init__(self, process, lanes=LANES):
+        self.process = process
+
+        self.ingest_queue = Queue.Queue(EventPipeline.INGEST_SIZE)
+        self.lanes = [Queue.Queue(EventPipeline.LANE_SIZE) for i in range(lanes)]
+
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+
+        self.threads = [threading.Thread(target=self.dispatch, name='event-dispatch')]
+        for number, lane in enumerate(self.lanes):
+            self.threads.append(threading.Thread(target=self.drain, args=(lane,), name='event-lane-' + str(number)))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def ingest(self, event, payload, format='json', device=None):
+        """Queues a raw device event, called on the MQTT network thread."""
+
+        self.received += 1
+        try:
+            self.ingest_queue.put((event, payload, format, device), timeout=EventPipeline.INGEST_TIMEOUT)
+        except Queue.Full:
+            self.dropped += 1
+            print 'Dropped ' + event + ' event, pipeline is full'
+
+    def dispatch(self):
+        while True:
+            item = self.ingest_queue.get()
+            if item is None:
+                return
+            try:
+                self.process(*item)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                traceback.print_exc()
+
+    def emit(self, key, function, *args):
+        """Runs function on the lane owning key, after earlier work for that key."""
+
+        lane = self.lanes[hash(key) % len(self.lanes)]
+        lane.put((function, args))
+
+    def drain(self, lane):
+        while True:
+            item = lane.get()
+            if item is None:
+                return
+            function, args = item
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'failed': self.failed,
+            'ingest_depth': self.ingest_queue.qsize(),
+            'lane_depths': [lane.qsize() for lane in self.lanes]
+        }
+
+    def stop(self, timeout=5.0):
+        """Lets queued work finish, then stops the pipeline threads."""
+
+        self.ingest_queue.put(None)
+        self.threads[0].join(timeout)
+        for lane in self.lanes:
+            lane.put(None)
+        for thread in self.threads[1:]:
+            thread.join(timeout)
@@ -0,0 +1,463 @@
+#!/usr/bin/python
+
+from web_feed import BeverageFeed
+from web_metrics import registry, label_families
+from web_partition import Partition
+from werkzeug.serving import make_server
+
+import functools
+import itertools
+import mmap
+import multiprocessing
+import os
+import Queue
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+
+class SharedSnapshots:
+    """
+    Encoded API snapshots in shared memory, written by the state owner
+    and read by every HTTP worker without a round trip to it. Each slot
+    starts with a sequence number that is odd while the owner writes, so
+    a reader that sees it move retries rather than keep a torn copy. The
+    sequence alone needs the stores to land in order, which weakly ordered
+    CPUs such as the Pi's ARM cores do not promise without a barrier, so
+    the header also holds a checksum of the data that readers verify.
+    """
+
+    SLOTS = 16
+    SLOT_SIZE = 256 * 1024
+
+    # sequence, key, the lengths of the etag, body and gzipped body, and their crc32
+    HEADER = struct.Struct('<Q64sIIIi')
+    SEQUENCE = struct.Struct('<Q')
+
+    # reads that race a write before the caller asks the owner instead
+    RETRIES = 10
+
+    def __init__(self, slots=SLOTS, slot_size=SLOT_SIZE):
+        self.slots = slots
+        self.slot_size = slot_size
+
+        # anonymous shared memory, inherited by the forked workers
+        self.map = mmap.mmap(-1, slots * slot_size)
+
+        # slot of each key, assigned by the owner and found by the workers
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def write(self, key, etag, body, gzipped):
+        """Stores a snapshot, or marks it missing when it is too big for a slot."""
+
+        with self.lock:
+            slot = self.index.get(key)
+            if slot is None:
+                slot = len(self.index)
+                if slot == self.slots:
+                    return False
+                self.index[key] = slot
+
+            size = len(etag) + len(body) + len(gzipped)
+            if SharedSnapshots.HEADER.size + size > self.slot_size:
+                etag = body = gzipped = ''
+
+            data = etag + body + gzipped
+            offset = slot * self.slot_size
+            sequence = SharedSnapshots.SEQUENCE.unpack_from(self.map, offset)[0]
+            SharedSnapshots.SEQUENCE.pack_into(self.map, offset, sequence + 1)
+            SharedSnapshots.HEADER.pack_into(self.map, offset, sequence + 1, key, len(etag), len(body), len(gzipped),
+                                             zlib.crc32(data))
+            start = offset + SharedSnapshots.HEADER.size
+            self.map[start:start + len(data)] = data
+            SharedSnapshots.SEQUENCE.pack_into(self.map, offset, sequence + 2)
+            return bool(etag)
+
+    def find(self, key):
+        for slot in range(self.slots):
+            stored = SharedSnapshots.HEADER.unpack_from(self.map, slot * self.slot_size)[1].rstrip('\0')
+            if stored == key:
+                self.index[key] = slot
+                return slot
+            if not stored:
+                return None
+        return None
+
+    def read(self, key):
+        """Returns (etag, body, gzipped), or None when there is no consistent copy."""
+
+        slot = self.index.get(key)
+        if slot is None:
+            slot = self.find(key)
+            if slot is None:
+                return None
+
+        offset = slot * self.slot_size
+        start = offset + SharedSnapshots.HEADER.size
+        for attempt in range(SharedSnapshots.RETRIES):
+            sequence, stored, etag, body, gzipped, crc = SharedSnapshots.HEADER.unpack_from(self.map, offset)
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            data = self.map[start:start + etag + body + gzipped]
+            # a matching checksum rules out data stored after the sequence was read
+            if SharedSnapshots.SEQUENCE.unpack_from(self.map, offset)[0] == sequence and zlib.crc32(data) == crc:
+                if not etag:
+                    return None
+                return data[:etag], data[etag:etag + body], data[etag + body:]
+        return None
+
+
+def snapshot_key(venue, name):
+    # venues named by a request arrive as unicode, slot keys are bytes
+    return ((venue or '') + '/' + name).encode('utf-8')
+
+
+class ServingPool:
+    """
+    Serves the Flask app from several worker processes sharing one
+    listening socket. The workers are forked before the monitor exists,
+    and the parent process then builds it and becomes the state owner:
+    it alone holds the broker connection, the scheduler and the data
+    files. Snapshots are published to the workers through shared memory
+    whenever a venue's state changes and beverage feeds are mirrored into
+    each of them, every other call is forwarded to the owner and answered
+    on the worker's own queue. The owner answers each venue's calls on its
+    own lane, so a venue waiting on Cloudant or its state writer never
+    holds up the others.
+    """
+
+    # seconds a burst of changes is gathered into one publish
+    PUBLISH_INTERVAL = 0.02
+
+    # owner threads answering the forwarded calls of each venue, and of the monitor
+    LANE_THREADS = 2
+
+    SNAPSHOTS = ('beverage', 'system')
+
+    def __init__(self, workers, host, port):
+        self.workers = workers
+        self.host = host
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(128)
+
+        self.snapshots = SharedSnapshots()
+        self.requests = multiprocessing.Queue()
+        self.replies = [multiprocessing.Queue() for index in range(workers)]
+
+        self.owner = os.getpid()
+        # worker index of each live worker process
+        self.pids = {}
+        self.index = None
+        self.worker_metrics = {}
+        self.etags = {}
+        self.stopped = threading.Event()
+
+        # venues whose state changed since their snapshots were published
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.publish_lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def start(self, create_monitor):
+        """
+        Forks the workers. Returns a WorkerMonitor in each worker, and in
+        the owner the monitor made by create_monitor.
+        """
+
+        for index in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.index = index
+                self.monitor = WorkerMonitor(self, index)
+                return self.monitor
+            self.pids[pid] = index
+
+        self.monitor = create_monitor()
+        self.venues = getattr(self.monitor, 'venues', [None])
+
+        for venue in self.venues:
+            self.monitor.partition(venue).feed.observers.append(functools.partial(self.mirror, venue))
+        self.monitor.add_state_observer(self.changed)
+
+        self.lanes = {}
+        for number, key in enumerate([('venue', venue) for venue in self.venues] + [('monitor', None)]):
+            self.lanes[key] = Queue.Queue()
+            for thread_number in range(ServingPool.LANE_THREADS):
+                thread = threading.Thread(target=self.answer, args=(self.lanes[key],),
+                                          name='serving-owner-' + str(number) + '-' + str(thread_number))
+                thread.daemon = True
+                thread.start()
+
+        router = threading.Thread(target=self.route, name='serving-router')
+        router.daemon = True
+        router.start()
+
+        publisher = threading.Thread(target=self.publish_loop, name='serving-publisher')
+        publisher.daemon = True
+        publisher.start()
+        return self.monitor
+
+    def broadcast(self, message):
+        for replies in self.replies:
+            if replies is not None:
+                replies.put(message)
+
+    def mirror(self, venue, index, data):
+        self.broadcast(('feed', venue, index, dict(data)))
+
+    def changed(self, venue):
+        with self.lock:
+            self.dirty.add(venue)
+        self.wake.set()
+
+    def publish(self, venue):
+        for name in ServingPool.SNAPSHOTS:
+            snapshot = self.monitor.partition(venue).get_snapshot(name)
+            key = snapshot_key(venue, name)
+            if self.etags.get(key) != snapshot[0]:
+                self.etags[key] = snapshot[0]
+                self.snapshots.write(key, *snapshot)
+
+    def publish_changed(self, venues=None):
+        """Publishes the snapshots of the changed venues, of all or those given."""
+
+        # one publisher at a time, so an older snapshot never overwrites a newer one
+        with self.publish_lock:
+            with self.lock:
+                if venues is None:
+                    venues = list(self.dirty)
+                else:
+                    venues = [venue for venue in venues if venue in self.dirty]
+                self.dirty.difference_update(venues)
+            for venue in venues:
+                self.publish(venue)
+
+    def publish_loop(self):
+        # workers learn the venues and their beverages once the monitor is up
+        for venue in self.venues:
+            self.broadcast(('reset', venue, self.monitor.partition(venue).get_all_beverages()))
+            self.changed(venue)
+        self.broadcast(('venues', self.venues))
+
+        while not self.stopped.is_set():
+            # a timeout keeps the loop responsive to stopped
+            if not self.wake.wait(1.0):
+                continue
+            self.stopped.wait(ServingPool.PUBLISH_INTERVAL)
+            self.wake.clear()
+            try:
+                self.publish_changed()
+            except Exception:
+                traceback.print_exc()
+
+    def route(self):
+        """Hands each forwarded call to the lane of its venue."""
+
+        while True:
+            try:
+                message = self.requests.get()
+            except (EOFError, IOError):
+                # multiprocessing closes the queue at exit
+                return
+            if message[0] == 'metrics':
+                self.worker_metrics[message[1]] = message[2]
+                continue
+
+            kind, venue = message[0], message[3]
+            self.lanes.get((kind, venue), self.lanes[('monitor', None)]).put(message)
+
+    def answer(self, lane):
+        while True:
+            kind, worker, request, venue, method, args = lane.get()
+            try:
+                if kind == 'monitor' and method == 'metric_families':
+                    value = self.metric_families()
+                elif kind == 'monitor':
+                    value = getattr(self.monitor, method)(*args)
+                else:
+                    value = getattr(self.monitor.partition(venue), method)(*args)
+                reply = ('reply', request, True, value)
+            except Exception as e:
+                traceback.print_exc()
+                reply = ('reply', request, False, str(e))
+
+            if kind != 'monitor':
+                # a worker reading right after its own change sees it
+                try:
+                    self.publish_changed([venue])
+                except Exception:
+                    traceback.print_exc()
+            replies = self.replies[worker]
+            if replies is not None:
+                replies.put(reply)
+
+    def metric_families(self):
+        """The monitor's metrics and the latest reported by each worker, labelled by worker."""
+
+        families = self.monitor.metric_families()
+        for index, worker in sorted(self.worker_metrics.items()):
+            families += label_families(worker, 'worker', str(index))
+        return families
+
+    def serve(self, app):
+        """Serves requests in a worker, or waits for the workers in the owner."""
+
+        if self.index is not None:
+            server = make_server(self.host, 0, app, threaded=True, fd=self.socket.fileno())
+            server.serve_forever()
+            return
+
+        # a stopped owner takes its workers with it, and stops once they are all gone
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while self.pids:
+                pid, status = os.wait()
+                if pid in self.pids:
+                    self.retire(self.pids.pop(pid))
+                    print 'Worker ' + str(pid) + ' exited with status ' + str(status) + ', ' + str(len(self.pids)) + ' left'
+        finally:
+            self.stopped.set()
+            for pid in self.pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def retire(self, index):
+        """
+        Stops sending to a worker that exited. Nothing reads its queue any
+        more, so messages put on it would pile up in this process.
+        """
+
+        replies = self.replies[index]
+        self.replies[index] = None
+        # its feeder thread may be stuck on a full pipe, do not wait for it at exit
+        replies.cancel_join_thread()
+
+
+class WorkerMonitor:
+    """
+    The monitor as seen from an HTTP worker process. Snapshots are read
+    from shared memory and feeds are mirrored from the owner; every other
+    call goes to the owner, like a PartitionedMonitor's to its venues.
+    """
+
+    CALL_TIMEOUT = 30.0
+
+    # seconds between reports of this worker's metrics to the owner
+    METRICS_INTERVAL = 5.0
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.venues = []
+        self.feeds = {}
+        self.ready = threading.Event()
+
+        self.requests = itertools.count()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        for target, name in ((self.receive, 'serving-receive'), (self.report, 'serving-metrics')):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+
+    def receive(self):
+        replies = self.pool.replies[self.index]
+        while True:
+            try:
+                message = replies.get(timeout=1.0)
+            except Queue.Empty:
+                if os.getppid() != self.pool.owner:
+                    # the owner is gone, nothing here can be answered
+                    os._exit(1)
+                continue
+
+            try:
+                if message[0] == 'reply':
+                    request, ok, value = message[1:]
+                    with self.pending_lock:
+                        reply = self.pending.pop(request, None)
+                    if reply is not None:
+                        reply[1] = ok
+                        reply[2] = value
+                        reply[0].set()
+                elif message[0] == 'feed':
+                    venue, index, data = message[1:]
+                    self.feed(venue).publish(index, data)
+                elif message[0] == 'reset':
+                    venue, beverages = message[1:]
+                    self.feed(venue).reset(beverages)
+                elif message[0] == 'venues':
+                    self.venues = message[1]
+                    self.ready.set()
+            except Exception:
+                traceback.print_exc()
+
+    def report(self):
+        while True:
+            time.sleep(WorkerMonitor.METRICS_INTERVAL)
+            self.pool.requests.put(('metrics', self.index, registry.collect()))
+
+    def feed(self, venue):
+        if venue not in self.feeds:
+            self.feeds[venue] = BeverageFeed()
+        return self.feeds[venue]
+
+    def request(self, kind, venue, method, args):
+        request = next(self.requests)
+        reply = [threading.Event(), None, None]
+        with self.pending_lock:
+            self.pending[request] = reply
+
+        self.pool.requests.put((kind, self.index, request, venue, method, args))
+        if not reply[0].wait(WorkerMonitor.CALL_TIMEOUT):
+            with self.pending_lock:
+                self.pending.pop(request, None)
+            raise RuntimeError('the state owner did not answer ' + method)
+        if not reply[1]:
+            raise RuntimeError(reply[2])
+        return reply[2]
+
+    def call(self, venue, method, *args):
+        return self.request('venue', venue, method, args)
+
+    def partition(self, venue=None):
+        if not self.ready.wait(WorkerMonitor.CALL_TIMEOUT):
+            raise RuntimeError('the state owner has not started')
+        if venue is None:
+            venue = self.venues[0]
+        if venue not in self.venues:
+            raise KeyError('unknown venue ' + venue)
+        self.feed(venue)
+        return WorkerPartition(self, venue)
+
+    def metric_families(self):
+        return self.request('monitor', None, 'metric_families', ())
+
+    def get_health(self):
+        return self.request('monitor', None, 'get_health', ())
+
+    def disconnect(self):
+        pass
+
+
+class WorkerPartition(Partition):
+    """A venue served by the owner, with its snapshots read from shared memory."""
+
+    def get_snapshot(self, name):
+        snapshot = self.router.pool.snapshots.read(snapshot_key(self.venue, name))
+        if snapshot is None:
+            return self.router.call(self.venue, 'get_snapshot', name)
+        return snapshot
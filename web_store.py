@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+import ConfigParser
+import json
+import os
+import threading
+
+
+class StateStore:
+    """
+    Write-behind persistence for monitor state. Changed values are
+    appended to a journal as they happen and folded into an atomically
+    replaced config snapshot after a quiet period, so restarting from the
+    snapshot plus the journal recovers the latest state. Journal writes
+    are synced to disk together once per sync_delay, so a power cut
+    loses at most the changes of the last sync_delay seconds.
+    """
+
+    SNAPSHOT_DELAY = 5.0
+    SYNC_DELAY = 1.0
+
+    def __init__(self, snapshot_path, journal_path, snapshot_delay=SNAPSHOT_DELAY, sync_delay=SYNC_DELAY):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.snapshot_delay = snapshot_delay
+        self.sync_delay = sync_delay
+
+        self.parser = ConfigParser.ConfigParser()
+        self.lock = threading.RLock()
+        self.journal = None
+        self.timer = None
+        self.sync_timer = None
+        self.dirty = False
+
+    def load(self, config):
+        """Reads the given config and replays any journal written after it."""
+
+        with self.lock:
+            self.parser = ConfigParser.ConfigParser()
+            with open(config) as f:
+                self.parser.readfp(f)
+
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # a torn final line from a crash mid-write
+                            break
+                        self.apply(entry['section'], entry['values'])
+                        self.dirty = True
+
+            if self.dirty:
+                self.schedule_snapshot()
+
+            return self.parser
+
+    def apply(self, section, values):
+        if not self.parser.has_section(section):
+            self.parser.add_section(section)
+        for option, value in values.items():
+            if value is None:
+                self.parser.remove_option(section, option)
+            else:
+                self.parser.set(section, option, value)
+
+    def record(self, section, values):
+        """Journals the values of a section that differ from the stored state."""
+
+        with self.lock:
+            changed = {}
+            for option, value in values.items():
+                if value is not None:
+                    value = str(value)
+                if self.parser.has_option(section, option):
+                    current = self.parser.get(section, option)
+                else:
+                    current = None
+                if value != current:
+                    changed[option] = value
+
+            if not changed:
+                return
+
+            self.apply(section, changed)
+
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'a')
+            self.journal.write(json.dumps({'section': section, 'values': changed}) + '\n')
+            self.journal.flush()
+
+            # the first unsynced change opens the window, later ones join it
+            if self.sync_timer is None:
+                self.sync_timer = threading.Timer(self.sync_delay, self.sync)
+                self.sync_timer.daemon = True
+                self.sync_timer.start()
+
+            self.dirty = True
+            self.schedule_snapshot()
+
+    def sync(self):
+        """Forces the journal written so far to disk."""
+
+        with self.lock:
+            if self.sync_timer is not None:
+                self.sync_timer.cancel()
+                self.sync_timer = None
+            if self.journal is not None:
+                os.fsync(self.journal.fileno())
+
+    def schedule_snapshot(self):
+        # restart the quiet period on every change
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(self.snapshot_delay, self.snapshot)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def snapshot(self):
+        """Atomically replaces the snapshot file and empties the journal."""
+
+        with self.lock:
+            if not self.dirty:
+                return
+
+            temp_path = self.snapshot_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                self.parser.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_path, self.snapshot_path)
+
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+            self.dirty = False
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.sync_timer is not None:
+                self.sync_timer.cancel()
+                self.sync_timer = None
+            self.snapshot()
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+import struct
+import sys
+import time
+
+
+# payload format name in the mqtt topic, alongside 'json'
+FORMAT = 'bin'
+
+# schema version, the first byte of every payload; a side that does not
+# know a version keeps exchanging json with its peer
+VERSION = 3
+
+# version and message code in front of every payload
+HEADER = struct.Struct('<BB')
+
+BEVERAGE = struct.Struct('<H')
+REFILL = struct.Struct('<H')
+DISPENSED = struct.Struct('<Hd')
+STATE = struct.Struct('<HB')
+
+# device events end in their spool epoch, sequence number and time in
+# milliseconds, each 0 when they have none
+SPOOLED = struct.Struct('<QQQ')
+SPOOL_FIELDS = ('epoch', 'seq', 'time')
+
+# message codes of the events and commands with a compact layout
+CODES = {
+    'dispensed': 1,
+    'pouring': 2,
+    'online': 3,
+    'refill': 4,
+    'info': 5
+}
+NAMES = dict((code, name) for name, code in CODES.items())
+
+
+def compact(name):
+    return name in CODES
+
+
+def pack_mask(flags):
+    mask = bytearray((len(flags) + 7) // 8)
+    for index, flag in enumerate(flags):
+        if flag:
+            mask[index // 8] |= 1 << (index % 8)
+    return bytes(mask)
+
+
+def unpack_mask(payload, offset, count):
+    mask = bytearray(payload[offset:offset + (count + 7) // 8])
+    return [bool(mask[index // 8] & (1 << (index % 8))) for index in range(count)]
+
+
+def pack(name, data):
+    """
+    Encodes an event or command with a compact layout. The status of a
+    beverage is a single byte, and the beverages of an 'info' command
+    are reduced to online and pouring bitmasks, the only fields the
+    status Pi reads.
+    """
+
+    header = HEADER.pack(VERSION, CODES[name])
+    if name != 'info':
+        spooled = SPOOLED.pack(*[data.get(field, 0) for field in SPOOL_FIELDS])
+    if name == 'dispensed':
+        return header + DISPENSED.pack(data['beverage'], data['amount']) + spooled
+    if name in ('pouring', 'online'):
+        return header + STATE.pack(data['beverage'], bool(data['state'])) + spooled
+    if name == 'refill':
+        return header + REFILL.pack(data['beverage']) + spooled
+
+    beverages = data['beverages']
+    return (header + BEVERAGE.pack(len(beverages)) +
+            pack_mask([beverage.get('online') for beverage in beverages]) +
+            pack_mask([beverage.get('pouring') for beverage in beverages]))
+
+
+def unpack(payload):
+    """Returns the (name, data) of a packed payload."""
+
+    version, code = HEADER.unpack_from(payload)
+    if version != VERSION or code not in NAMES:
+        raise ValueError('Unsupported payload version %d code %d' % (version, code))
+
+    name = NAMES[code]
+    offset = HEADER.size
+    if name == 'dispensed':
+        beverage, amount = DISPENSED.unpack_from(payload, offset)
+        return name, spooled({'beverage': beverage, 'amount': amount}, payload, offset + DISPENSED.size)
+    if name in ('pouring', 'online'):
+        beverage, state = STATE.unpack_from(payload, offset)
+        return name, spooled({'beverage': beverage, 'state': bool(state)}, payload, offset + STATE.size)
+    if name == 'refill':
+        beverage, = REFILL.unpack_from(payload, offset)
+        return name, spooled({'beverage': beverage}, payload, offset + REFILL.size)
+
+    count, = BEVERAGE.unpack_from(payload, offset)
+    offset += BEVERAGE.size
+    online = unpack_mask(payload, offset, count)
+    pouring = unpack_mask(payload, offset + (count + 7) // 8, count)
+    return name, {'beverages': [{'online': online[index], 'pouring': pouring[index]} for index in range(count)]}
+
+
+def spooled(data, payload, offset):
+    for field, value in zip(SPOOL_FIELDS, SPOOLED.unpack_from(payload, offset)):
+        if value:
+            data[field] = value
+    return data
+
+
+class Message:
+    def __init__(self, data, timestamp):
+        self.data = data
+        self.timestamp = timestamp
+
+
+# the ibmiotf message encoder interface, registered for FORMAT on every
+# client; payloads are packed by the Transport, which knows their names
+
+def encode(data, timestamp):
+    return data
+
+
+def decode(message):
+    return Message(unpack(message.payload)[1], time.time())
+
+
+def register(client):
+    client.setMessageEncoderModule(FORMAT, sys.modules[__name__])
+    return client